@@ -0,0 +1,62 @@
+# numpy is an optional dependency, only required by the batch envy checker.
+try:
+	import numpy as np
+except ImportError:
+	np = None
+
+
+def _require_numpy():
+	if np is None:
+		raise ImportError('The batch envy checker requires numpy.')
+
+
+def rank_table(values):
+	"""Returns the rank table of a preference matrix, i.e. `ranks[a, o]` is
+	the index of object `o` in the preference order of actor `a`.
+
+	Args:
+		values (array-like): (N x N) preference matrix.
+
+	Returns: (numpy.ndarray) (N x N) rank table.
+	"""
+	_require_numpy()
+	values = np.asarray(values, dtype=np.intp)
+	size = values.shape[0]
+	ranks = np.empty_like(values)
+	ranks[np.arange(size)[:, None], values] = np.arange(size)
+	return ranks
+
+
+def check_allocations(values, allocations):
+	"""Checks the envy-freeness of many allocations at once. Actors are laid
+	out on a path: each actor can only envy its left and right neighbors, as
+	in `LEFInstance.check_solution`.
+
+	Args:
+		values (array-like): (N x N) preference matrix, or a `Preferences`.
+		allocations (array-like): (M x N) candidate allocations, each row 
+			holding the index allocated to each actor in its preference order.
+
+	Returns:
+		(numpy.ndarray, numpy.ndarray): Boolean vector of size M, True for 
+			envy-free allocations, and (M x N) boolean matrix flagging the 
+			envious actors of each allocation (see `check_actor_envy` in the
+			client).
+	"""
+	_require_numpy()
+	values = np.asarray(getattr(values, 'values', values), dtype=np.intp)
+	ranks = rank_table(values)
+	alloc = np.atleast_2d(np.asarray(allocations, dtype=np.intp))
+	size = values.shape[0]
+	actors = np.arange(size)
+
+	# Object held by each actor in each allocation.
+	objects = values[actors, alloc]
+	envious = np.zeros(alloc.shape, dtype=bool)
+	if size > 1:
+		# Actor a envies a+1 if it ranks a+1's object before its own.
+		envious[:, :-1] |= ranks[actors[:-1], objects[:, 1:]] < alloc[:, :-1]
+		# Actor a envies a-1 likewise.
+		envious[:, 1:] |= ranks[actors[1:], objects[:, :-1]] < alloc[:, 1:]
+
+	return ~envious.any(axis=1), envious
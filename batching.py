@@ -0,0 +1,59 @@
+class Outbox:
+	"""Outbox collects the messages produced while handling a request, so they
+	can be delivered as a single frame per recipient. Broadcast messages and 
+	messages addressed to the requesting connection are kept in order and sent
+	with a single group message when anything has to be broadcasted.
+
+	Attributes:
+		channel_name (str): Channel of the requesting connection.
+		messages (list): Collected messages, each a dict with the message
+			`data` and its recipient `to` (None for broadcasts).
+	"""
+
+	def __init__(self, channel_name):
+		self.channel_name = channel_name
+		self.messages = []
+
+	def add(self, return_data):
+		"""Adds data returned by a handler. If the data contains a key `type`
+		with the value "broadcast", the message goes to all players of the 
+		room.
+
+		Args:
+			return_data (dict): Data returned by a handler.
+		"""
+		broadcast = return_data.pop('type', None) == 'broadcast'
+		self.messages.append({
+			'to': None if broadcast else self.channel_name,
+			'data': return_data
+		})
+
+	@property
+	def has_broadcast(self):
+		return any(m['to'] is None for m in self.messages)
+
+	def event(self):
+		"""Returns the group message delivering the outbox (see `unpack`)."""
+		return {'type': 'batch', 'messages': self.messages}
+
+	def payload(self):
+		"""Returns the frame of the requesting connection."""
+		return Outbox.unpack(self.event(), self.channel_name)
+
+	def clear(self):
+		self.messages = []
+
+	@staticmethod
+	def unpack(event, channel_name):
+		"""Returns the frame of a recipient of a batch: a single message, an 
+		array of messages, or None if nothing is addressed to it.
+
+		Args:
+			event (dict): Group message sent by `event`.
+			channel_name (str): Channel of the recipient.
+		"""
+		data = [m['data'] for m in event['messages'] 
+			if m['to'] in (None, channel_name)]
+		if not data:
+			return None
+		return data[0] if len(data) == 1 else data
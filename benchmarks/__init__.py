@@ -0,0 +1,13 @@
+# Benchmarks are run with `manage.py benchmark <name>`. Each module exposes
+# `add_arguments(parser)` and `run(stdout, **options)`. Benchmarks setting
+# `USES_DATABASE` are run against a temporary test database.
+BENCHMARKS = [
+	'envy',
+	'consumers',
+	'wire',
+	'loadtest',
+	'layers',
+	'tokens',
+	'matchmaking',
+	'hints',
+]
@@ -0,0 +1,96 @@
+"""Concurrent connection capacity of the sync and async consumers."""
+from channels.routing import URLRouter
+from channels.testing import WebsocketCommunicator
+from django.test import override_settings
+from ..models import Player
+from ..routing import get_websocket_urlpatterns
+from ..utils import get_new_token
+
+import asyncio
+import time
+
+
+USES_DATABASE = True
+
+
+def add_arguments(parser):
+	parser.add_argument('--rooms', type=int, nargs='+',
+		default=[10, 50, 100, 200],
+		help='Numbers of rooms (2 connections each) started at once.')
+	parser.add_argument('--timeout', type=float, default=30,
+		help='Time after which a game start counts as failed.')
+
+
+def run(stdout, rooms, timeout, **options):
+	stdout.write('{:>6} {:>6} {:>10} {:>10} {:>10} {:>8}'.format(
+		'mode', 'rooms', 'p50 (ms)', 'p99 (ms)', 'total (s)', 'failed'))
+	layers = {'default': {'BACKEND': 'channels.layers.InMemoryChannelLayer'}}
+	with override_settings(CHANNEL_LAYERS=layers):
+		for use_async in (False, True):
+			application = URLRouter(get_websocket_urlpatterns(use_async))
+			for n in rooms:
+				tokens = [[get_new_token(), get_new_token()] for _ in range(n)]
+				Player.objects.bulk_create([Player(token=t)
+					for pair in tokens for t in pair])
+
+				start = time.perf_counter()
+				latencies = asyncio.run(start_games(application, tokens,
+					timeout))
+				total = time.perf_counter() - start
+
+				done = sorted(l for l in latencies if l is not None)
+				stdout.write('{:>6} {:>6} {:>10.1f} {:>10.1f} {:>10.2f} {:>8}'\
+					.format('async' if use_async else 'sync', n,
+						percentile(done, 50) * 1000,
+						percentile(done, 99) * 1000,
+						total, len(latencies) - len(done)))
+
+
+async def start_games(application, tokens, timeout):
+	"""Starts one game per pair of player tokens concurrently.
+
+	Returns: (list) Time taken by each game to load its instance, or None if
+		it failed.
+	"""
+	return await asyncio.gather(*[
+		start_game(application, pair, timeout) for pair in tokens])
+
+
+async def start_game(application, pair, timeout):
+	"""Connects two players to a new room and sets them ready until both
+	receive the instance.
+	"""
+	room_token = get_new_token()
+	start = time.perf_counter()
+	clients = [WebsocketCommunicator(application,
+		'/room/{}/{}/'.format(room_token, token)) for token in pair]
+	try:
+		await asyncio.gather(*[c.connect(timeout) for c in clients])
+		for client, token in zip(clients, pair):
+			await client.send_json_to({'action': 'set_ready',
+				'csmr_data': {'player_token': token}})
+		await asyncio.gather(*[receive_action(c, 'load_instance', timeout)
+			for c in clients])
+		return time.perf_counter() - start
+	except asyncio.TimeoutError:
+		return None
+	finally:
+		for client in clients:
+			await client.disconnect()
+
+
+async def receive_action(client, action, timeout):
+	"""Receives messages until one has the requested action. Frames may hold
+	a batch of messages.
+	"""
+	while True:
+		frame = await client.receive_json_from(timeout)
+		for message in frame if isinstance(frame, list) else [frame]:
+			if message.get('action') == action:
+				return message
+
+
+def percentile(values, p):
+	if not values:
+		return float('nan')
+	return values[min(len(values) - 1, int(len(values) * p / 100))]
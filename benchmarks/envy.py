@@ -0,0 +1,47 @@
+"""Batch envy checker against the per-allocation loop."""
+from django.core.management.base import CommandError
+from ..batch import check_allocations, np
+from ..models import LEFInstance
+from ..preferences import Preferences
+
+import time
+
+
+def add_arguments(parser):
+	parser.add_argument('--size', type=int, default=5,
+		help='Number of actors of the instance.')
+	parser.add_argument('--max-allocations', type=int, default=10**6,
+		help='Largest number of allocations checked at once.')
+	parser.add_argument('--loop-limit', type=int, default=10**6,
+		help='Skip the loop above this number of allocations.')
+
+
+def run(stdout, size, max_allocations, loop_limit, **options):
+	if np is None:
+		raise CommandError('numpy is required for the batch benchmark.')
+	values, _ = LEFInstance.random_values(size)
+	prefs = Preferences(values)
+	rng = np.random.default_rng(0)
+
+	stdout.write('{:>10} {:>12} {:>12} {:>8}'.format(
+		'M', 'loop (s)', 'batch (s)', 'speedup'))
+	m = 10
+	while m <= max_allocations:
+		allocations = rng.integers(0, size, (m, size))
+
+		start = time.perf_counter()
+		envy_free, envious = check_allocations(values, allocations)
+		batch_time = time.perf_counter() - start
+
+		if m <= loop_limit:
+			rows = allocations.tolist()
+			start = time.perf_counter()
+			expected = [prefs.is_envy_free(row) for row in rows]
+			loop_time = time.perf_counter() - start
+			assert expected == envy_free.tolist()
+			stdout.write('{:>10} {:>12.4f} {:>12.4f} {:>7.1f}x'.format(
+				m, loop_time, batch_time, loop_time / batch_time))
+		else:
+			stdout.write('{:>10} {:>12} {:>12.4f} {:>8}'.format(
+				m, '-', batch_time, '-'))
+		m *= 10
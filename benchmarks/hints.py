@@ -0,0 +1,72 @@
+"""Hints: latency of the constrained solve, cold and memoized."""
+from ..hints import HintCache
+from ..models import LEFInstance
+from ..preferences import Preferences
+from .consumers import percentile
+
+import random
+import threading
+import time
+
+
+def add_arguments(parser):
+	parser.add_argument('--sizes', type=int, nargs='+', default=[5, 8, 10],
+		help='Numbers of actors of the instances.')
+	parser.add_argument('--instances', type=int, default=200,
+		help='Number of instances per size.')
+	parser.add_argument('--threads', type=int, nargs='+', default=[1, 8],
+		help='Numbers of threads asking for hints at once.')
+	parser.add_argument('--seed', type=int, default=0,
+		help='Seed of the partial selections.')
+	parser.add_argument('--warm', action='store_true',
+		help='Warm the memo of every instance first, as loading the instance '
+			'of a room does (see HintCache.warm).')
+
+
+def run(stdout, sizes, instances, threads, seed, warm, **options):
+	"""Every instance is asked for a hint from partial selections of each
+	length: half of them follow an envy-free allocation, the others are
+	random (mostly dead ends). Each selection is asked for twice, the second
+	request being served by the memo.
+	"""
+	stdout.write('{:>5} {:>8} {:>10} {:>10} {:>10} {:>10}'.format(
+		'N', 'threads', 'cold p50', 'cold p99', 'memo p50', 'memo p99'))
+	for size in sizes:
+		rng = random.Random(seed)
+		requests = []
+		for pk in range(instances):
+			values, allocation = LEFInstance.random_values(size)
+			prefs = Preferences(values)
+			for k in range(size):
+				actors = rng.sample(range(size), k)
+				requests.append((pk, prefs, {a: allocation[a] for a in actors}))
+				requests.append((pk, prefs,
+					{a: rng.randrange(size) for a in actors}))
+
+		for count in threads:
+			cache = HintCache(maxsize=len(requests) * 2)
+			if warm:
+				for pk, prefs, _ in requests[::2 * size]:
+					cache.warm(pk, prefs)
+			cold, memo = [], []
+			chunks = [requests[i::count] for i in range(count)]
+
+			def ask(chunk):
+				for request in chunk:
+					for times in (cold, memo):
+						start = time.perf_counter()
+						cache.get(*request)
+						times.append(time.perf_counter() - start)
+
+			workers = [threading.Thread(target=ask, args=(chunk,))
+				for chunk in chunks]
+			for worker in workers:
+				worker.start()
+			for worker in workers:
+				worker.join()
+			cold.sort()
+			memo.sort()
+			stdout.write('{:>5} {:>8} {:>8.2f}ms {:>8.2f}ms {:>8.3f}ms '
+				'{:>8.3f}ms'.format(size, count, percentile(cold, 50) * 1000,
+					percentile(cold, 99) * 1000, percentile(memo, 50) * 1000,
+					percentile(memo, 99) * 1000))
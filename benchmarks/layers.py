@@ -0,0 +1,105 @@
+"""Group send throughput of the channel layers."""
+from channels.layers import InMemoryChannelLayer
+from multiprocessing import Process
+from ..layers import UnixSocketChannelLayer
+from ..management.commands.channel_broker import _serve
+
+import asyncio
+import os
+import shutil
+import tempfile
+import time
+
+
+def add_arguments(parser):
+	parser.add_argument('--groups', type=int, default=200,
+		help='Number of groups (rooms).')
+	parser.add_argument('--members', type=int, default=2,
+		help='Number of channels per group.')
+	parser.add_argument('--messages', type=int, default=20000,
+		help='Number of group sends.')
+	parser.add_argument('--shards', type=int, nargs='+', default=[1, 4],
+		help='Numbers of broker shards of the Unix socket layer.')
+	parser.add_argument('--redis', default='redis://localhost:6379',
+		help='Redis server of the channels_redis layer, which is skipped if '
+			'unavailable.')
+
+
+def run(stdout, groups, members, messages, shards, redis, **options):
+	stdout.write('{:>14} {:>14} {:>14}'.format(
+		'layer', 'sends/s', 'deliveries/s'))
+	layers = [('in-memory', lambda: InMemoryChannelLayer(capacity=messages))]
+	for n in shards:
+		layers.append(('unix ({})'.format(n), n))
+	layers.append(('redis', redis))
+
+	for name, layer in layers:
+		if isinstance(layer, int):
+			tmpdir = tempfile.mkdtemp()
+			path = os.path.join(tmpdir, 'broker')
+			brokers = start_brokers(path, layer, messages)
+			try:
+				rate = asyncio.run(group_send_rate(UnixSocketChannelLayer(
+					path, shards=layer), groups, members, messages))
+			finally:
+				for broker in brokers:
+					broker.terminate()
+				shutil.rmtree(tmpdir, ignore_errors=True)
+		elif isinstance(layer, str):
+			try:
+				from channels_redis.core import RedisChannelLayer
+				rate = asyncio.run(group_send_rate(RedisChannelLayer(
+					hosts=[layer], capacity=messages), groups, members,
+					messages))
+			except (ImportError, OSError) as e:
+				stdout.write('{:>14} skipped ({})'.format(name, e))
+				continue
+		else:
+			rate = asyncio.run(group_send_rate(layer(), groups, members,
+				messages))
+		stdout.write('{:>14} {:>14.0f} {:>14.0f}'.format(name, rate,
+			rate * members))
+
+
+def start_brokers(path, shards, capacity):
+	"""Starts the broker shards and waits for their sockets."""
+	brokers = [Process(target=_serve, args=('{}.{}'.format(path, i), 
+		capacity), daemon=True) for i in range(shards)]
+	for broker in brokers:
+		broker.start()
+	while not all(os.path.exists('{}.{}'.format(path, i)) 
+			for i in range(shards)):
+		time.sleep(.01)
+	return brokers
+
+
+async def group_send_rate(layer, groups, members, messages):
+	"""Sends messages to the groups in turn while all the channels receive.
+
+	Returns: (float) Number of group sends per second, until all messages are
+		received.
+	"""
+	channels = [[await layer.new_channel() for _ in range(members)]
+		for _ in range(groups)]
+	for g, group in enumerate(channels):
+		for channel in group:
+			await layer.group_add('group-{}'.format(g), channel)
+
+	async def receive(channel, count):
+		for _ in range(count):
+			await layer.receive(channel)
+
+	start = time.perf_counter()
+	receivers = [asyncio.ensure_future(receive(channel, 
+		len(range(g, messages, groups))))
+		for g, group in enumerate(channels) for channel in group]
+	for m in range(0, messages, groups):
+		await asyncio.gather(*[layer.group_send('group-{}'.format(g),
+			{'type': 'broadcast', 'data': {'action': 'load_context'}})
+			for g in range(min(groups, messages - m))])
+	await asyncio.gather(*receivers)
+	rate = messages / (time.perf_counter() - start)
+
+	if hasattr(layer, 'close'):
+		await layer.close()
+	return rate
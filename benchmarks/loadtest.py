@@ -0,0 +1,253 @@
+"""Full game flow of simulated players: latency, throughput and database
+queries per action.
+"""
+from channels.routing import URLRouter
+from channels.testing import WebsocketCommunicator
+from django.db.backends.utils import CursorWrapper
+from django.test import override_settings
+from ..preferences import Preferences
+from ..routing import get_websocket_urlpatterns
+from ..solver import Solver
+from .consumers import percentile
+
+import asyncio
+import random
+import threading
+import time
+
+
+USES_DATABASE = True
+
+# Actions of the flow, in order. `join` and `disconnect` are the websocket
+# connection and disconnection of the room.
+ACTIONS = ['menu', 'join', 'set_ready', 'check_solution', 'disconnect']
+
+
+def add_arguments(parser):
+	parser.add_argument('--players', type=int, default=200,
+		help='Number of simulated players (2 per room).')
+	parser.add_argument('--checks', type=int, default=5,
+		help='Number of solutions submitted by each player.')
+	parser.add_argument('--async', dest='use_async', action='store_true',
+		help='Use the asynchronous consumers.')
+	parser.add_argument('--timeout', type=float, default=60,
+		help='Time after which a request counts as failed.')
+	parser.add_argument('--seed', type=int, default=0,
+		help='Seed of the wrong solutions submitted.')
+
+
+def run(stdout, players, checks, use_async, timeout, seed, **options):
+	layers = {'default': {'BACKEND': 'channels.layers.InMemoryChannelLayer'}}
+	with override_settings(CHANNEL_LAYERS=layers):
+		application = URLRouter(get_websocket_urlpatterns(use_async))
+		test = LoadTest(application, players // 2, checks, timeout, seed)
+		asyncio.run(test.run())
+
+	stdout.write('{} rooms, {} consumers'.format(players // 2,
+		'async' if use_async else 'sync'))
+	stdout.write('{:>15} {:>8} {:>10} {:>10} {:>10} {:>10} {:>8}'.format(
+		'action', 'count', 'p50 (ms)', 'p99 (ms)', 'msg/s', 'queries',
+		'failed'))
+	for action in ACTIONS:
+		phase = test.phases[action]
+		done = sorted(l for l in phase.latencies if l is not None)
+		count = len(phase.latencies)
+		stdout.write('{:>15} {:>8} {:>10.1f} {:>10.1f} {:>10.0f} {:>10.2f} '
+			'{:>8}'.format(action, count,
+				percentile(done, 50) * 1000, percentile(done, 99) * 1000,
+				phase.messages / phase.duration if phase.duration else 0,
+				phase.queries / count if count else 0,
+				count - len(done)))
+
+
+class Phase:
+	"""Measures of one action of the flow, run by all the players at once.
+
+	Attributes:
+		latencies (list): Time taken by each request, None if it failed.
+		messages (int): Number of messages received by the players.
+		queries (int): Number of database queries run.
+		duration (float): Time taken by the whole phase.
+	"""
+
+	def __init__(self):
+		self.latencies = []
+		self.messages = 0
+		self.queries = 0
+		self.duration = 0.
+
+
+class QueryCounter:
+	"""Counts the queries run on all the database connections, whichever the
+	thread running them.
+	"""
+
+	def __init__(self):
+		self.count = 0
+		self._lock = threading.Lock()
+
+	def __enter__(self):
+		self._execute = CursorWrapper.execute
+		self._executemany = CursorWrapper.executemany
+		counter = self
+
+		def execute(cursor, *args, **kwargs):
+			counter.add()
+			return counter._execute(cursor, *args, **kwargs)
+
+		def executemany(cursor, *args, **kwargs):
+			counter.add()
+			return counter._executemany(cursor, *args, **kwargs)
+
+		CursorWrapper.execute = execute
+		CursorWrapper.executemany = executemany
+		return self
+
+	def __exit__(self, *exc):
+		CursorWrapper.execute = self._execute
+		CursorWrapper.executemany = self._executemany
+
+	def add(self):
+		with self._lock:
+			self.count += 1
+
+
+class LoadTest:
+	"""Simulated players, going through the flow of a game in pairs: menu
+	handshake, room join, `set_ready` until the instance is loaded, repeated
+	`check_solution` (the last one being valid) and disconnection. Each step
+	is run by all the players at once, so that the queries can be attributed
+	to it.
+	"""
+
+	def __init__(self, application, rooms, checks, timeout, seed):
+		self.application = application
+		self.rooms = rooms
+		self.checks = checks
+		self.timeout = timeout
+		self.rng = random.Random(seed)
+		self.phases = {action: Phase() for action in ACTIONS}
+
+	async def run(self):
+		with QueryCounter() as counter:
+			self.counter = counter
+			contexts = await self.phase('menu', [self.menu()
+				for _ in range(2 * self.rooms)])
+			pairs = [contexts[i:i+2] for i in range(0, len(contexts), 2)]
+			# Both players join the room proposed to the first one.
+			clients = await self.phase('join', [
+				self.join(pair[0]['next_room_token'], ctx['player_token'])
+				for pair in pairs for ctx in pair])
+			clients = [(c, ctx['player_token']) for c, ctx
+				in zip(clients, contexts)]
+
+			instances = await self.phase('set_ready', [
+				self.set_ready(client, token) for client, token in clients])
+			for check in range(self.checks):
+				await self.phase('check_solution', [
+					self.check_solution(client, token, values,
+						valid=check == self.checks - 1 and i % 2 == 0)
+					for i, ((client, token), values)
+						in enumerate(zip(clients, instances))])
+			await self.phase('disconnect', [self.disconnect(client)
+				for client, token in clients])
+
+	async def phase(self, action, coroutines):
+		"""Runs the requests of all the players for an action.
+
+		Returns: (list) Results of the requests.
+		"""
+		phase = self.phases[action]
+		queries = self.counter.count
+		start = time.perf_counter()
+		results = await asyncio.gather(*coroutines)
+		phase.duration += time.perf_counter() - start
+		phase.queries += self.counter.count - queries
+		return [r for r, latency in results]
+
+	async def request(self, action, client, content, expected):
+		"""Sends a request and waits for the message `expected`.
+
+		Returns: (dict, float) Message received and latency of the request.
+		"""
+		start = time.perf_counter()
+		try:
+			await client.send_json_to(content)
+			message = await self.receive(action, client, expected)
+		except asyncio.TimeoutError:
+			self.phases[action].latencies.append(None)
+			return None, None
+		latency = time.perf_counter() - start
+		self.phases[action].latencies.append(latency)
+		return message, latency
+
+	async def receive(self, action, client, expected):
+		"""Receives messages until one has the expected action. Frames may
+		hold a batch of messages.
+		"""
+		while True:
+			frame = await client.receive_json_from(self.timeout)
+			for message in frame if isinstance(frame, list) else [frame]:
+				self.phases[action].messages += 1
+				if message.get('action') == expected:
+					return message
+
+	async def menu(self):
+		client = WebsocketCommunicator(self.application, '/menu/')
+		await client.connect(self.timeout)
+		message, latency = await self.request('menu', client,
+			{'player_token': None}, 'load_context')
+		await client.disconnect()
+		return message['client_data'], latency
+
+	async def join(self, room_token, player_token):
+		client = WebsocketCommunicator(self.application,
+			'/room/{}/{}/'.format(room_token, player_token))
+		start = time.perf_counter()
+		await client.connect(self.timeout)
+		latency = time.perf_counter() - start
+		self.phases['join'].latencies.append(latency)
+		return client, latency
+
+	async def set_ready(self, client, player_token):
+		message, latency = await self.request('set_ready', client, {
+			'action': 'set_ready',
+			'csmr_data': {'player_token': player_token}
+		}, 'load_instance')
+		if message is None:
+			return None, None
+		return message['client_data']['instance']['values'], latency
+
+	async def check_solution(self, client, player_token, values, valid):
+		if values is None:
+			# The instance was never received.
+			self.phases['check_solution'].latencies.append(None)
+			return None, None
+		if valid:
+			allocation = Solver(values).solve()
+		else:
+			allocation = self.wrong_allocation(values)
+		return await self.request('check_solution', client, {
+			'action': 'check_solution',
+			'csmr_data': {
+				'player_token': player_token,
+				'solution': {str(a): i for a, i in enumerate(allocation)}
+			}
+		}, 'check_solution')
+
+	def wrong_allocation(self, values):
+		"""Returns a random allocation which is not envy-free."""
+		prefs = Preferences(values)
+		while True:
+			objects = list(range(len(values)))
+			self.rng.shuffle(objects)
+			allocation = [values[a].index(o) for a, o in enumerate(objects)]
+			if not prefs.is_envy_free(allocation):
+				return allocation
+
+	async def disconnect(self, client):
+		start = time.perf_counter()
+		await client.disconnect()
+		latency = time.perf_counter() - start
+		self.phases['disconnect'].latencies.append(latency)
+		return None, latency
@@ -0,0 +1,69 @@
+"""Matchmaking queue: enqueue throughput and match latency."""
+from ..matchmaking import Matchmaker
+from .consumers import percentile
+
+import random
+import time
+
+
+def add_arguments(parser):
+	parser.add_argument('--players', type=int, default=10**5,
+		help='Number of players enqueued.')
+	parser.add_argument('--rates', type=int, nargs='+',
+		default=[100, 1000, 10000],
+		help='Arrival rates (players per second) simulated.')
+	parser.add_argument('--interval', type=float, default=1.0,
+		help='Time (in seconds) between two passes pairing the waiting '
+			'players.')
+	parser.add_argument('--spread', type=float, default=300,
+		help='Standard deviation of the ratings. 0 enqueues players without'
+			' rating.')
+	parser.add_argument('--seed', type=int, default=0,
+		help='Seed of the ratings.')
+
+
+def run(stdout, players, rates, interval, spread, seed, **options):
+	"""Players arrive at a constant rate on a simulated clock, so the match
+	latency (time waited in the queue) does not depend on the speed of the
+	machine; the enqueue cost is measured on the wall clock.
+	"""
+	stdout.write('{:>8} {:>12} {:>10} {:>10} {:>10} {:>10} {:>8}'.format(
+		'rate', 'enqueue/s', 'p99 (us)', 'p50 (ms)', 'p99 (ms)', 'gap p50',
+		'waiting'))
+	for rate in rates:
+		rng = random.Random(seed)
+		now = [0.]
+		matchmaker = Matchmaker(clock=lambda: now[0])
+		waits, gaps, costs = [], [], []
+		next_pass = interval
+
+		for i in range(players):
+			now[0] = i / rate
+			while now[0] >= next_pass:
+				for pair in matchmaker.match_waiting():
+					record(pair, next_pass, waits, gaps)
+				next_pass += interval
+			rating = rng.gauss(1500, spread) if spread else None
+			start = time.perf_counter()
+			pair = matchmaker.enqueue(str(i), 'channel-{}'.format(i), rating)
+			costs.append(time.perf_counter() - start)
+			if pair is not None:
+				record(pair, now[0], waits, gaps)
+
+		waits.sort()
+		gaps.sort()
+		costs.sort()
+		stdout.write('{:>8} {:>12.0f} {:>10.1f} {:>10.1f} {:>10.1f} {:>10.1f}'
+			' {:>8}'.format(rate, len(costs) / sum(costs),
+				percentile(costs, 99) * 1e6, percentile(waits, 50) * 1000,
+				percentile(waits, 99) * 1000, percentile(gaps, 50),
+				len(matchmaker)))
+
+
+def record(pair, now, waits, gaps):
+	"""Records the time waited by both players of a pair and their rating 
+	difference.
+	"""
+	for ticket in pair:
+		waits.append(now - ticket.enqueued_at)
+	gaps.append(abs(pair[0].rating - pair[1].rating))
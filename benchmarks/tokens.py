@@ -0,0 +1,57 @@
+"""Token lookups of the menu and room connections with many players."""
+from ..consumers import MenuConsumer
+from ..models import Player
+from ..state import DatabaseRoomStore
+from ..utils import get_new_token
+from .loadtest import QueryCounter
+
+import time
+
+
+USES_DATABASE = True
+
+
+def add_arguments(parser):
+	parser.add_argument('--players', type=int, default=10**6,
+		help='Number of players in the database.')
+	parser.add_argument('--repeat', type=int, default=1000,
+		help='Number of connections timed.')
+
+
+def run(stdout, players, repeat, **options):
+	start = time.perf_counter()
+	tokens = ['{:08x}'.format(i) for i in range(players)]
+	for i in range(0, players, 10000):
+		Player.objects.bulk_create([Player(token=t)
+			for t in tokens[i:i+10000]])
+	stdout.write('Created {} players in {:.1f} s'.format(players,
+		time.perf_counter() - start))
+	stdout.write(Player.objects.filter(token=tokens[-1]).explain())
+
+	store = DatabaseRoomStore()
+	rooms = [get_new_token() for _ in range(repeat)]
+	# Players of the timed connections, spread over the table.
+	step = max(players // (2 * repeat), 1)
+	pairs = [(tokens[(2*i) * step % players], tokens[(2*i+1) * step % players])
+		for i in range(repeat)]
+
+	stdout.write('{:>14} {:>10} {:>10}'.format('operation', 'us/op',
+		'queries'))
+	measure(stdout, 'menu', [lambda p=p: MenuConsumer.load_context(
+		{'player_token': p[0]}) for p in pairs])
+	measure(stdout, 'create room', [lambda r=r, p=p: store.join(r, p[0])
+		for r, p in zip(rooms, pairs)])
+	measure(stdout, 'join room', [lambda r=r, p=p: store.join(r, p[1])
+		for r, p in zip(rooms, pairs)])
+	measure(stdout, 'leave room', [lambda r=r, p=p: store.leave(r, p[1])
+		for r, p in zip(rooms, pairs)])
+
+
+def measure(stdout, name, operations):
+	with QueryCounter() as queries:
+		start = time.perf_counter()
+		for operation in operations:
+			operation()
+		duration = time.perf_counter() - start
+	stdout.write('{:>14} {:>10.0f} {:>10.2f}'.format(name,
+		duration / len(operations) * 1e6, queries.count / len(operations)))
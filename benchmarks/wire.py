@@ -0,0 +1,39 @@
+"""Size and encoding time of the JSON and binary wire formats."""
+from ..generator import InstanceGenerator
+from .. import wire
+
+import json
+import time
+
+
+def add_arguments(parser):
+	parser.add_argument('--sizes', type=int, nargs='+', default=[5, 8, 12],
+		help='Sizes of the instances sent.')
+	parser.add_argument('--repeat', type=int, default=10000,
+		help='Number of encodings timed.')
+
+
+def run(stdout, sizes, repeat, **options):
+	generator = InstanceGenerator(0)
+	stdout.write('{:>5} {:>12} {:>12} {:>12} {:>12}'.format(
+		'N', 'json (B)', 'binary (B)', 'json (us)', 'binary (us)'))
+	for size in sizes:
+		values, _ = generator.generate(size)
+		message = {
+			'action': 'load_instance',
+			'client_data': {'instance': {'version': 1, 'size': size,
+				'values': values, 'solved_by': None, 'solution': None}}
+		}
+
+		start = time.perf_counter()
+		for _ in range(repeat):
+			text = json.dumps(message)
+		json_time = (time.perf_counter() - start) / repeat
+		start = time.perf_counter()
+		for _ in range(repeat):
+			frame = wire.encode(message)
+		binary_time = (time.perf_counter() - start) / repeat
+
+		stdout.write('{:>5} {:>12} {:>12} {:>12.1f} {:>12.1f}'.format(size,
+			len(text.encode('utf-8')), len(frame), json_time * 1e6, 
+			binary_time * 1e6))
@@ -0,0 +1,106 @@
+from django.conf import settings
+
+
+# Default values of the settings used by the game application. Each of them can
+# be overridden in the project settings.
+DEFAULTS = {
+	# Number of pre-generated instances kept in the pool for each size.
+	'LEF_INSTANCE_POOL_SIZES': {5: 50},
+	# The producer refills a size as soon as its pool drops below this level.
+	'LEF_INSTANCE_POOL_LOW_WATER_MARK': 20,
+	# Difficulty bands, as ranges [low, high) of instance tightness (see
+	# LEFInstance.tightness), and the band of the instances loaded when a 
+	# room does not request one (None for any instance).
+	'LEF_DIFFICULTY_BANDS': {
+		'easy': (0, .5),
+		'medium': (.5, .7),
+		'hard': (.7, 1.01),
+	},
+	'LEF_DEFAULT_DIFFICULTY': None,
+	# Difficulty features are only computed for instances up to this size,
+	# the solver being exponential in it.
+	'LEF_DIFFICULTY_MAX_SIZE': 20,
+	# Number of decoded preference matrices kept in the process-wide cache.
+	'LEF_PREFERENCE_CACHE_SIZE': 4096,
+	# Serve websockets with the asynchronous consumers (AsyncMenuConsumer and
+	# AsyncRoomConsumer) instead of the synchronous ones.
+	'LEF_ASYNC_CONSUMERS': False,
+	# Where handlers read the room state from: 'database' queries the models
+	# on every action, 'memory' keeps active rooms in memory and persists them
+	# in the background (see state.MemoryRoomStore).
+	'LEF_ROOM_STATE': 'database',
+	# Maximum delay (in seconds) and number of pending writes before the
+	# memory room store persists its changes.
+	'LEF_ROOM_STATE_FLUSH_INTERVAL': 1.0,
+	'LEF_ROOM_STATE_BATCH_SIZE': 500,
+	# Time (in seconds) during which a player whose connection was lost stays
+	# in its room and may resume its session. Players leave their room at the
+	# first sweep after it (see sweeper.Sweeper).
+	'LEF_RESUME_GRACE_PERIOD': 10,
+	# Rooms without activity for this long (in seconds) are closed, and the
+	# unsolved instances claimed this long ago that no room references are
+	# deleted.
+	'LEF_ROOM_IDLE_TIMEOUT': 3600,
+	# Minimum time (in seconds) between two records of the activity of a
+	# room (see Room.active_at), so that the actions of its players do not
+	# all write it. Must be well below LEF_ROOM_IDLE_TIMEOUT.
+	'LEF_ROOM_ACTIVITY_INTERVAL': 60,
+	# Time (in seconds) between two sweeps of the in-process sweeper. None 
+	# disables it, in which case `manage.py sweep` must be run periodically.
+	'LEF_SWEEP_INTERVAL': 5,
+	# Maximum number of rows handled by a batch of the sweeper.
+	'LEF_SWEEP_BATCH_SIZE': 500,
+	# Time (in seconds) during which the asynchronous room consumer collects
+	# outgoing messages before sending them in a single frame. With 0, the 
+	# messages of each request are sent together as soon as it is handled.
+	'LEF_BATCH_WINDOW': 0,
+	# Rating difference accepted at once between two players of the 
+	# matchmaking queue, and its increase per second waited.
+	'LEF_MATCHMAKING_TOLERANCE': 50,
+	'LEF_MATCHMAKING_WIDENING': 10,
+	# Time (in seconds) between two passes pairing the waiting players. None
+	# only pairs players when they are enqueued.
+	'LEF_MATCHMAKING_INTERVAL': 1.0,
+	# Dotted path of a function returning the rating of a player given its 
+	# token (None if unknown). Without it, players are paired in the order 
+	# they are enqueued. 'game.leaderboard.solve_rating' pairs players by
+	# win rate.
+	'LEF_MATCHMAKING_RATING': None,
+	# Number of players of the leaderboard (the largest K served), and the 
+	# time (in seconds) during which it is served from the cache of the 
+	# process.
+	'LEF_LEADERBOARD_SIZE': 100,
+	'LEF_LEADERBOARD_TIMEOUT': 5,
+	# Number of player selections tracked by the process (see 
+	# selection.SelectionTracker), and the minimum time (in seconds) between
+	# two broadcasts of the progress of a player.
+	'LEF_SELECTION_CACHE_SIZE': 8192,
+	'LEF_PROGRESS_INTERVAL': 0.5,
+	# Number of hints kept in the process-wide memo (see hints.HintCache).
+	'LEF_HINT_CACHE_SIZE': 16384,
+	# Directory of the room event log, one file per day (see eventlog.py). 
+	# None disables the log.
+	'LEF_EVENT_LOG_DIR': None,
+	# Maximum time (in seconds) during which the events are queued before
+	# being written.
+	'LEF_EVENT_LOG_FLUSH_INTERVAL': 1.0,
+	# Number of rooms per page of the menu room list.
+	'LEF_MENU_PAGE_SIZE': 20,
+	# Record the latency, queries and payload sizes of the consumer actions
+	# in the registry exposed by the `metrics` view (see instrumentation.py).
+	'LEF_INSTRUMENTATION': True,
+	# Actions taking longer than this (in seconds) are logged. None disables
+	# the log.
+	'LEF_SLOW_ACTION_THRESHOLD': None,
+	# Dotted paths of extra instrumentation hooks.
+	'LEF_INSTRUMENTATION_HOOKS': [],
+}
+
+
+def get_setting(name):
+	"""Returns the value of a game setting, falling back to its default.
+
+	Args:
+		name (str): Name of the setting.
+	"""
+	return getattr(settings, name, DEFAULTS[name])
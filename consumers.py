@@ -1,50 +1,286 @@
 from asgiref.sync import async_to_sync
-from channels.generic.websocket import JsonWebsocketConsumer
+from channels.db import database_sync_to_async
+from channels.generic.websocket import AsyncJsonWebsocketConsumer, \
+	JsonWebsocketConsumer
+from django.db import IntegrityError, transaction
+from django.db.models import Count
+from .batching import Outbox
+from .conf import get_setting
+from .hints import hint_cache
 from .utils import get_new_token
+from . import eventlog, instrumentation, wire
+from .eventlog import event_log
+from .leaderboard import leaderboard, player_stats
+from .matchmaking import create_room, get_rating, match_found, matchmaker
 from .models import Player, Room, LEFInstance
-
+from .pool import instance_pool
+from .preferences import preference_cache
+from .selection import opponent_progress, progress_throttle, \
+	selection_tracker
+from .state import room_store
+from .sweeper import sweeper
+
+import asyncio
 import json
 
 
+# Group of the menu connections, receiving the room list events.
+ROOMS_GROUP = 'rooms'
+
+
+def group_name(room_token):
+	"""Returns the group of the connections of a room."""
+	return 'group-{}'.format(room_token)
+
+
+# Actions of the menu (see MenuConsumer.handle).
+MENU_ACTIONS = frozenset(('load_context', 'load_rooms', 'load_leaderboard',
+	'enqueue', 'cancel_enqueue'))
+# Actions of a room (see RoomHandler).
+ROOM_ACTIONS = frozenset(('load_context', 'resume', 'notify_reconnect',
+	'set_ready', 'load_instance', 'check_solution', 'select', 'hint'))
+
+
 class MenuConsumer(JsonWebsocketConsumer):
-	"""MenuConsumer handles websocket connection for user in the menu."""
+	"""MenuConsumer handles websocket connection for user in the menu. The 
+	connection joins the rooms group, so the room list is kept up to date with
+	the events sent by the room consumers (see state.room_event).
+	"""
 
 	def connect(self):
+		async_to_sync(self.channel_layer.group_add)(
+			ROOMS_GROUP, 
+			self.channel_name
+		)
 		self.accept()
 
 	def disconnect(self, close_code):
-		pass
+		async_to_sync(self.channel_layer.group_discard)(
+			ROOMS_GROUP, 
+			self.channel_name
+		)
+		matchmaker.cancel(channel_name=self.channel_name)
+
+	def receive(self, text_data=None, bytes_data=None, **kwargs):
+		self.frame_size = len(text_data or bytes_data or '')
+		super().receive(text_data, bytes_data, **kwargs)
 
 	def receive_json(self, content):
-		"""Handles the unique action possible within the menu: `load_context`.
-		If the user requesting the context is new (i.e. doesn't have a token), 
-		a new Player object is created in the database.
+		sample = instrumentation.start('menu', 
+			MenuConsumer.action_label(content), self.frame_size)
+		reply = instrumentation.measure(sample, MenuConsumer.handle, content,
+			self.channel_name)
+		# The opponent found by the matchmaker is sent the same message.
+		for channel_name in reply.pop('notify', ()):
+			async_to_sync(self.channel_layer.send)(channel_name, 
+				{'type': 'match_event', 'data': reply})
+		# Send relevant data back to browser
+		self.send_json(content=reply)
+		instrumentation.finish(sample)
 
-		The context refers to the rooms currently active.
+	def send_json(self, content, close=False):
+		"""Sends a message and records its size (see instrumentation.py)."""
+		text = self.encode_json(content)
+		self.send(text_data=text, close=close)
+		instrumentation.record_send('menu', content, len(text))
+
+	def rooms_event(self, event):
+		"""Forwards a room list event to the browser."""
+		self.send_json(event['data'])
+
+	def match_event(self, event):
+		"""Sends the room of a match to the browser."""
+		self.send_json(event['data'])
+
+	@staticmethod
+	def action_label(content):
+		"""Returns the action of a request as recorded by the instrumentation.
+		The action is sent by the client, so unknown actions are recorded as
+		`load_context`, the action they are handled by (see `handle`).
 		"""
-		player_token = content.get('player_token', None)
-		player_results = Player.objects.filter(token=player_token)
-		if player_results.count() <= 0:
-			player_token = get_new_token()
-			Player.objects.create(token=player_token)
+		action = content.get('action')
+		return action if action in MENU_ACTIONS else 'load_context'
 
-		# Send relevant data back to browser
-		self.send_json(content={
-			'action': 'load_context',
-			'client_data': {
-				'player_token': player_token,
-				'next_room_token': get_new_token(),
-				'rooms': [r.serialize() 
-					for r in Room.objects.all()]
+	@staticmethod
+	def handle(content, channel_name=None):
+		"""Calls the menu action requested (`load_context` by default).
+
+		Args:
+			content (dict): data received.
+			channel_name (str): Channel of the connection.
+
+		Returns:
+			(dict) Data to be sent back to the user.
+		"""
+		action = content.get('action')
+		if action == 'load_rooms':
+			return {
+				'action': 'load_rooms',
+				'client_data': MenuConsumer.load_rooms(content.get('page', 0))
 			}
+		if action == 'load_leaderboard':
+			return {
+				'action': 'load_leaderboard',
+				'client_data': {
+					'leaderboard': leaderboard.top(
+						MenuConsumer.leaderboard_size(content.get('k'))),
+					'stats': player_stats(content.get('player_token'))
+				}
+			}
+		if action == 'enqueue':
+			return MenuConsumer.enqueue(content, channel_name)
+		if action == 'cancel_enqueue':
+			matchmaker.cancel(content.get('player_token'), channel_name)
+			return {'action': 'cancel_enqueue', 'client_data': {}}
+		return MenuConsumer.load_context(content)
+
+	@staticmethod
+	def leaderboard_size(k):
+		"""Returns the number of players of the leaderboard requested by the
+		client, None (the default) if it is not an integer.
+		"""
+		try:
+			return int(k)
+		except (TypeError, ValueError):
+			return None
+
+	@staticmethod
+	def enqueue(content, channel_name):
+		"""Handles the `enqueue` action of the menu: the player waits in the
+		matchmaking queue until an opponent is found (see 
+		matchmaking.Matchmaker). If one is waiting already, a room is created
+		for them, with its instance, and its token is sent to both.
+
+		Args:
+			content (dict): data received.
+			channel_name (str): Channel of the connection.
+
+		Returns:
+			(dict) Data to be sent back to the user. The channels of the
+				other players to be sent the same message are listed in 
+				`notify`.
+		"""
+		if get_setting('LEF_MATCHMAKING_INTERVAL'):
+			matchmaker.start()
+		player_token = content['player_token']
+		pair = matchmaker.enqueue(player_token, channel_name,
+			get_rating(player_token))
+		if pair is None:
+			return {
+				'action': 'enqueue',
+				'client_data': {'waiting': len(matchmaker)}
+			}
+		reply = match_found(create_room())
+		reply['notify'] = [pair[0].channel_name]
+		return reply
+
+	@staticmethod
+	def load_context(content):
+		"""Handles the `load_context` action of the menu. If the user 
+		requesting the context is new (i.e. doesn't have a token), a new Player
+		object is created in the database.
+
+		The context refers to the rooms currently active.
+
+		Args:
+			content (dict): data received.
+
+		Returns:
+			(dict) Data to be sent back to the user.
+		"""
+		player_token = content.get('player_token', None)
+		if player_token is None or \
+				not Player.objects.filter(token=player_token).exists():
+			while True:
+				try:
+					with transaction.atomic():
+						player_token = Player.objects.create(
+							token=get_new_token()).token
+					break
+				except IntegrityError:
+					# Token taken by another player.
+					continue
+
+		client_data = MenuConsumer.load_rooms(0)
+		client_data.update({
+			'player_token': player_token,
+			'next_room_token': get_new_token()
 		})
+		return {
+			'action': 'load_context',
+			'client_data': client_data
+		}
+
+	@staticmethod
+	def load_rooms(page):
+		"""Returns a page of the room list, newest rooms first. The players of
+		the rooms are counted in the same query.
+
+		Args:
+			page (int): Index of the page.
+
+		Returns:
+			(dict) Rooms of the page and whether there is a next page.
+		"""
+		size = get_setting('LEF_MENU_PAGE_SIZE')
+		start = max(int(page), 0) * size
+		rooms = list(Room.objects.annotate(
+			connected_count=Count('connected_players')
+		).order_by('-pk')[start:start+size+1])
+		return {
+			'rooms': [r.serialize() for r in rooms[:size]],
+			'page': page,
+			'has_next': len(rooms) > size
+		}
+
+
+class AsyncMenuConsumer(AsyncJsonWebsocketConsumer):
+	"""Asynchronous version of MenuConsumer. Database access is run in a 
+	thread, once per request.
+	"""
+
+	async def connect(self):
+		await self.channel_layer.group_add(ROOMS_GROUP, self.channel_name)
+		await self.accept()
+
+	async def disconnect(self, close_code):
+		await self.channel_layer.group_discard(ROOMS_GROUP, self.channel_name)
+		matchmaker.cancel(channel_name=self.channel_name)
+
+	async def receive(self, text_data=None, bytes_data=None, **kwargs):
+		self.frame_size = len(text_data or bytes_data or '')
+		await super().receive(text_data, bytes_data, **kwargs)
+
+	async def receive_json(self, content):
+		sample = instrumentation.start('menu', 
+			MenuConsumer.action_label(content), self.frame_size)
+		reply = await database_sync_to_async(instrumentation.measure)(
+			sample, MenuConsumer.handle, content, self.channel_name)
+		for channel_name in reply.pop('notify', ()):
+			await self.channel_layer.send(channel_name, 
+				{'type': 'match_event', 'data': reply})
+		await self.send_json(content=reply)
+		instrumentation.finish(sample)
+
+	async def send_json(self, content, close=False):
+		text = await self.encode_json(content)
+		await self.send(text_data=text, close=close)
+		instrumentation.record_send('menu', content, len(text))
+
+	async def rooms_event(self, event):
+		await self.send_json(event['data'])
+
+	async def match_event(self, event):
+		await self.send_json(event['data'])
 
 
 class RoomConsumer(JsonWebsocketConsumer):
 	"""RoomConsumer handles websocket connections for users playing in a room.
 
-	Because JsonWebsocketConsumer is synchronous, all access to database do not 
-	need protection against concurrency.
+	The players of a room may be served by different worker processes, so 
+	the writes racing between them (setting the instance of a room and 
+	solving it) are conditional updates: the first one wins and the others 
+	read its result (see state.DatabaseRoomStore).
 	"""
 
 	def connect(self):
@@ -54,30 +290,25 @@ class RoomConsumer(JsonWebsocketConsumer):
 		"""
 		player_token = self.scope['url_route']['kwargs']['player_token']
 		room_token = self.scope['url_route']['kwargs']['room_token']
-		self.group_name = 'group-{}'.format(room_token)
+		self.group_name = group_name(room_token)
+		self.binary = wire.wants_binary(self.scope)
 		# Join room group channel
 		async_to_sync(self.channel_layer.group_add)(
 			self.group_name,
 			self.channel_name
 		)
-		# Check room existence in database.
-		room_results = Room.objects.filter(token=room_token)
-		if room_results.count() <= 0:
-			# If room does not exist, create object in database.
-			room = Room.objects.create(token=room_token)
-		else:
-			room = room_results[0]
-		
-		# Set player status
-		player = Player.objects.get(token=player_token)
-		player.connected_to = room
-		player.save()
+		event = RoomConsumer.join_room(room_token, player_token)
+		if event is not None:
+			async_to_sync(self.channel_layer.group_send)(ROOMS_GROUP, 
+				{'type': 'rooms_event', 'data': event})
 
 		self.accept()
 
 	def disconnect(self, close_code):
-		"""This updates the player status and closes the room if no players are
-		left.
+		"""This records that the connection of the player was lost. The player
+		leaves the room, which is closed if no players are left, once the 
+		grace period during which the session may be resumed is over (see 
+		sweeper.Sweeper).
 		"""
 
 		# Leave room group
@@ -88,42 +319,93 @@ class RoomConsumer(JsonWebsocketConsumer):
 		
 		player_token = self.scope['url_route']['kwargs']['player_token']
 		room_token = self.scope['url_route']['kwargs']['room_token']
-		# Update player status
-		player = Player.objects.get(token=player_token)
-		player.connected_to = None
-		player.is_ready = False
-		player.save()
+		room_store.disconnect(room_token, player_token)
+		event_log.record(eventlog.DISCONNECT, room_token, player_token)
+		progress_throttle.forget(room_token, player_token)
 		# Notify other players
 		self.notify_disconnect()
-		# If last player to leave the room, delete room.
-		room = Room.objects.get(token=room_token)
-		players_connected = room.connected_players
-		if players_connected.count() <= 0:
-			room.delete()
+
+	@staticmethod
+	def join_room(room_token, player_token):
+		"""Resumes the session of the player if it is still in the room (its
+		connection was lost less than LEF_RESUME_GRACE_PERIOD seconds ago). 
+		Otherwise, the player joins the room.
+
+		Args:
+			room_token (str): Token of the room.
+			player_token (str): Token of the player.
+
+		Returns: (dict) Room list event to be sent to the menu, None if the
+			session was resumed.
+		"""
+		if get_setting('LEF_SWEEP_INTERVAL'):
+			sweeper.start()
+		if room_store.resume(room_token, player_token):
+			event_log.record(eventlog.RESUME, room_token, player_token)
+			return None
+		event_log.record(eventlog.JOIN, room_token, player_token)
+		return room_store.join(room_token, player_token)
 
 	def receive_json(self, content):
 		"""For each request, calls the correct handler (see RoomHandler) and
-		sends back the data returned by the handler.
+		sends back the data returned by the handler. All the messages produced
+		by the request are sent in a single frame per recipient.
 
 		Args:
 			content (dict): data received.
 		"""
+		room_token = self.scope['url_route']['kwargs']['room_token']
+		sample = instrumentation.start('room', 
+			RoomConsumer.action_label(content), self.frame_size)
+		try:
+			outbox = Outbox(self.channel_name)
+			for return_data in instrumentation.measure(sample, 
+					RoomConsumer.handle, content, room_token):
+				outbox.add(return_data)
+			if sample is not None:
+				sample.broadcast = outbox.has_broadcast
+			self.send_outbox(outbox)
+		finally:
+			instrumentation.finish(sample)
+
+	@staticmethod
+	def action_label(content):
+		"""Returns the action of a request as recorded by the instrumentation.
+		The action is sent by the client, so unknown actions are recorded as
+		`unknown` (see `handle`).
+		"""
+		action = content.get('action')
+		return action if action in ROOM_ACTIONS else 'unknown'
+
+	@staticmethod
+	def handle(content, room_token):
+		"""Calls the handler of a request (see RoomHandler) and its callback.
+		Requests of an unknown action are ignored.
+
+		Args:
+			content (dict): data received.
+			room_token (str): Token of the room.
+
+		Returns:
+			(list) Data returned by the handler and by its callback.
+		"""
+		if content.get('action') not in ROOM_ACTIONS:
+			return []
 
 		# Inject room_token for handlers
-		content['csmr_data']['room_token'] = self.scope['url_route']\
-			['kwargs']['room_token']
+		content['csmr_data']['room_token'] = room_token
 		# Handle request.
 		return_data = getattr(RoomHandler, 
 			content['action'])(content['csmr_data'])
 
+		# Handlers return None when nothing is to be sent.
+		if return_data is None:
+			return []
 		callback = return_data.pop('callback', None)
-		self.send_return_data(return_data)
+		messages = [return_data]
 		if callback:
-			# FIX: No need to send callback data separately as the process is 
-			# synchronous and the user receives both messages at the same time..
-			callback_data = callback(content['csmr_data'])
-			self.send_return_data(callback_data)
-		
+			messages.append(callback(content['csmr_data']))
+		return messages
 
 	def broadcast(self, event):
 		"""When a message is of type broadcast, this method is called to send
@@ -146,24 +428,189 @@ class RoomConsumer(JsonWebsocketConsumer):
 			}
 		)
 
-	def send_return_data(self, return_data):
-		"""Method used to send data back to the players. If the data contains a
-		key `type` with the value "broadcast", the message is broadcasted to all
-		players in the room.
+	def receive(self, text_data=None, bytes_data=None, **kwargs):
+		"""Decodes binary frames (see wire.py) before handling them."""
+		self.frame_size = len(text_data or bytes_data or '')
+		if bytes_data is not None:
+			try:
+				content = wire.decode(bytes_data)
+			except wire.ProtocolError:
+				# The client does not speak the protocol.
+				self.close(code=wire.CLOSE_MALFORMED)
+				return
+			self.receive_json(content, **kwargs)
+		else:
+			super().receive(text_data=text_data, **kwargs)
+
+	def send_json(self, content, close=False):
+		"""Sends a message, as a binary frame if the client negotiated the 
+		binary encoding, and records its size (see instrumentation.py).
 		"""
-		if return_data.pop('type', None) == 'broadcast':
+		if self.binary:
+			frame = wire.encode(content)
+			self.send(bytes_data=frame, close=close)
+		else:
+			frame = self.encode_json(content)
+			self.send(text_data=frame, close=close)
+		instrumentation.record_send('room', content, len(frame))
+
+	def batch(self, event):
+		"""Sends the messages of a batch addressed to this connection (see
+		batching.Outbox).
+
+		Args:
+			event (dict): event data.
+		"""
+		payload = Outbox.unpack(event, self.channel_name)
+		if payload is not None:
+			self.send_json(payload)
+
+	def send_outbox(self, outbox):
+		"""Method used to send data back to the players. If the outbox contains
+		broadcast messages, it is sent to all players in the room with a single
+		group message.
+		"""
+		if outbox.has_broadcast:
 			async_to_sync(self.channel_layer.group_send)(
 				self.group_name,
-				{
-					'type': 'broadcast',
-					'data': return_data
-				}
+				outbox.event()
 			)
+		elif outbox.messages:
+			self.send_json(outbox.payload())
+
+
+class AsyncRoomConsumer(AsyncJsonWebsocketConsumer):
+	"""Asynchronous version of RoomConsumer. The database access of each 
+	connection, disconnection and request runs in a single thread call (see
+	RoomConsumer.join_room, state.DatabaseRoomStore.disconnect and 
+	RoomConsumer.handle), so the channel layer is never waited on from a 
+	worker thread.
+	"""
+
+	async def connect(self):
+		player_token = self.scope['url_route']['kwargs']['player_token']
+		room_token = self.scope['url_route']['kwargs']['room_token']
+		self.group_name = group_name(room_token)
+		self.binary = wire.wants_binary(self.scope)
+		self.outbox = Outbox(self.channel_name)
+		self.flush_task = None
+		await self.channel_layer.group_add(self.group_name, self.channel_name)
+		event = await database_sync_to_async(RoomConsumer.join_room)(
+			room_token, player_token)
+		if event is not None:
+			await self.channel_layer.group_send(ROOMS_GROUP, 
+				{'type': 'rooms_event', 'data': event})
+
+		await self.accept()
+
+	async def disconnect(self, close_code):
+		if self.flush_task is not None:
+			self.flush_task.cancel()
+			self.flush_task = None
+			await self.send_outbox()
+		await self.channel_layer.group_discard(
+			self.group_name, 
+			self.channel_name
+		)
+
+		player_token = self.scope['url_route']['kwargs']['player_token']
+		room_token = self.scope['url_route']['kwargs']['room_token']
+		await database_sync_to_async(room_store.disconnect)(
+			room_token, player_token)
+		event_log.record(eventlog.DISCONNECT, room_token, player_token)
+		progress_throttle.forget(room_token, player_token)
+		await self.channel_layer.group_send(self.group_name, {
+			'type': 'broadcast',
+			'data': {'action': 'notify_disconnect'}
+		})
+
+	async def receive_json(self, content):
+		room_token = self.scope['url_route']['kwargs']['room_token']
+		sample = instrumentation.start('room', 
+			RoomConsumer.action_label(content), self.frame_size)
+		try:
+			messages = await database_sync_to_async(instrumentation.measure)(
+				sample, RoomConsumer.handle, content, room_token)
+			for return_data in messages:
+				self.outbox.add(return_data)
+			if sample is not None:
+				sample.broadcast = self.outbox.has_broadcast
+
+			# Messages of the requests received within the batching window 
+			# are sent together.
+			window = get_setting('LEF_BATCH_WINDOW')
+			if not window:
+				await self.send_outbox()
+			elif self.flush_task is None:
+				self.flush_task = asyncio.ensure_future(
+					self.flush_later(window))
+		finally:
+			# With a batching window, the time until the reply is queued.
+			instrumentation.finish(sample)
+
+	async def receive(self, text_data=None, bytes_data=None, **kwargs):
+		self.frame_size = len(text_data or bytes_data or '')
+		if bytes_data is not None:
+			try:
+				content = wire.decode(bytes_data)
+			except wire.ProtocolError:
+				await self.close(code=wire.CLOSE_MALFORMED)
+				return
+			await self.receive_json(content, **kwargs)
+		else:
+			await super().receive(text_data=text_data, **kwargs)
+
+	async def send_json(self, content, close=False):
+		if self.binary:
+			frame = wire.encode(content)
+			await self.send(bytes_data=frame, close=close)
 		else:
-			self.send_json(return_data)
+			frame = await self.encode_json(content)
+			await self.send(text_data=frame, close=close)
+		instrumentation.record_send('room', content, len(frame))
+
+	async def flush_later(self, window):
+		await asyncio.sleep(window)
+		self.flush_task = None
+		await self.send_outbox()
+
+	async def broadcast(self, event):
+		await self.send_json(event['data'])
+
+	async def batch(self, event):
+		payload = Outbox.unpack(event, self.channel_name)
+		if payload is not None:
+			await self.send_json(payload)
+
+	async def send_outbox(self):
+		"""See RoomConsumer.send_outbox."""
+		outbox, self.outbox = self.outbox, Outbox(self.channel_name)
+		if outbox.has_broadcast:
+			await self.channel_layer.group_send(self.group_name, 
+				outbox.event())
+		elif outbox.messages:
+			await self.send_json(outbox.payload())
 
 
 class RoomHandler:
+	"""Handlers of the room actions. The room state is read and written 
+	through the room store (see state.py), which either queries the models or
+	keeps active rooms in memory depending on the LEF_ROOM_STATE setting.
+	"""
+
+	@staticmethod
+	def load_room(room_token):
+		"""Loads the state of a room and records its activity, so that the 
+		sweeper does not close it (see DatabaseRoomStore.touch).
+
+		Args:
+			room_token (str): Token of the room.
+
+		Returns: (RoomState) State of the room.
+		"""
+		room = room_store.load(room_token)
+		room_store.touch(room)
+		return room
 
 	@staticmethod
 	def load_context(data):
@@ -178,44 +625,111 @@ class RoomHandler:
 		"""
 		ctx = {}
 		# get context
-		room = Room.objects.get(token=data['room_token'])
-		ctx['players'] = room.connected_players.all()
+		room = RoomHandler.load_room(data['room_token'])
+		ctx['players'] = list(room.players.values())
 		# If all players are ready, load instance after loading context.
-		if ctx['players'].filter(is_ready=True).count() == 2:
+		if room.ready_count == 2:
 			ctx['callback'] = RoomHandler.load_instance
 		# send context
 		return {
 			'type': 'broadcast',
 			'action': 'load_context',
 			'client_data': {
-				'players': [p.serialize() for p in ctx['players']]
+				'players': [p.serialize(room.token) for p in ctx['players']],
+				'players_version': room.players_version
 			},
 			'callback': ctx.get('callback')
 		}
 
+	@staticmethod
+	def resume(data):
+		"""Called instead of `load_context` when a client reconnects. The 
+		client sends the versions of the players and of the instance it holds,
+		and only what changed since is sent back.
+
+		Args:
+			data (dict): request data, with `players_version`, 
+				`instance_version` and `is_solved`.
+
+		Returns:
+			(dict) Data to be sent back to the requesting user.
+		"""
+		room = RoomHandler.load_room(data['room_token'])
+		client_data = {'players_version': room.players_version}
+		if data.get('players_version') != room.players_version:
+			client_data['players'] = [p.serialize(room.token) 
+				for p in room.players.values()]
+
+		instance = room.instance
+		known_version = data.get('instance_version')
+		if instance is None:
+			if known_version is not None:
+				client_data['instance'] = None
+		elif known_version != instance.version or \
+				bool(data.get('is_solved')) != (instance.solved_by is not None):
+			client_data['instance'] = instance.serialize(known_version)
+
+		# The other player was told about the disconnection.
+		if instance is None and room.ready_count == 2:
+			callback = RoomHandler.load_instance
+		else:
+			callback = RoomHandler.notify_reconnect
+		return {
+			'type': None,
+			'action': 'resume',
+			'client_data': client_data,
+			'callback': callback
+		}
+
+	@staticmethod
+	def notify_reconnect(data):
+		# Broadcasted when a session is resumed, so that the game goes on.
+		return {
+			'type': 'broadcast',
+			'action': 'notify_reconnect',
+			'client_data': {}
+		}
+
 	@staticmethod
 	def set_ready(data):
 		# Set player ready status
-		player = Player.objects.get(token=data['player_token'])
-		player.is_ready = True
-		player.save()
+		room = RoomHandler.load_room(data['room_token'])
+		room_store.set_ready(room, data['player_token'])
+		event_log.record(eventlog.READY, room.token, data['player_token'])
 
 		return RoomHandler.load_context(data)
 
 	@staticmethod
 	def load_instance(data):
 		# Called when a room should be sent the instance. If the room does not
-		# have an associated instance, a new one is created.
-		room = Room.objects.get(token=data['room_token'])
-		if not room.current_instance:
-			room.current_instance = LEFInstance.random(5)
-			room.save()
+		# have an associated instance, one is claimed from the instance pool,
+		# in the difficulty band requested by the player, if any.
+		# Both players may trigger this at once: the instance claimed by the 
+		# loser goes back to the pool.
+		room = RoomHandler.load_room(data['room_token'])
+		if not room.instance:
+			band = data.get('difficulty') \
+				or get_setting('LEF_DEFAULT_DIFFICULTY')
+			if band not in get_setting('LEF_DIFFICULTY_BANDS'):
+				band = None
+			instance = instance_pool.claim(5, band)
+			if room_store.set_instance(room, instance):
+				event_log.record(eventlog.INSTANCE, room.token, 
+					instance_id=instance.pk, size=instance.size, band=band)
+			else:
+				instance_pool.release(instance)
+		# The time to solution is measured from the first time the instance
+		# is sent, and its first hints are ready by then.
+		if room.instance.started_at is None:
+			room_store.start_clock(room)
+			hint_cache.warm(room.instance.pk,
+				preference_cache.get(room.instance))
 
 		return {
 		 	'type': 'broadcast',
 			'action': 'load_instance',
 			'client_data': {
-				'instance': room.current_instance.serialize()
+				'instance': room.instance.serialize()
 			}
 		}
 
@@ -223,23 +737,79 @@ class RoomHandler:
 	def check_solution(data):
 		# Handles the evaluation of a solution from a player.
 		# If the solution is valid, the correct notification is sent back to
-		# both players.
-		room = Room.objects.get(token=data['room_token'])
-		instance = room.current_instance
-
-		is_solved = instance.check_solution(data['solution'])
+		# both players. The preferences of the instance are read from the 
+		# preference cache.
+		room = RoomHandler.load_room(data['room_token'])
+		instance = room.instance
+
+		is_valid = is_solved = instance.check_solution(data['solution'])
+		solution = ','.join(map(str, 
+			[data['solution'][str(x)] for x in range(instance.size)]))
+		if is_solved:
+			# Only the first valid solution wins the instance.
+			is_solved = room_store.solve(room, data['player_token'], solution)
+			preference_cache.invalidate(instance.pk)
+		event_log.record(eventlog.SUBMISSION, room.token, data['player_token'],
+			instance.pk, solution=solution, valid=is_valid)
 		if is_solved:
-			instance.solved_by = data['player_token']
-			instance.solution = ','.join(map(str, 
-				[data['solution'][str(x)] for x in range(instance.size)]
-			))
-			instance.save()
+			event_log.record(eventlog.SOLVE, room.token, data['player_token'],
+				instance.pk, time_to_solution=instance.time_to_solution)
 
+		# Players submitting a solution hold the instance: only its status is
+		# sent back.
 		return {
 			'type': 'broadcast' if is_solved else None,
 			'action': 'check_solution',
 			'client_data': {
 				'is_solved': is_solved,
-				'instance': instance.serialize()
+				'instance': instance.serialize(data.get('instance_version'))
 			}
-		}
\ No newline at end of file
+		}
+
+	@staticmethod
+	def select(data):
+		# Tracks the selection of a player (see selection.Selection): the 
+		# object at index `index` of its preference order is allocated to 
+		# actor `actor` (deselected if the index is None). When the progress
+		# of the player changes, it is broadcasted to the room, at most once
+		# per LEF_PROGRESS_INTERVAL (see selection.ProgressThrottle). Nothing
+		# is sent back otherwise.
+		room = RoomHandler.load_room(data['room_token'])
+		instance = room.instance
+		if instance is None or instance.solved_by is not None:
+			return None
+		index = data.get('index')
+		progress = selection_tracker.select(room.token, data['player_token'],
+			instance.pk, preference_cache.get(instance), int(data['actor']),
+			None if index is None else int(index))
+		if progress is None or not progress_throttle.offer(room.token, 
+				data['player_token'], progress):
+			return None
+		return dict(opponent_progress({data['player_token']: progress}), 
+			type='broadcast')
+
+	@staticmethod
+	def hint(data):
+		# Suggests the next move extending the selection of the player towards
+		# an envy-free allocation, or tells that it is a dead end (see 
+		# hints.compute). The selection is the one sent with the request, the
+		# one tracked by the server (see `select`) otherwise.
+		room = RoomHandler.load_room(data['room_token'])
+		instance = room.instance
+		if instance is None or instance.solved_by is not None:
+			hint = None
+		else:
+			selection = data.get('selection')
+			if selection is None:
+				tracked = selection_tracker.get(room.token, 
+					data['player_token'])
+				selection = dict(enumerate(tracked.alloc)) if tracked \
+					and tracked.instance_id == instance.pk else {}
+			hint = hint_cache.get(instance.pk, preference_cache.get(instance),
+				{int(a): None if i is None else int(i) 
+					for a, i in selection.items()})
+		return {
+			'type': None,
+			'action': 'hint',
+			'client_data': {'hint': hint}
+		}
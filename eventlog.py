@@ -0,0 +1,341 @@
+from datetime import datetime, timezone
+from .conf import get_setting
+
+import atexit
+import json
+import logging
+import mmap
+import os
+import queue
+import struct
+import threading
+import time
+
+
+logger = logging.getLogger(__name__)
+
+# Kinds of room events.
+JOIN = 1
+RESUME = 2
+READY = 3
+INSTANCE = 4
+SUBMISSION = 5
+SOLVE = 6
+DISCONNECT = 7
+KINDS = {
+	JOIN: 'join',
+	RESUME: 'resume',
+	READY: 'ready',
+	INSTANCE: 'instance',
+	SUBMISSION: 'submission',
+	SOLVE: 'solve',
+	DISCONNECT: 'disconnect',
+}
+
+# A record is the length of the rest of the record (unsigned int), followed
+# by the kind of the event (unsigned char), its time (seconds since the
+# epoch, double), the id of the instance (long long, 0 if none), the lengths
+# of the room token, of the player token and of the data (unsigned shorts),
+# then the tokens and the data (JSON), in UTF-8. All in little endian.
+LENGTH = struct.Struct('<I')
+FIXED = struct.Struct('<BdqHHH')
+
+
+class Event:
+	"""Room event read from a log file.
+
+	Attributes:
+		kind (int): Kind of the event (see KINDS).
+		time (float): Time of the event (in seconds since the epoch).
+		instance_id (int): Id of the instance of the room, None if unknown.
+		room_token (str): Token of the room.
+		player_token (str): Token of the player, None if the event is not a
+			player's.
+		data (dict): Details of the event.
+	"""
+	__slots__ = ('kind', 'time', 'instance_id', 'room_token', 'player_token',
+		'data')
+
+	def __init__(self, kind, time, instance_id, room_token, player_token,
+			data):
+		self.kind = kind
+		self.time = time
+		self.instance_id = instance_id
+		self.room_token = room_token
+		self.player_token = player_token
+		self.data = data
+
+	@property
+	def name(self):
+		return KINDS.get(self.kind, str(self.kind))
+
+	def __repr__(self):
+		return '<Event {} room={} player={} instance={}>'.format(self.name,
+			self.room_token, self.player_token, self.instance_id)
+
+
+def encode(kind, when, room_token, player_token=None, instance_id=None,
+		data=None):
+	"""Encodes an event into a record (see FIXED).
+
+	Returns: (bytes) Record, with its length prefix.
+
+	Raises:
+		ValueError: A token or the data is too long for the record, or the
+			data cannot be serialized.
+	"""
+	room = room_token.encode('utf-8')
+	player = (player_token or '').encode('utf-8')
+	payload = json.dumps(data, separators=(',', ':')).encode('utf-8') \
+		if data else b''
+	try:
+		fixed = FIXED.pack(kind, when, instance_id or 0, len(room),
+			len(player), len(payload))
+	except struct.error as e:
+		raise ValueError('Event too long for a record: {}'.format(e))
+	return b''.join((LENGTH.pack(len(fixed) + len(room) + len(player) +
+		len(payload)), fixed, room, player, payload))
+
+
+class EventLog:
+	"""Append-only log of the room events, one file per day (UTC) in a
+	directory. Recording an event only encodes and queues it: the records are
+	appended by a background thread, in a single write per batch, so that the
+	consumers never wait on the disk. An event that cannot be encoded is
+	dropped on its own, with a warning. Several processes may append to the
+	same file, each batch being written at once in append mode.
+
+	Attributes:
+		directory (str): Directory of the log files, None to disable the log.
+		flush_interval (float): Maximum time (in seconds) during which queued
+			events are kept before being written.
+	"""
+
+	def __init__(self, directory=None, flush_interval=None):
+		self.directory = directory if directory is not None \
+			else get_setting('LEF_EVENT_LOG_DIR')
+		self.flush_interval = flush_interval if flush_interval is not None \
+			else get_setting('LEF_EVENT_LOG_FLUSH_INTERVAL')
+		self._queue = queue.SimpleQueue()
+		self._lock = threading.Lock()
+		self._file = None
+		self._day = None
+		self._writer = None
+
+	def record(self, kind, room_token, player_token=None, instance_id=None,
+			**data):
+		"""Queues an event.
+
+		Args:
+			kind (int): Kind of the event (see KINDS).
+			room_token (str): Token of the room.
+			player_token (str): Token of the player, if it is a player's.
+			instance_id (int): Id of the instance of the room, if any.
+			data: Details of the event, serializable in JSON.
+		"""
+		if not self.directory:
+			return
+		when = time.time()
+		try:
+			record = encode(kind, when, room_token, player_token, instance_id,
+				data)
+		except (TypeError, ValueError):
+			logger.warning('Unable to log a %s event of room %s.',
+				KINDS.get(kind, kind), room_token, exc_info=True)
+			return
+		self._queue.put((when, record))
+		if self._writer is None:
+			self.start()
+
+	def start(self):
+		"""Starts the writer thread if it is not already running."""
+		with self._lock:
+			if self._writer is not None:
+				return
+			os.makedirs(self.directory, exist_ok=True)
+			self._writer = threading.Thread(target=self._run,
+				name='lef-event-log', daemon=True)
+			self._writer.start()
+			atexit.register(self.flush)
+
+	def _run(self):
+		"""Writer loop."""
+		while True:
+			time.sleep(self.flush_interval)
+			try:
+				self.flush()
+			except Exception:
+				logger.exception('Unable to write the event log.')
+
+	def flush(self):
+		"""Writes the queued events."""
+		events = []
+		while True:
+			try:
+				events.append(self._queue.get_nowait())
+			except queue.Empty:
+				break
+		if not events:
+			return
+		with self._lock:
+			records = []
+			for when, record in events:
+				day = log_day(when)
+				if day != self._day:
+					self._write(records)
+					records = []
+					self._open(day)
+				records.append(record)
+			self._write(records)
+
+	def _open(self, day):
+		if self._file is not None:
+			self._file.close()
+		self._file = open(log_path(self.directory, day), 'ab', buffering=0)
+		self._day = day
+
+	def _write(self, records):
+		"""Writes records whole: the file is unbuffered, and a write may be
+		short.
+		"""
+		if records:
+			data = memoryview(b''.join(records))
+			while data:
+				data = data[self._file.write(data):]
+
+	def close(self):
+		"""Writes the queued events and closes the current file."""
+		self.flush()
+		with self._lock:
+			if self._file is not None:
+				self._file.close()
+				self._file, self._day = None, None
+
+
+def log_day(when):
+	"""Returns the day (UTC) of the file of an event, as `YYYY-MM-DD`."""
+	return datetime.fromtimestamp(when, timezone.utc).strftime('%Y-%m-%d')
+
+
+def log_path(directory, day):
+	"""Returns the path of the log file of a day."""
+	return os.path.join(directory, 'events-{}.log'.format(day))
+
+
+def log_files(directory):
+	"""Returns the paths of the log files of a directory, oldest first."""
+	return sorted(os.path.join(directory, name)
+		for name in os.listdir(directory)
+		if name.startswith('events-') and name.endswith('.log'))
+
+
+class LogReader:
+	"""Reads a log file through a memory map, so that scanning it does not
+	read it into memory nor create an object per event. A record still being
+	written at the end of the file is left out.
+
+	Usage:
+		with LogReader(path) as reader:
+			for offset, kind, when, instance_id in reader.scan():
+				...
+	"""
+
+	def __init__(self, path):
+		self.path = path
+		self._file = open(path, 'rb')
+		size = os.fstat(self._file.fileno()).st_size
+		# Empty files cannot be mapped.
+		self.buffer = mmap.mmap(self._file.fileno(), 0,
+			access=mmap.ACCESS_READ) if size else b''
+
+	def __enter__(self):
+		return self
+
+	def __exit__(self, *args):
+		self.close()
+
+	def close(self):
+		if isinstance(self.buffer, mmap.mmap):
+			self.buffer.close()
+		self._file.close()
+
+	def scan(self):
+		"""Walks the records, only decoding their fixed part.
+
+		Yields: (tuple) Offset, kind, time and instance id of each record.
+		"""
+		buffer, size = self.buffer, len(self.buffer)
+		unpack_length, unpack_fixed = LENGTH.unpack_from, FIXED.unpack_from
+		offset = 0
+		while offset + LENGTH.size <= size:
+			length, = unpack_length(buffer, offset)
+			if offset + LENGTH.size + length > size:
+				break
+			kind, when, instance_id, _, _, _ = unpack_fixed(buffer,
+				offset + LENGTH.size)
+			yield offset, kind, when, instance_id
+			offset += LENGTH.size + length
+
+	def event(self, offset):
+		"""Decodes the record at an offset (see `scan`)."""
+		buffer = self.buffer
+		start = offset + LENGTH.size
+		kind, when, instance_id, room_size, player_size, data_size = \
+			FIXED.unpack_from(buffer, start)
+		start += FIXED.size
+		room = buffer[start:start+room_size].decode('utf-8')
+		start += room_size
+		player = buffer[start:start+player_size].decode('utf-8')
+		start += player_size
+		data = json.loads(buffer[start:start+data_size].decode('utf-8')) \
+			if data_size else {}
+		return Event(kind, when, instance_id or None, room, player or None,
+			data)
+
+	def events(self, kinds=None):
+		"""Replays the events of the file, in the order they were written.
+
+		Args:
+			kinds (set): Kinds of the events to decode, all by default.
+
+		Yields: (Event) Events.
+		"""
+		for offset, kind, _, _ in self.scan():
+			if kinds is None or kind in kinds:
+				yield self.event(offset)
+
+
+def replay(paths, kinds=None, room_token=None):
+	"""Replays the events of log files.
+
+	Args:
+		paths (list): Paths of the log files, in chronological order.
+		kinds (set): Kinds of the events replayed, all by default.
+		room_token (str): Token of the room whose events are replayed, all
+			rooms by default.
+
+	Yields: (Event) Events.
+	"""
+	for path in paths:
+		with LogReader(path) as reader:
+			for event in reader.events(kinds):
+				if room_token is None or event.room_token == room_token:
+					yield event
+
+
+def count_events(paths):
+	"""Counts the events of log files by kind, without decoding them.
+
+	Returns: (dict) Number of events by kind name.
+	"""
+	counts = {}
+	for path in paths:
+		with LogReader(path) as reader:
+			for _, kind, _, _ in reader.scan():
+				counts[kind] = counts.get(kind, 0) + 1
+	return {KINDS.get(kind, str(kind)): count
+		for kind, count in sorted(counts.items())}
+
+
+# Event log of the process.
+event_log = EventLog()
@@ -0,0 +1,117 @@
+from collections import OrderedDict
+from .conf import get_setting
+from .solver import Solver
+
+import threading
+
+
+class HintCache:
+	"""Process-wide LRU memo of the hints, keyed by instance id and partial
+	allocation. A hint is computed by a solve constrained to the partial
+	allocation (see `compute`); as most hints are asked for from the empty
+	selection or after following a previous hint, the same partial
+	allocations come back often. Those are memoized when the instance is
+	loaded (see `warm`); hints from other selections, mostly dead ends, are
+	still computed on their first request, which may take tens of
+	milliseconds for the larger instances.
+
+	Attributes:
+		maxsize (int): Maximum number of hints kept.
+	"""
+
+	def __init__(self, maxsize=None):
+		self.maxsize = maxsize if maxsize is not None \
+			else get_setting('LEF_HINT_CACHE_SIZE')
+		self._entries = OrderedDict()
+		self._lock = threading.Lock()
+
+	def get(self, instance_id, prefs, selection):
+		"""Returns the hint extending a partial allocation, computing it on a
+		miss.
+
+		Args:
+			instance_id (int): Id of the instance.
+			prefs (Preferences): Preferences of the instance.
+			selection (dict): Partial allocation (actor -> index in its
+				preference order, or None if it has no object).
+
+		Returns: (dict) See `compute`.
+		"""
+		partial = tuple(sorted((a, i) for a, i in selection.items()
+			if i is not None))
+		key = (instance_id, partial)
+		with self._lock:
+			hint = self._entries.get(key)
+			if hint is not None:
+				self._entries.move_to_end(key)
+				return hint
+
+		hint = compute(prefs, dict(partial))
+		with self._lock:
+			self._put(key, hint)
+		return hint
+
+	def warm(self, instance_id, prefs):
+		"""Memoizes the hints of the empty selection and of the selections
+		following the previous hints, with a single solve: they are the
+		successive moves of one envy-free allocation.
+
+		Args:
+			instance_id (int): Id of the instance.
+			prefs (Preferences): Preferences of the instance.
+		"""
+		solution = Solver(prefs).solve()
+		if solution is None:
+			hints = [((), {'dead_end': True, 'actor': None, 'index': None})]
+		else:
+			hints = [(tuple((b, solution[b]) for b in range(a)),
+				{'dead_end': False, 'actor': a, 'index': solution[a]})
+				for a in range(prefs.size)]
+		with self._lock:
+			for partial, hint in hints:
+				self._put((instance_id, partial), hint)
+
+	def _put(self, key, hint):
+		self._entries[key] = hint
+		self._entries.move_to_end(key)
+		if len(self._entries) > self.maxsize:
+			self._entries.popitem(last=False)
+
+	def clear(self):
+		with self._lock:
+			self._entries.clear()
+
+	def __len__(self):
+		return len(self._entries)
+
+
+def compute(prefs, partial):
+	"""Finds the next move extending a partial allocation towards an
+	envy-free allocation: the leftmost actor without object, and its object in
+	an envy-free allocation where the actors of the partial allocation keep
+	theirs.
+
+	Args:
+		prefs (Preferences): Preferences of the instance.
+		partial (dict): Partial allocation (actor -> index in its preference
+			order).
+
+	Returns: (dict) `dead_end` (True if no envy-free allocation extends the
+		partial one), and the `actor` and `index` of the move (None if there
+		is none).
+	"""
+	hint = {'dead_end': False, 'actor': None, 'index': None}
+	if any(not 0 <= a < prefs.size or not 0 <= i < prefs.size
+			for a, i in partial.items()):
+		return dict(hint, dead_end=True)
+	solution = Solver(prefs, fixed=partial).solve()
+	if solution is None:
+		return dict(hint, dead_end=True)
+	for a in range(prefs.size):
+		if a not in partial:
+			return dict(hint, actor=a, index=solution[a])
+	return hint
+
+
+# Hints shared by the consumers of the process.
+hint_cache = HintCache()
@@ -0,0 +1,298 @@
+from bisect import bisect_left
+from django.db import connection
+from django.utils.module_loading import import_string
+from .conf import get_setting
+
+import logging
+import threading
+import time
+
+
+logger = logging.getLogger(__name__)
+
+# Upper bounds of the histogram buckets.
+TIME_BUCKETS = (.001, .0025, .005, .01, .025, .05, .1, .25, .5, 1, 2.5, 5)
+COUNT_BUCKETS = (0, 1, 2, 3, 5, 10, 20, 50)
+SIZE_BUCKETS = (64, 256, 1024, 4096, 16384, 65536)
+
+
+class Sample:
+	"""Measures of a request handled by a consumer.
+
+	Attributes:
+		consumer (str): `menu` or `room`.
+		action (str): Action requested.
+		bytes_in (int): Size of the frame received.
+		start (float): Time at which the frame was received.
+		duration (float): Wall time until the reply was sent.
+		queries (int): Number of database queries run by the handler.
+		query_time (float): Time spent in those queries.
+		broadcast (boolean): True if the reply was sent to the whole room.
+	"""
+	__slots__ = ('consumer', 'action', 'bytes_in', 'start', 'duration',
+		'queries', 'query_time', 'broadcast')
+
+	def __init__(self, consumer, action, bytes_in):
+		self.consumer = consumer
+		self.action = action
+		self.bytes_in = bytes_in
+		self.start = time.perf_counter()
+		self.duration = 0.
+		self.queries = 0
+		self.query_time = 0.
+		self.broadcast = False
+
+	def __call__(self, execute, sql, params, many, context):
+		# Database execute wrapper (see Django's `connection.execute_wrapper`).
+		start = time.perf_counter()
+		try:
+			return execute(sql, params, many, context)
+		finally:
+			self.queries += 1
+			self.query_time += time.perf_counter() - start
+
+
+class Histogram:
+	"""Cumulative histogram, in the Prometheus format.
+
+	Attributes:
+		buckets (tuple): Upper bounds of the buckets.
+		counts (list): Number of values of each bucket (the last one holds
+			the values above all the bounds).
+		sum (float): Sum of the values.
+	"""
+
+	def __init__(self, buckets):
+		self.buckets = buckets
+		self.counts = [0] * (len(buckets) + 1)
+		self.sum = 0
+
+	def observe(self, value):
+		self.counts[bisect_left(self.buckets, value)] += 1
+		self.sum += value
+
+	@property
+	def count(self):
+		return sum(self.counts)
+
+
+class Registry:
+	"""In-process registry of the histograms and counters, by metric name and
+	labels.
+	"""
+
+	def __init__(self):
+		self.histograms = {}
+		self.counters = {}
+		self._help = {}
+		self._lock = threading.Lock()
+
+	def observe(self, name, buckets, value, **labels):
+		"""Adds a value to a histogram, created with `buckets` if needed."""
+		key = (name, tuple(sorted(labels.items())))
+		with self._lock:
+			histogram = self.histograms.get(key)
+			if histogram is None:
+				histogram = self.histograms[key] = Histogram(buckets)
+			histogram.observe(value)
+
+	def inc(self, name, value=1, **labels):
+		"""Increments a counter."""
+		key = (name, tuple(sorted(labels.items())))
+		with self._lock:
+			self.counters[key] = self.counters.get(key, 0) + value
+
+	def describe(self, name, text):
+		"""Sets the help text of a metric."""
+		self._help[name] = text
+
+	def clear(self):
+		with self._lock:
+			self.histograms.clear()
+			self.counters.clear()
+
+	def exposition(self):
+		"""Returns the metrics in the Prometheus text exposition format."""
+		with self._lock:
+			histograms = {k: (list(h.counts), h.sum)
+				for k, h in self.histograms.items()}
+			buckets = {k: h.buckets for k, h in self.histograms.items()}
+			counters = dict(self.counters)
+
+		kinds = dict([(k[0], 'histogram') for k in histograms] +
+			[(k[0], 'counter') for k in counters])
+		lines = []
+		for name, kind in sorted(kinds.items()):
+			if name in self._help:
+				lines.append('# HELP {} {}'.format(name, self._help[name]))
+			lines.append('# TYPE {} {}'.format(name, kind))
+			if kind == 'counter':
+				for (n, labels), value in sorted(counters.items()):
+					if n == name:
+						lines.append('{}{} {}'.format(name,
+							format_labels(labels), value))
+				continue
+			for (n, labels), (counts, total) in sorted(histograms.items()):
+				if n != name:
+					continue
+				cumulative = 0
+				for bound, count in zip(buckets[n, labels] + ('+Inf',),
+						counts):
+					cumulative += count
+					lines.append('{}_bucket{} {}'.format(name, format_labels(
+						labels + (('le', bound),)), cumulative))
+				lines.append('{}_sum{} {}'.format(name, format_labels(labels),
+					total))
+				lines.append('{}_count{} {}'.format(name,
+					format_labels(labels), cumulative))
+		return '\n'.join(lines) + '\n'
+
+
+def format_labels(labels):
+	if not labels:
+		return ''
+	return '{' + ','.join('{}="{}"'.format(k, str(v).replace('"', '\\"'))
+		for k, v in labels) + '}'
+
+
+class RegistryHook:
+	"""Records the samples in the histograms of a registry.
+
+	Attributes:
+		registry (Registry): Registry receiving the measures.
+	"""
+
+	def __init__(self, registry):
+		self.registry = registry
+		registry.describe('lef_action_seconds',
+			'Wall time of the actions, until the reply is sent.')
+		registry.describe('lef_action_queries',
+			'Database queries run by the actions.')
+		registry.describe('lef_action_query_seconds',
+			'Time spent in the database queries of the actions.')
+		registry.describe('lef_action_bytes_in', 'Size of the requests.')
+		registry.describe('lef_action_broadcasts_total',
+			'Number of actions replied to the whole room.')
+		registry.describe('lef_send_bytes',
+			'Size of the frames sent, by action of their first message.')
+		registry.describe('lef_send_total',
+			'Number of frames sent (the fan-out of the broadcasts).')
+
+	def record_action(self, sample):
+		labels = {'consumer': sample.consumer, 'action': sample.action}
+		registry = self.registry
+		registry.observe('lef_action_seconds', TIME_BUCKETS, sample.duration,
+			**labels)
+		registry.observe('lef_action_queries', COUNT_BUCKETS, sample.queries,
+			**labels)
+		registry.observe('lef_action_query_seconds', TIME_BUCKETS,
+			sample.query_time, **labels)
+		registry.observe('lef_action_bytes_in', SIZE_BUCKETS,
+			sample.bytes_in, **labels)
+		if sample.broadcast:
+			registry.inc('lef_action_broadcasts_total', **labels)
+
+	def record_send(self, consumer, action, size):
+		labels = {'consumer': consumer, 'action': action}
+		self.registry.observe('lef_send_bytes', SIZE_BUCKETS, size, **labels)
+		self.registry.inc('lef_send_total', **labels)
+
+
+class SlowActionLog:
+	"""Logs the actions taking longer than a threshold.
+
+	Attributes:
+		threshold (float): Duration (in seconds) above which an action is
+			logged.
+	"""
+
+	def __init__(self, threshold):
+		self.threshold = threshold
+
+	def record_action(self, sample):
+		if sample.duration >= self.threshold:
+			logger.warning('Slow %s action %s: %.1f ms, %d queries (%.1f ms), '
+				'%d bytes in.', sample.consumer, sample.action,
+				sample.duration * 1000, sample.queries,
+				sample.query_time * 1000, sample.bytes_in)
+
+	def record_send(self, consumer, action, size):
+		pass
+
+
+def measure(sample, func, *args):
+	"""Calls a request handler, counting the database queries it runs. Must
+	be called in the thread running the handler.
+
+	Args:
+		sample (Sample): Sample of the request.
+		func (callable): Handler.
+	"""
+	if sample is None:
+		return func(*args)
+	with connection.execute_wrapper(sample):
+		return func(*args)
+
+
+def start(consumer, action, bytes_in):
+	"""Starts the measures of a request.
+
+	Args:
+		consumer (str): `menu` or `room`.
+		action (str): Action requested.
+		bytes_in (int): Size of the frame received.
+
+	Returns: (Sample) Sample of the request, None if no hook is installed.
+	"""
+	if not hooks:
+		return None
+	return Sample(consumer, action, bytes_in)
+
+
+def finish(sample):
+	"""Records a request once its reply has been sent."""
+	if sample is None:
+		return
+	sample.duration = time.perf_counter() - sample.start
+	for hook in hooks:
+		hook.record_action(sample)
+
+
+def record_send(consumer, content, size):
+	"""Records a frame sent by a consumer.
+
+	Args:
+		consumer (str): `menu` or `room`.
+		content (dict|list): Message, or batch of messages, sent.
+		size (int): Size of the encoded frame.
+	"""
+	if not hooks:
+		return
+	message = content[0] if isinstance(content, list) and content \
+		else content
+	action = message.get('action') if isinstance(message, dict) else None
+	for hook in hooks:
+		hook.record_send(consumer, action or 'unknown', size)
+
+
+def get_hooks():
+	"""Returns the hooks selected by the LEF_INSTRUMENTATION,
+	LEF_SLOW_ACTION_THRESHOLD and LEF_INSTRUMENTATION_HOOKS settings. Extra
+	hooks are given by dotted path and instantiated without arguments; they
+	implement `record_action(sample)` and `record_send(consumer, action,
+	size)`.
+	"""
+	if not get_setting('LEF_INSTRUMENTATION'):
+		return []
+	result = [RegistryHook(registry)]
+	threshold = get_setting('LEF_SLOW_ACTION_THRESHOLD')
+	if threshold is not None:
+		result.append(SlowActionLog(threshold))
+	result += [import_string(path)()
+		for path in get_setting('LEF_INSTRUMENTATION_HOOKS')]
+	return result
+
+
+# Registry of the process, exposed by the `metrics` view.
+registry = Registry()
+hooks = get_hooks()
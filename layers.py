@@ -0,0 +1,511 @@
+from channels.exceptions import ChannelFull
+from channels.layers import BaseChannelLayer
+from collections import deque
+from zlib import crc32
+
+import asyncio
+import itertools
+import os
+import pickle
+import random
+import string
+import struct
+import time
+import weakref
+
+
+# Frames exchanged with the broker: length (unsigned int, big endian) and
+# pickled payload. Requests are `(id, command, *args)` and replies `(id,
+# result)`; messages pushed to a subscribed process have the id None.
+FRAME = struct.Struct('!I')
+
+
+async def read_frame(reader):
+	length, = FRAME.unpack(await reader.readexactly(FRAME.size))
+	return pickle.loads(await reader.readexactly(length))
+
+
+def pack_frame(payload):
+	data = pickle.dumps(payload, pickle.HIGHEST_PROTOCOL)
+	return FRAME.pack(len(data)) + data
+
+
+def shard_of(name, shards):
+	"""Returns the shard of a group or channel. The channels of a process
+	(`prefix!local`) are all held by the shard of their prefix.
+
+	Args:
+		name (str): Group or channel name.
+		shards (int): Number of shards.
+	"""
+	if '!' in name:
+		name = name[:name.index('!') + 1]
+	return crc32(name.encode('utf-8')) % shards
+
+
+class Broker:
+	"""One shard of the broker: holds the channel queues and the groups whose
+	names hash to it. Worker processes connect to every shard through a Unix
+	domain socket (see UnixSocketChannelLayer).
+
+	Attributes:
+		capacity (int): Maximum number of messages queued per channel.
+		group_expiry (int): Time (in seconds) after which group memberships
+			expire.
+	"""
+
+	def __init__(self, capacity=100, group_expiry=86400):
+		self.capacity = capacity
+		self.group_expiry = group_expiry
+		self.channels = {}
+		self.groups = {}
+		self.receivers = {}
+		self.subscribers = {}
+
+	async def serve(self, path):
+		"""Serves the shard on a Unix socket until cancelled. The socket is
+		created under a restrictive umask, so that only the owner can connect
+		to it, even before the first connection is accepted.
+		"""
+		if os.path.exists(path):
+			os.unlink(path)
+		umask = os.umask(0o177)
+		try:
+			server = await asyncio.start_unix_server(self.handle, path)
+		finally:
+			os.umask(umask)
+		async with server:
+			await server.serve_forever()
+
+	# Commands a connection may run, besides `subscribe`, `receive` and
+	# `cancel`, which need the connection.
+	COMMANDS = frozenset(('send', 'send_many', 'requeue', 'group_add',
+		'group_discard', 'group_channels', 'flush'))
+
+	async def handle(self, reader, writer):
+		"""Runs the commands of a connection. A connection sending an unknown
+		command is closed.
+		"""
+		prefixes = []
+		try:
+			while True:
+				request_id, command, *args = await read_frame(reader)
+				if command == 'subscribe':
+					prefixes.append(args[0])
+					self.subscribe(args[0], writer)
+					continue
+				if command == 'receive':
+					self.receive(args[0], writer, request_id)
+					continue
+				if command == 'cancel':
+					self.cancel(args[0], writer, request_id)
+					continue
+				if command not in self.COMMANDS:
+					break
+				result = getattr(self, command)(*args)
+				writer.write(pack_frame((request_id, result)))
+		except (asyncio.IncompleteReadError, ConnectionError):
+			pass
+		except asyncio.CancelledError:
+			# The server is shutting down.
+			pass
+		finally:
+			for prefix in prefixes:
+				if self.subscribers.get(prefix) is writer:
+					del self.subscribers[prefix]
+			for waiters in self.receivers.values():
+				for waiter in [w for w in waiters if w[0] is writer]:
+					waiters.remove(waiter)
+			writer.close()
+
+	def send(self, channel, message, capacity=None):
+		"""Queues a message, or delivers it to a waiting receiver.
+
+		Args:
+			channel (str): Channel name.
+			message (dict): Message.
+			capacity (int): Maximum number of messages queued on the channel,
+				`capacity` of the broker by default.
+
+		Returns: (boolean) False if the channel is full.
+		"""
+		if '!' in channel:
+			writer = self.subscribers.get(channel[:channel.index('!') + 1])
+			if writer is not None:
+				writer.write(pack_frame((None, (channel, message))))
+				return True
+		else:
+			waiters = self.receivers.get(channel)
+			if waiters:
+				writer, request_id = waiters.popleft()
+				writer.write(pack_frame((request_id, message)))
+				return True
+
+		queue = self.channels.setdefault(channel, deque())
+		if len(queue) >= (capacity or self.capacity):
+			return False
+		queue.append(message)
+		return True
+
+	def send_many(self, channels, message, capacities=None):
+		"""Sends a message to several channels, skipping the full ones.
+
+		Args:
+			channels (list): Channel names.
+			message (dict): Message.
+			capacities (list): Capacity of each channel (see `send`).
+		"""
+		for channel, capacity in zip(channels, capacities or
+				[None] * len(channels)):
+			self.send(channel, message, capacity)
+		return True
+
+	def receive(self, channel, writer, request_id):
+		"""Replies with the next message of a channel once there is one."""
+		queue = self.channels.get(channel)
+		if queue:
+			writer.write(pack_frame((request_id, queue.popleft())))
+		else:
+			self.receivers.setdefault(channel, deque()).append(
+				(writer, request_id))
+
+	def cancel(self, channel, writer, request_id):
+		"""Drops the waiter of a cancelled `receive`, and acknowledges it
+		with a None reply to the same request.
+		"""
+		waiters = self.receivers.get(channel)
+		if waiters and (writer, request_id) in waiters:
+			waiters.remove((writer, request_id))
+		writer.write(pack_frame((request_id, None)))
+
+	def requeue(self, channel, message):
+		"""Puts back at the head of a channel a message delivered to a
+		cancelled `receive`.
+		"""
+		waiters = self.receivers.get(channel)
+		if waiters:
+			writer, request_id = waiters.popleft()
+			writer.write(pack_frame((request_id, message)))
+		else:
+			self.channels.setdefault(channel, deque()).appendleft(message)
+		return True
+
+	def subscribe(self, prefix, writer):
+		"""Pushes the messages of the process channels `prefix*` to a
+		connection, starting with the ones already queued.
+		"""
+		self.subscribers[prefix] = writer
+		for channel in [c for c in self.channels if c.startswith(prefix)]:
+			for message in self.channels.pop(channel):
+				writer.write(pack_frame((None, (channel, message))))
+
+	def group_add(self, group, channel):
+		self.groups.setdefault(group, {})[channel] = time.time()
+
+	def group_discard(self, group, channel):
+		members = self.groups.get(group)
+		if members is not None:
+			members.pop(channel, None)
+			if not members:
+				del self.groups[group]
+
+	def group_channels(self, group):
+		"""Returns the channels of a group, dropping the expired ones."""
+		members = self.groups.get(group, {})
+		limit = time.time() - self.group_expiry
+		for channel in [c for c, t in members.items() if t < limit]:
+			del members[channel]
+		return list(members)
+
+	def flush(self):
+		self.channels.clear()
+		self.groups.clear()
+
+
+class Connection:
+	"""Multiplexed connection of a process to one shard of the broker. If the
+	connection is lost, the next command reconnects, and subscribes again if
+	the process was subscribed (see `subscribe`).
+
+	Attributes:
+		path (str): Path of the socket of the shard.
+		timeout (float): Time (in seconds) after which a request without
+			reply fails, None to wait forever.
+	"""
+
+	def __init__(self, path, timeout=None):
+		self.path = path
+		self.timeout = timeout
+		self.futures = {}
+		# Channel of each cancelled receive not acknowledged yet by the
+		# broker.
+		self.cancelled = {}
+		self.ids = itertools.count()
+		self.reader = self.writer = None
+		self.prefix = None
+		self.on_message = None
+		self._lock = asyncio.Lock()
+		self._task = None
+
+	async def connect(self):
+		async with self._lock:
+			if self.writer is None:
+				self.reader, self.writer = await asyncio.open_unix_connection(
+					self.path)
+				self._task = asyncio.ensure_future(self.read())
+				if self.prefix is not None:
+					self.writer.write(pack_frame((None, 'subscribe',
+						self.prefix)))
+
+	async def subscribe(self, prefix, on_message):
+		"""Asks the broker to push the messages of the process channels
+		`prefix*`, which are passed to `on_message(channel, message)`.
+		"""
+		self.on_message = on_message
+		if self.prefix is None:
+			self.prefix = prefix
+			if self.writer is not None:
+				self.writer.write(pack_frame((None, 'subscribe', prefix)))
+		await self.connect()
+
+	async def request(self, command, *args, timeout=False):
+		"""Sends a command and waits for its reply.
+
+		Args:
+			command (str): Command of the broker.
+			timeout (float): Overrides the timeout of the connection (None to
+				wait forever).
+
+		Raises:
+			asyncio.TimeoutError: There was no reply in time.
+			ConnectionError: The connection was lost.
+		"""
+		await self.connect()
+		request_id = next(self.ids)
+		future = asyncio.get_event_loop().create_future()
+		self.futures[request_id] = future
+		self.writer.write(pack_frame((request_id, command) + args))
+		try:
+			return await asyncio.wait_for(future,
+				self.timeout if timeout is False else timeout)
+		finally:
+			self.futures.pop(request_id, None)
+
+	async def receive(self, channel):
+		"""Waits as long as it takes for the next message of a channel held by
+		the broker. If the wait is cancelled, the broker drops the waiter, and
+		a message it had already delivered is put back in the channel (see
+		`read`).
+		"""
+		await self.connect()
+		request_id = next(self.ids)
+		future = asyncio.get_event_loop().create_future()
+		self.futures[request_id] = future
+		self.writer.write(pack_frame((request_id, 'receive', channel)))
+		try:
+			return await future
+		except asyncio.CancelledError:
+			if future.done() and not future.cancelled() and \
+					future.exception() is None:
+				# The message arrived along with the cancellation.
+				self._requeue(channel, future.result())
+			elif self.writer is not None:
+				self.cancelled[request_id] = channel
+				self.writer.write(pack_frame((request_id, 'cancel', channel)))
+			raise
+		finally:
+			self.futures.pop(request_id, None)
+
+	def _requeue(self, channel, message):
+		if self.writer is not None:
+			self.writer.write(pack_frame((next(self.ids), 'requeue', channel,
+				message)))
+
+	async def read(self):
+		"""Dispatches the replies and the pushed messages."""
+		try:
+			while True:
+				request_id, result = await read_frame(self.reader)
+				if request_id is None:
+					self.on_message(*result)
+					continue
+				channel = self.cancelled.pop(request_id, None)
+				if channel is not None:
+					# Reply to a cancelled receive: its message, followed by
+					# the acknowledgement of the cancellation, or the
+					# acknowledgement alone.
+					if result is not None:
+						self._requeue(channel, result)
+					continue
+				future = self.futures.pop(request_id, None)
+				if future is not None and not future.done():
+					future.set_result(result)
+		except (asyncio.IncompleteReadError, ConnectionError):
+			# The next command reconnects.
+			self.writer.close()
+			self.reader = self.writer = self._task = None
+			self.cancelled.clear()
+			for future in self.futures.values():
+				if not future.done():
+					future.set_exception(ConnectionError(
+						'Lost the connection to the broker.'))
+			self.futures.clear()
+
+	def close(self):
+		if self._task is not None:
+			self._task.cancel()
+		if self.writer is not None:
+			self.writer.close()
+		self.reader = self.writer = self._task = None
+
+
+class UnixSocketChannelLayer(BaseChannelLayer):
+	"""Channel layer for the worker processes of a single host, without Redis.
+	Groups and channels are sharded by name over the brokers started with
+	`manage.py channel_broker`, each listening on `{path}.{shard}`. A group
+	send asks the shard of the group for its channels and sends the message to
+	the shards of the channels, the channels of each process being held by a
+	single shard (see shard_of).
+
+	The channels created by `new_channel` are process-specific: their messages
+	are pushed by the broker to the process, which dispatches them locally.
+	Messages of these channels not received within `expiry` seconds are
+	dropped. The capacities of the channels are enforced by the broker for
+	the other channels, and by the process for its own.
+
+	Example settings:
+
+		CHANNEL_LAYERS = {'default': {
+			'BACKEND': 'game.layers.UnixSocketChannelLayer',
+			'CONFIG': {'path': '/run/lef/broker', 'shards': 4},
+		}}
+	"""
+
+	extensions = ['groups', 'flush']
+
+	def __init__(self, path, shards=1, expiry=60, group_expiry=86400,
+			capacity=100, channel_capacity=None, timeout=10):
+		super().__init__(expiry=expiry, capacity=capacity)
+		self.channel_capacity = self.compile_capacities(channel_capacity or {})
+		self.path = path
+		self.shards = shards
+		self.group_expiry = group_expiry
+		self.timeout = timeout
+		self.prefix = 'specific.{}!'.format(''.join(
+			random.choice(string.ascii_letters) for _ in range(12)))
+		# Connections are bound to the event loop using them.
+		self._loops = weakref.WeakKeyDictionary()
+
+	def _state(self):
+		loop = asyncio.get_event_loop()
+		state = self._loops.get(loop)
+		if state is None:
+			state = self._loops[loop] = {
+				'connections': [Connection('{}.{}'.format(self.path, i),
+					self.timeout) for i in range(self.shards)],
+				'queues': {},
+				'waiters': {},
+				'expired_at': time.time(),
+			}
+		return state
+
+	def _connection(self, name):
+		return self._state()['connections'][shard_of(name, self.shards)]
+
+	async def send(self, channel, message):
+		assert isinstance(message, dict), 'message is not a dict'
+		assert self.valid_channel_name(channel), 'Channel name not valid'
+		if not await self._connection(channel).request('send', channel,
+				message, self.get_capacity(channel)):
+			raise ChannelFull(channel)
+
+	async def receive(self, channel):
+		assert self.valid_channel_name(channel)
+		if not channel.startswith(self.prefix):
+			return await self._connection(channel).receive(channel)
+
+		state = self._state()
+		await self._connection(channel).subscribe(self.prefix, self._dispatch)
+		queues = state['queues']
+		limit = time.time() - self.expiry
+		queue = queues.pop(channel, None)
+		while queue:
+			sent_at, message = queue.popleft()
+			if sent_at >= limit:
+				if queue:
+					queues[channel] = queue
+				return message
+		future = state['waiters'][channel] = \
+			asyncio.get_event_loop().create_future()
+		try:
+			return await future
+		finally:
+			if state['waiters'].get(channel) is future:
+				del state['waiters'][channel]
+
+	def _dispatch(self, channel, message):
+		"""Delivers a message pushed by the broker to its receiver, or queues
+		it. Messages beyond the capacity of the channel are dropped.
+		"""
+		state = self._state()
+		future = state['waiters'].pop(channel, None)
+		if future is not None and not future.done():
+			future.set_result(message)
+			return
+		now = time.time()
+		queue = state['queues'].setdefault(channel, deque())
+		if len(queue) < self.get_capacity(channel):
+			queue.append((now, message))
+		if now - state['expired_at'] >= self.expiry:
+			self._expire(state, now)
+
+	def _expire(self, state, now):
+		"""Drops the expired messages, and the queues left empty, of the
+		channels nobody receives from any more.
+		"""
+		state['expired_at'] = now
+		limit = now - self.expiry
+		queues = state['queues']
+		for channel in list(queues):
+			queue = queues[channel]
+			while queue and queue[0][0] < limit:
+				queue.popleft()
+			if not queue:
+				del queues[channel]
+
+	async def new_channel(self, prefix='specific.'):
+		return '{}{}'.format(self.prefix, ''.join(
+			random.choice(string.ascii_letters) for _ in range(12)))
+
+	async def group_add(self, group, channel):
+		assert self.valid_group_name(group), 'Group name not valid'
+		assert self.valid_channel_name(channel), 'Channel name not valid'
+		await self._connection(group).request('group_add', group, channel)
+
+	async def group_discard(self, group, channel):
+		assert self.valid_group_name(group), 'Group name not valid'
+		assert self.valid_channel_name(channel), 'Channel name not valid'
+		await self._connection(group).request('group_discard', group, channel)
+
+	async def group_send(self, group, message):
+		assert isinstance(message, dict), 'Message is not a dict'
+		assert self.valid_group_name(group), 'Group name not valid'
+		channels = await self._connection(group).request('group_channels',
+			group)
+		by_shard = {}
+		for channel in channels:
+			by_shard.setdefault(shard_of(channel, self.shards), []).append(
+				channel)
+		connections = self._state()['connections']
+		await asyncio.gather(*[connections[shard].request('send_many',
+			members, message, [self.get_capacity(c) for c in members])
+			for shard, members in by_shard.items()])
+
+	async def flush(self):
+		await asyncio.gather(*[c.request('flush')
+			for c in self._state()['connections']])
+
+	async def close(self):
+		for connection in self._state()['connections']:
+			connection.close()
+		self._loops.pop(asyncio.get_event_loop(), None)
@@ -0,0 +1,75 @@
+from .conf import get_setting
+from .models import LEADERBOARD_ORDER, PlayerStats
+
+import threading
+import time
+
+
+class Leaderboard:
+	"""Process-wide cache of the top of the leaderboard. The players are
+	ranked by wins, then by best time to solution, reading the first rows of
+	the matching index of PlayerStats: a refresh reads `size` rows, whatever
+	the number of games played, and is done at most once per `timeout`.
+
+	Attributes:
+		size (int): Number of players kept, the largest K served.
+		timeout (float): Time (in seconds) during which the top is served
+			from the cache.
+		clock (callable): Monotonic clock.
+	"""
+
+	def __init__(self, size=None, timeout=None, clock=time.monotonic):
+		self.size = size if size is not None \
+			else get_setting('LEF_LEADERBOARD_SIZE')
+		self.timeout = timeout if timeout is not None \
+			else get_setting('LEF_LEADERBOARD_TIMEOUT')
+		self.clock = clock
+		self._top = None
+		self._expires_at = 0
+		self._lock = threading.Lock()
+
+	def top(self, k=None):
+		"""Returns the K best players.
+
+		Args:
+			k (int): Number of players, at most `size` (the default).
+
+		Returns: (list) Serialized statistics of the players (see
+			PlayerStats.serialize), the best first.
+		"""
+		k = self.size if k is None else max(0, min(k, self.size))
+		with self._lock:
+			if self._top is None or self.clock() >= self._expires_at:
+				self._top = [stats.serialize() for stats in
+					PlayerStats.objects.select_related('player')
+						.order_by(*LEADERBOARD_ORDER)[:self.size]]
+				self._expires_at = self.clock() + self.timeout
+			return self._top[:k]
+
+	def invalidate(self):
+		with self._lock:
+			self._top = None
+
+
+def player_stats(player_token):
+	"""Returns the serialized statistics of a player, None if it never played
+	a game to its end.
+	"""
+	stats = PlayerStats.objects.select_related('player').filter(
+		player__token=player_token).first()
+	return stats.serialize() if stats is not None else None
+
+
+def solve_rating(player_token):
+	"""Rating of a player for the matchmaking (see LEF_MATCHMAKING_RATING):
+	its win rate in percent, None if it never played a game to its end.
+	"""
+	stats = PlayerStats.objects.filter(player__token=player_token).values(
+		'games', 'wins').first()
+	if not stats or not stats['games']:
+		return None
+	return 100 * stats['wins'] / stats['games']
+
+
+# Leaderboard served by the menu consumers and views of the process.
+leaderboard = Leaderboard()
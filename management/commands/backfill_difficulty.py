@@ -0,0 +1,78 @@
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from itertools import islice
+from multiprocessing import Pool
+from ...conf import get_setting
+from ...models import LEFInstance
+
+import os
+import time
+
+
+class Command(BaseCommand):
+	help = ('Computes the difficulty fields of the instances stored without '
+		'them, in parallel.')
+
+	def add_arguments(self, parser):
+		parser.add_argument('--workers', type=int, default=os.cpu_count(),
+			help='Number of worker processes.')
+		parser.add_argument('--chunk-size', type=int, default=1000,
+			help='Number of instances computed and written at once.')
+		parser.add_argument('--limit', type=int, default=None,
+			help='Maximum number of instances processed.')
+
+	def handle(self, *args, **options):
+		pending = LEFInstance.objects.filter(solution_count__isnull=True,
+			size__lte=get_setting('LEF_DIFFICULTY_MAX_SIZE'))
+		total = pending.count()
+		if options['limit'] is not None:
+			total = min(total, options['limit'])
+		if not total:
+			self.stdout.write('All the instances have their difficulty.')
+			return
+
+		done, start = 0, time.perf_counter()
+		chunks = self.read_chunks(pending, options['chunk_size'], total)
+		with Pool(options['workers']) as pool:
+			# Chunks are read by this thread, a few at a time per worker.
+			while True:
+				window = list(islice(chunks, 2 * options['workers']))
+				if not window:
+					break
+				for results in pool.imap_unordered(_compute, window):
+					self.write_chunk(results)
+					done += len(results)
+					elapsed = time.perf_counter() - start
+					self.stdout.write('[{}/{}] {:.0f} instances/s'.format(
+						done, total, done / elapsed))
+
+	@staticmethod
+	def read_chunks(pending, chunk_size, total):
+		"""Yields the (id, size, preferences) rows of the instances to be 
+		processed, a chunk at a time, paginating on the primary key so that
+		each chunk is a single indexed query.
+		"""
+		last, read = 0, 0
+		while read < total:
+			rows = [(pk, size, bytes(preferences)) for pk, size, preferences
+				in pending.filter(pk__gt=last).order_by('pk').values_list(
+					'pk', 'size', 'preferences')[:min(chunk_size, total-read)]]
+			if not rows:
+				return
+			last = rows[-1][0]
+			read += len(rows)
+			yield rows
+
+	@staticmethod
+	def write_chunk(results):
+		"""Stores the difficulty fields of a chunk of instances."""
+		with transaction.atomic():
+			for pk, fields in results:
+				LEFInstance.objects.filter(pk=pk).update(**fields)
+
+
+def _compute(rows):
+	"""Worker entry point: computes the difficulty fields of a chunk."""
+	return [(pk, LEFInstance.difficulty_fields(
+		[list(preferences[a*size:(a+1)*size]) for a in range(size)]))
+		for pk, size, preferences in rows]
@@ -0,0 +1,60 @@
+from django.core.management.base import BaseCommand, CommandParser
+from django.db import connection
+from importlib import import_module
+from ...benchmarks import BENCHMARKS
+
+import os
+import shutil
+import tempfile
+
+
+class BenchmarkParser(CommandParser):
+	"""Parser of the arguments of a benchmark. Its module is only imported,
+	and its arguments added, once the benchmark is selected, so that the 
+	dependencies of the other benchmarks are not required.
+	"""
+	benchmark = None
+
+	def parse_known_args(self, args=None, namespace=None):
+		if self.benchmark is not None:
+			Command.get_benchmark(self.benchmark).add_arguments(self)
+			self.benchmark = None
+		return super().parse_known_args(args, namespace)
+
+
+class Command(BaseCommand):
+	help = 'Runs one of the benchmarks of the game application.'
+
+	def add_arguments(self, parser):
+		subparsers = parser.add_subparsers(dest='benchmark', 
+			title='benchmarks', parser_class=BenchmarkParser)
+		subparsers.required = True
+		for name in BENCHMARKS:
+			subparsers.add_parser(name).benchmark = name
+
+	def handle(self, *args, **options):
+		module = self.get_benchmark(options.pop('benchmark'))
+		if not getattr(module, 'USES_DATABASE', False):
+			module.run(self.stdout, **options)
+			return
+
+		# Never benchmark against the real database. SQLite test databases are
+		# kept in a file, as benchmarks access them from several threads.
+		old_name = connection.settings_dict['NAME']
+		test_settings = connection.settings_dict.setdefault('TEST', {})
+		tmpdir = None
+		if connection.vendor == 'sqlite' and not test_settings.get('NAME'):
+			tmpdir = tempfile.mkdtemp()
+			test_settings['NAME'] = os.path.join(tmpdir, 'benchmark.sqlite3')
+		connection.creation.create_test_db(verbosity=0, autoclobber=True)
+		try:
+			module.run(self.stdout, **options)
+		finally:
+			connection.creation.destroy_test_db(old_name, verbosity=0)
+			if tmpdir:
+				shutil.rmtree(tmpdir, ignore_errors=True)
+
+	@staticmethod
+	def get_benchmark(name):
+		return import_module('{}.benchmarks.{}'.format(
+			__package__.rsplit('.', 2)[0], name))
@@ -0,0 +1,43 @@
+from django.core.management.base import BaseCommand
+from multiprocessing import Process
+from ...layers import Broker
+
+import asyncio
+
+
+class Command(BaseCommand):
+	help = ('Runs the broker shards of the UnixSocketChannelLayer, one process '
+		'per shard.')
+
+	def add_arguments(self, parser):
+		parser.add_argument('--path', required=True,
+			help='Path of the sockets (shard i listens on PATH.i), as given '
+				'in the CONFIG of the channel layer.')
+		parser.add_argument('--shards', type=int, default=1,
+			help='Number of shards.')
+		parser.add_argument('--capacity', type=int, default=100,
+			help='Maximum number of messages queued per channel, unless the '
+				'channel layer gives the capacity of the channel.')
+
+	def handle(self, *args, **options):
+		processes = [Process(target=_serve, name='lef-broker-{}'.format(i),
+			args=('{}.{}'.format(options['path'], i), options['capacity']))
+			for i in range(options['shards'])]
+		for process in processes:
+			process.start()
+		self.stdout.write('Serving {} shards on {}.*'.format(len(processes),
+			options['path']))
+		try:
+			for process in processes:
+				process.join()
+		except KeyboardInterrupt:
+			for process in processes:
+				process.terminate()
+
+
+def _serve(path, capacity):
+	"""Runs one shard of the broker."""
+	try:
+		asyncio.run(Broker(capacity=capacity).serve(path))
+	except KeyboardInterrupt:
+		pass
@@ -0,0 +1,38 @@
+from django.core.management.base import BaseCommand, CommandError
+from ...conf import get_setting
+from ...eventlog import count_events, log_files, replay
+
+import datetime
+
+
+class Command(BaseCommand):
+	help = ('Counts the room events of the event log by kind, or replays the '
+		'events of a room.')
+
+	def add_arguments(self, parser):
+		parser.add_argument('--directory', default=None,
+			help='Directory of the log files. LEF_EVENT_LOG_DIR by default.')
+		parser.add_argument('--days', nargs='+', default=None,
+			help='Days (YYYY-MM-DD) read, all by default.')
+		parser.add_argument('--room', default=None,
+			help='Token of a room whose events are replayed.')
+
+	def handle(self, *args, **options):
+		directory = options['directory'] or get_setting('LEF_EVENT_LOG_DIR')
+		if not directory:
+			raise CommandError('No event log directory.')
+		paths = log_files(directory)
+		if options['days']:
+			paths = [p for p in paths if any(p.endswith(
+				'events-{}.log'.format(day)) for day in options['days'])]
+
+		if options['room'] is None:
+			for kind, count in count_events(paths).items():
+				self.stdout.write('{:<12} {:>10}'.format(kind, count))
+			return
+		for event in replay(paths, room_token=options['room']):
+			self.stdout.write('{} {:<12} {:<10} {} {}'.format(
+				datetime.datetime.fromtimestamp(event.time).isoformat(
+					timespec='milliseconds'), event.name,
+				event.player_token or '-', event.instance_id or '-',
+				event.data))
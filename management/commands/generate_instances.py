@@ -0,0 +1,150 @@
+from django.core.management.base import BaseCommand, CommandError
+from django.db import transaction
+from functools import partial
+from multiprocessing import Pool
+from ...generator import generate_chunk
+from ...models import LEFInstance
+
+import django
+import json
+import os
+import random
+import time
+
+
+class Command(BaseCommand):
+	help = 'Generates LEF instances in parallel and stores them in the database.'
+
+	def add_arguments(self, parser):
+		parser.add_argument('count', type=int,
+			help='Number of instances to generate.')
+		parser.add_argument('--size', type=int, default=5,
+			help='Number of actors of each instance.')
+		parser.add_argument('--solutions', type=int, default=None,
+			help='Exact number of solutions of each instance.')
+		parser.add_argument('--seed', type=int, default=None,
+			help='Seed of the generation. Each chunk derives its own seed '
+				'from it.')
+		parser.add_argument('--pooled', action='store_true',
+			help='Add the instances to the instance pool.')
+		parser.add_argument('--workers', type=int, default=os.cpu_count(),
+			help='Number of worker processes.')
+		parser.add_argument('--chunk-size', type=int, default=1000,
+			help='Number of instances generated and written at once.')
+		parser.add_argument('--checkpoint', default=None,
+			help='File recording the chunks written. Running the command '
+				'again with the same file resumes the generation.')
+
+	def handle(self, *args, **options):
+		count, chunk_size = options['count'], options['chunk_size']
+		if options['solutions'] is not None and options['solutions'] < 1:
+			raise CommandError('--solutions must be at least 1.')
+		params = {key: options[key] for key in 
+			('count', 'size', 'solutions', 'seed', 'pooled', 'chunk_size')}
+		done = self.load_checkpoint(options['checkpoint'], params)
+		resumed = bool(options['checkpoint']) and \
+			os.path.exists(options['checkpoint'])
+		if params['seed'] is None:
+			params['seed'] = random.randrange(2**32)
+		self.stdout.write('Seed: {}'.format(params['seed']))
+
+		chunks = [(c, min(chunk_size, count - c*chunk_size)) 
+			for c in range(-(-count // chunk_size)) if c not in done]
+		if not chunks:
+			self.stdout.write('All the chunks have already been written.')
+			return
+		checkpoint = self.open_checkpoint(options['checkpoint'], params)
+		totals = {'generated': 0, 'rejected': 0, 'tightened': 0}
+		written, start = 0, time.perf_counter()
+		work = partial(_generate, seed=params['seed'], size=options['size'],
+			solutions=options['solutions'])
+		try:
+			with Pool(options['workers'], initializer=django.setup) as pool:
+				for chunk, instances, stats in pool.imap_unordered(work, chunks):
+					# The interrupted run may have written the chunk and not
+					# recorded it yet.
+					if not (resumed and self.chunk_written(instances)):
+						self.write_chunk(instances, options['pooled'])
+					if checkpoint:
+						checkpoint.write('{}\n'.format(chunk))
+						checkpoint.flush()
+					for key in totals:
+						totals[key] += stats[key]
+					written += len(instances)
+					elapsed = time.perf_counter() - start
+					self.stdout.write('[{}/{}] {:.0f} instances/s'.format(
+						written, sum(n for _, n in chunks), written / elapsed))
+		finally:
+			if checkpoint:
+				checkpoint.close()
+
+		if totals['generated']:
+			self.stdout.write('Candidates: {}, rejected: {} ({:.1%}), '
+				'tightening swaps: {}.'.format(totals['generated'],
+					totals['rejected'], 
+					totals['rejected'] / totals['generated'], 
+					totals['tightened']))
+
+	@staticmethod
+	def write_chunk(instances, pooled):
+		"""Stores a chunk of instances with their difficulty fields. The 
+		preference matrices are packed in the instance rows, so a single bulk
+		insert is enough.
+		"""
+		with transaction.atomic():
+			LEFInstance.objects.bulk_create([
+				LEFInstance(size=len(values), pooled=pooled, 
+					preferences=LEFInstance.pack_values(values), **fields)
+				for values, fields in instances
+			], batch_size=500)
+
+	@staticmethod
+	def chunk_written(instances):
+		"""Checks whether the instances of a chunk are all stored already.
+		Chunks are written in a single transaction and generated identically
+		again when the generation resumes, so a chunk written but not
+		recorded in the checkpoint is found whole.
+		"""
+		packed = [LEFInstance.pack_values(values) for values, _ in instances]
+		found = set()
+		for i in range(0, len(packed), 500):
+			found.update(bytes(p) for p in LEFInstance.objects.filter(
+				size=len(instances[0][0]), preferences__in=packed[i:i+500],
+			).values_list('preferences', flat=True))
+		return found == set(packed)
+
+	@staticmethod
+	def load_checkpoint(path, params):
+		"""Returns the chunks already written according to the checkpoint 
+		file, and fills in the seed of the interrupted generation.
+		"""
+		if not path or not os.path.exists(path):
+			return set()
+		with open(path) as f:
+			saved = json.loads(f.readline())
+			if params['seed'] is None:
+				params['seed'] = saved['seed']
+			if saved != params:
+				raise CommandError('The checkpoint was written with other '
+					'parameters: {}'.format(saved))
+			return {int(line) for line in f if line.strip()}
+
+	@staticmethod
+	def open_checkpoint(path, params):
+		if not path:
+			return None
+		if os.path.exists(path):
+			return open(path, 'a')
+		checkpoint = open(path, 'w')
+		checkpoint.write(json.dumps(params) + '\n')
+		return checkpoint
+
+
+def _generate(chunk, seed, size, solutions):
+	"""Worker entry point: generates one (index, count) chunk and computes
+	the difficulty fields of its instances.
+	"""
+	chunk, instances, stats = generate_chunk(seed, chunk[0], chunk[1], size,
+		solutions)
+	return chunk, [(values, LEFInstance.difficulty_fields(values)) 
+		for values in instances], stats
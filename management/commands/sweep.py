@@ -0,0 +1,27 @@
+from django.core.management.base import BaseCommand
+from ...sweeper import Sweeper
+
+
+class Command(BaseCommand):
+	help = ('Expires disconnected players and idle rooms, and prunes the '
+		'unsolved instances no room references.')
+
+	def add_arguments(self, parser):
+		parser.add_argument('--grace-period', type=float, default=None,
+			help='Time (in seconds) after which disconnected players leave '
+				'their room. LEF_RESUME_GRACE_PERIOD by default.')
+		parser.add_argument('--idle-timeout', type=float, default=None,
+			help='Time (in seconds) after which idle rooms are closed. '
+				'LEF_ROOM_IDLE_TIMEOUT by default.')
+		parser.add_argument('--batch-size', type=int, default=None,
+			help='Maximum number of rows handled by a batch.')
+		parser.add_argument('--max-batches', type=int, default=None,
+			help='Maximum number of batches run by each step.')
+
+	def handle(self, *args, **options):
+		sweeper = Sweeper(grace_period=options['grace_period'],
+			idle_timeout=options['idle_timeout'], 
+			batch_size=options['batch_size'])
+		counts = sweeper.sweep(options['max_batches'])
+		self.stdout.write('Expired {players} players and {rooms} rooms, '
+			'pruned {instances} instances.'.format(**counts))
@@ -0,0 +1,285 @@
+from asgiref.sync import async_to_sync
+from bisect import bisect_left
+from channels.layers import get_channel_layer
+from django.db import IntegrityError, close_old_connections, transaction
+from django.utils.module_loading import import_string
+from .conf import get_setting
+from .models import Room
+from .pool import instance_pool
+from .utils import get_new_token
+
+import itertools
+import logging
+import threading
+import time
+
+
+logger = logging.getLogger(__name__)
+
+
+class Ticket:
+	"""Player waiting in the matchmaking queue.
+
+	Attributes:
+		player_token (str): Token of the player.
+		channel_name (str): Channel of the menu connection of the player.
+		rating (float): Skill of the player, players with close ratings
+			being paired first.
+		enqueued_at (float): Time at which the player was enqueued.
+		key (tuple): Position of the ticket in the queue: (rating, sequence
+			number).
+	"""
+	__slots__ = ('player_token', 'channel_name', 'rating', 'enqueued_at',
+		'key')
+
+	def __init__(self, player_token, channel_name, rating, enqueued_at, seq):
+		self.player_token = player_token
+		self.channel_name = channel_name
+		self.rating = rating
+		self.enqueued_at = enqueued_at
+		self.key = (rating, seq)
+
+
+class Matchmaker:
+	"""Matchmaker pairs the players waiting in its queue. The queue is kept
+	sorted by rating, so the closest opponent of a player is found by
+	bisection. A player is paired when it is enqueued if an opponent is
+	within the tolerance of that opponent; the tolerance of a ticket widens
+	with its waiting time, and the waiting players are paired periodically
+	(see `match_waiting`). Players without rating have a rating of 0 and are
+	paired first come, first served.
+
+	The queue lives in the memory of the process, so the menu connections
+	must be served by a single process to be paired together.
+
+	Attributes:
+		tolerance (float): Rating difference accepted at once.
+		widening (float): Increase of the tolerance per second waited.
+		clock (callable): Monotonic clock.
+	"""
+
+	def __init__(self, tolerance=None, widening=None, clock=time.monotonic):
+		self.tolerance = tolerance if tolerance is not None \
+			else get_setting('LEF_MATCHMAKING_TOLERANCE')
+		self.widening = widening if widening is not None \
+			else get_setting('LEF_MATCHMAKING_WIDENING')
+		self.clock = clock
+		# Sorted ticket keys, and the tickets by key, player and channel.
+		self._queue = []
+		self._tickets = {}
+		self._players = {}
+		self._channels = {}
+		self._seq = itertools.count()
+		self._lock = threading.Lock()
+		self._thread = None
+
+	def __len__(self):
+		return len(self._queue)
+
+	def enqueue(self, player_token, channel_name, rating=None):
+		"""Enqueues a player, or pairs it with the closest waiting opponent
+		whose tolerance accepts it. A player already waiting is enqueued
+		again.
+
+		Args:
+			player_token (str): Token of the player.
+			channel_name (str): Channel of the menu connection.
+			rating (float): Skill of the player, if known.
+
+		Returns: (tuple) The waiting ticket and the ticket of the player if
+			they were paired, None otherwise.
+		"""
+		now = self.clock()
+		with self._lock:
+			self._remove(self._players.get(player_token))
+			ticket = Ticket(player_token, channel_name, float(rating or 0),
+				now, next(self._seq))
+			# First ticket with a rating at least as high, the oldest of its
+			# rating, and the ticket before it.
+			idx = bisect_left(self._queue, (ticket.rating,))
+			best = None
+			for key in self._queue[max(idx-1, 0):idx+1]:
+				other = self._tickets[key]
+				gap = abs(other.rating - ticket.rating)
+				if gap <= self.tolerance_of(other, now) and \
+						(best is None or gap < best[0]):
+					best = (gap, other)
+			if best is not None:
+				self._remove(best[1])
+				return best[1], ticket
+
+			self._queue.insert(bisect_left(self._queue, ticket.key),
+				ticket.key)
+			self._tickets[ticket.key] = ticket
+			self._players[player_token] = ticket
+			self._channels[channel_name] = ticket
+			return None
+
+	def cancel(self, player_token=None, channel_name=None):
+		"""Removes a player from the queue, given its token or the channel of
+		its menu connection.
+
+		Returns: (boolean) True if the player was waiting.
+		"""
+		with self._lock:
+			ticket = self._players.get(player_token) \
+				or self._channels.get(channel_name)
+			return self._remove(ticket)
+
+	def tolerance_of(self, ticket, now):
+		"""Returns the rating difference accepted by a ticket."""
+		return self.tolerance + self.widening * (now - ticket.enqueued_at)
+
+	def match_waiting(self):
+		"""Pairs the waiting players whose tolerance widened enough, in a
+		single pass over the queue: neighbours in rating order are paired if
+		one of them accepts the other.
+
+		Returns: (list) Pairs of tickets, the oldest first.
+		"""
+		now = self.clock()
+		pairs = []
+		with self._lock:
+			queue, kept = self._queue, []
+			i = 0
+			while i < len(queue):
+				ticket = self._tickets[queue[i]]
+				if i + 1 < len(queue):
+					other = self._tickets[queue[i+1]]
+					if other.rating - ticket.rating <= max(
+							self.tolerance_of(ticket, now),
+							self.tolerance_of(other, now)):
+						pairs.append(sorted((ticket, other),
+							key=lambda t: t.enqueued_at))
+						i += 2
+						continue
+				kept.append(queue[i])
+				i += 1
+			for pair in pairs:
+				for ticket in pair:
+					self._forget(ticket)
+			self._queue = kept
+		return pairs
+
+	def _remove(self, ticket):
+		if ticket is None or self._tickets.get(ticket.key) is not ticket:
+			return False
+		del self._queue[bisect_left(self._queue, ticket.key)]
+		self._forget(ticket)
+		return True
+
+	def _forget(self, ticket):
+		del self._tickets[ticket.key]
+		if self._players.get(ticket.player_token) is ticket:
+			del self._players[ticket.player_token]
+		if self._channels.get(ticket.channel_name) is ticket:
+			del self._channels[ticket.channel_name]
+
+	def start(self, interval=None):
+		"""Starts the thread pairing the waiting players periodically, if it
+		is not already running.
+
+		Args:
+			interval (float): Time (in seconds) between two passes,
+				LEF_MATCHMAKING_INTERVAL by default.
+		"""
+		with self._lock:
+			if self._thread is not None:
+				return
+			self._thread = threading.Thread(target=self._run,
+				args=(interval or get_setting('LEF_MATCHMAKING_INTERVAL'),),
+				name='lef-matchmaker', daemon=True)
+			self._thread.start()
+
+	def requeue(self, ticket):
+		"""Puts back a ticket paired by `match_waiting` whose game could not
+		be started, keeping its place and waiting time. The ticket is dropped
+		if the player was enqueued again since.
+
+		Returns: (boolean) True if the ticket was put back.
+		"""
+		with self._lock:
+			if ticket.player_token in self._players or \
+					ticket.channel_name in self._channels:
+				return False
+			self._queue.insert(bisect_left(self._queue, ticket.key),
+				ticket.key)
+			self._tickets[ticket.key] = ticket
+			self._players[ticket.player_token] = ticket
+			self._channels[ticket.channel_name] = ticket
+			return True
+
+	def start_games(self, pairs, channel_layer):
+		"""Creates the rooms of the pairs and sends them to the players. The
+		players of a room that could not be created are put back in the queue.
+		"""
+		close_old_connections()
+		for pair in pairs:
+			try:
+				message = match_found(create_room())
+			except Exception:
+				logger.exception('Unable to start a matched game.')
+				for ticket in pair:
+					self.requeue(ticket)
+				continue
+			for ticket in pair:
+				try:
+					async_to_sync(channel_layer.send)(ticket.channel_name,
+						{'type': 'match_event', 'data': message})
+				except Exception:
+					logger.exception('Unable to send a match.')
+
+	def _run(self, interval):
+		"""Matching loop. The players paired are sent their room."""
+		channel_layer = get_channel_layer()
+		while True:
+			time.sleep(interval)
+			pairs = self.match_waiting()
+			if pairs:
+				self.start_games(pairs, channel_layer)
+
+
+def create_room(size=5):
+	"""Creates the room of two matched players, with an instance claimed from
+	the instance pool.
+
+	Args:
+		size (int): Number of actors of the instance.
+
+	Returns: (str) Token of the room.
+	"""
+	instance = instance_pool.claim(size)
+	while True:
+		try:
+			with transaction.atomic():
+				return Room.objects.create(token=get_new_token(),
+					current_instance=instance).token
+		except IntegrityError:
+			# Token taken by another room.
+			continue
+
+
+def match_found(room_token):
+	"""Builds the message sent to both players of a match.
+
+	Args:
+		room_token (str): Token of the room created for them.
+	"""
+	return {
+		'action': 'match_found',
+		'client_data': {'room_token': room_token}
+	}
+
+
+def get_rating(player_token):
+	"""Returns the rating of a player according to the function given by
+	dotted path in LEF_MATCHMAKING_RATING, None if there is none.
+	"""
+	path = get_setting('LEF_MATCHMAKING_RATING')
+	if not path:
+		return None
+	return import_string(path)(player_token)
+
+
+# Matchmaker shared by the menu consumers of the process.
+matchmaker = Matchmaker()
@@ -0,0 +1,18 @@
+# Generated by Django 2.2.28 on 2026-10-17 16:02
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('game', '0012_auto_20180916_1138'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='lefinstance',
+            name='pooled',
+            field=models.BooleanField(default=False),
+        ),
+    ]
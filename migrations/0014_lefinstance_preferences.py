@@ -0,0 +1,58 @@
+from array import array
+from django.db import migrations, models
+
+
+def pack_orders(apps, schema_editor):
+    """Packs the LEFOrder rows of each instance into its preference matrix."""
+    LEFInstance = apps.get_model('game', 'LEFInstance')
+    LEFOrder = apps.get_model('game', 'LEFOrder')
+    values = {}
+    for order in LEFOrder.objects.order_by('instance_id', 'index').iterator():
+        values.setdefault(order.instance_id, []).extend(
+            map(int, order.values.split(',')))
+    for instance in LEFInstance.objects.iterator():
+        instance.preferences = array('B', values.get(instance.pk, [])).tobytes()
+        instance.save(update_fields=['preferences'])
+
+
+def unpack_orders(apps, schema_editor):
+    """Recreates one LEFOrder row per actor from the preference matrix."""
+    LEFInstance = apps.get_model('game', 'LEFInstance')
+    LEFOrder = apps.get_model('game', 'LEFOrder')
+    orders = []
+    for instance in LEFInstance.objects.iterator():
+        matrix = bytes(instance.preferences)
+        for a in range(instance.size):
+            row = matrix[a*instance.size:(a+1)*instance.size]
+            orders.append(LEFOrder(instance=instance, index=a,
+                values=','.join(map(str, row))))
+    LEFOrder.objects.bulk_create(orders)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('game', '0013_lefinstance_pooled'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='lefinstance',
+            name='preferences',
+            field=models.BinaryField(default=b''),
+            preserve_default=False,
+        ),
+        migrations.RunPython(pack_orders, unpack_orders),
+        migrations.RemoveField(
+            model_name='leforder',
+            name='instance',
+        ),
+        migrations.DeleteModel(
+            name='LEFOrder',
+        ),
+        migrations.AlterField(
+            model_name='lefinstance',
+            name='solution',
+            field=models.TextField(null=True),
+        ),
+    ]
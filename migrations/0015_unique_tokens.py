@@ -0,0 +1,47 @@
+from django.db import migrations, models
+from django.db.models import Count
+from uuid import uuid4
+
+
+def renew_duplicate_tokens(apps, schema_editor):
+    """Gives a new token to every player and room sharing its token with an
+    older row, so that the tokens can be made unique. The oldest row keeps
+    the token; clients holding it are identified as before.
+    """
+    for name in ('Player', 'Room'):
+        model = apps.get_model('game', name)
+        duplicates = model.objects.values('token')\
+            .annotate(n=Count('pk')).filter(n__gt=1)\
+            .values_list('token', flat=True)
+        taken = set()
+        for token in duplicates:
+            rows = model.objects.filter(token=token).order_by('pk')
+            for row in rows[1:]:
+                new_token = str(uuid4())[:8]
+                while new_token in taken or \
+                        model.objects.filter(token=new_token).exists():
+                    new_token = str(uuid4())[:8]
+                taken.add(new_token)
+                model.objects.filter(pk=row.pk).update(token=new_token)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('game', '0014_lefinstance_preferences'),
+    ]
+
+    operations = [
+        migrations.RunPython(renew_duplicate_tokens,
+            migrations.RunPython.noop),
+        migrations.AlterField(
+            model_name='player',
+            name='token',
+            field=models.CharField(max_length=8, unique=True),
+        ),
+        migrations.AlterField(
+            model_name='room',
+            name='token',
+            field=models.CharField(max_length=8, unique=True),
+        ),
+    ]
@@ -0,0 +1,16 @@
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('game', '0015_unique_tokens'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='player',
+            name='disconnected_at',
+            field=models.DateTimeField(null=True),
+        ),
+    ]
@@ -0,0 +1,28 @@
+from django.db import migrations, models
+import django.utils.timezone
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('game', '0016_player_disconnected_at'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='lefinstance',
+            name='claimed_at',
+            field=models.DateTimeField(null=True),
+        ),
+        migrations.AddField(
+            model_name='room',
+            name='active_at',
+            field=models.DateTimeField(db_index=True,
+                default=django.utils.timezone.now),
+        ),
+        migrations.AlterField(
+            model_name='player',
+            name='disconnected_at',
+            field=models.DateTimeField(db_index=True, null=True),
+        ),
+    ]
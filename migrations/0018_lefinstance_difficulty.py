@@ -0,0 +1,36 @@
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('game', '0017_sweeper_timestamps'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='lefinstance',
+            name='actor_options',
+            field=models.BinaryField(null=True),
+        ),
+        migrations.AddField(
+            model_name='lefinstance',
+            name='search_effort',
+            field=models.IntegerField(db_index=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='lefinstance',
+            name='solution_count',
+            field=models.IntegerField(db_index=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='lefinstance',
+            name='tightness',
+            field=models.FloatField(db_index=True, null=True),
+        ),
+        migrations.AddIndex(
+            model_name='lefinstance',
+            index=models.Index(fields=['size', 'pooled', 'tightness'],
+                name='game_lefins_size_973a06_idx'),
+        ),
+    ]
@@ -0,0 +1,61 @@
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+def clear_unknown_times(apps, schema_editor):
+    """Times to solution were never recorded: 0 becomes unknown."""
+    LEFInstance = apps.get_model('game', 'LEFInstance')
+    LEFInstance.objects.filter(time_to_solution=0).update(
+        time_to_solution=None)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('game', '0018_lefinstance_difficulty'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='lefinstance',
+            name='started_at',
+            field=models.DateTimeField(null=True),
+        ),
+        migrations.AddField(
+            model_name='lefinstance',
+            name='winner',
+            field=models.ForeignKey(null=True,
+                on_delete=django.db.models.deletion.SET_NULL,
+                related_name='won_instances', to='game.Player'),
+        ),
+        migrations.AlterField(
+            model_name='lefinstance',
+            name='time_to_solution',
+            field=models.IntegerField(null=True),
+        ),
+        migrations.RunPython(clear_unknown_times,
+            migrations.RunPython.noop),
+        migrations.CreateModel(
+            name='PlayerStats',
+            fields=[
+                ('player', models.OneToOneField(
+                    on_delete=django.db.models.deletion.CASCADE,
+                    primary_key=True, related_name='stats', serialize=False,
+                    to='game.Player')),
+                ('games', models.IntegerField(default=0)),
+                ('wins', models.IntegerField(default=0)),
+                ('timed_wins', models.IntegerField(default=0)),
+                ('best_time', models.IntegerField(null=True)),
+                ('total_time', models.BigIntegerField(default=0)),
+            ],
+        ),
+        migrations.AddIndex(
+            model_name='playerstats',
+            index=models.Index(models.F('wins').desc(),
+                models.ExpressionWrapper(
+                    models.Q(best_time__isnull=True),
+                    output_field=models.BooleanField()).asc(),
+                models.F('best_time').asc(),
+                name='game_playerstats_top_idx'),
+        ),
+    ]
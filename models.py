@@ -1,86 +1,184 @@
+from array import array
 from django.db import models
-from random import shuffle, choice
+from django.db.models import BooleanField, ExpressionWrapper, F, Q, Value
+from django.db.models.functions import Coalesce, Least
+from django.utils import timezone
+from .conf import get_setting
+from .generator import default_generator
+from .preferences import Preferences, preference_cache
+from . import solver
 
 
 class LEFInstance(models.Model):
-	"""Represents a LEF instance in the database. It mostly acts as	a reference 
-	for the preference orders of each agents present in the instance.
+	"""Represents a LEF instance in the database. The preference orders of all
+	the actors are stored in the instance row as a packed matrix of bytes.
 
 	Attributes:
 		solved_by (CharField): Token of player that "wins" the instance.
-		solution (CharField): Allocation submitted by the winner. Stored as
+		winner (ForeignKey): Player that won the instance.
+		solution (TextField): Allocation submitted by the winner. Stored as
 			comma separated values in a string.
-		time_to_solution (IntegerField): Time taken (in seconds) to solve the 
-			instnace.
+		started_at (DateTimeField): Time at which the instance was first sent
+			to a room.
+		time_to_solution (IntegerField): Time taken (in milliseconds) to solve
+			the instance, from `started_at`.
 		size (IntegerField): Size of instance.
+		pooled (BooleanField): True while the instance waits in the instance 
+			pool (see pool.InstancePool) and has not been claimed by a room.
+		claimed_at (DateTimeField): Time at which the instance was claimed
+			for a room. Unsolved instances claimed long ago and no longer 
+			referenced by a room are pruned (see sweeper.Sweeper).
+		preferences (BinaryField): Preference matrix of the instance, one byte
+			per object, row `a` being the preference order of actor `a` (see 
+			`pack_values`).
+		solution_count (IntegerField): Number of envy-free allocations.
+		search_effort (IntegerField): Number of states expanded by the solver
+			to count them.
+		tightness (FloatField): Share of the actor/object pairs found in no
+			solution. Difficulty bands are ranges of tightness (see
+			LEF_DIFFICULTY_BANDS).
+		actor_options (BinaryField): Number of objects each actor holds in 
+			some solution, packed as unsigned shorts.
+
+		The difficulty features (see solver.difficulty) are computed when the
+		instance is created, and are null for instances larger than 
+		LEF_DIFFICULTY_MAX_SIZE or not backfilled yet.
 	"""
 
 	solved_by = models.CharField(max_length=8, null=True)
-	solution = models.CharField(max_length=13, null=True)
-	time_to_solution = models.IntegerField(default=0)
+	winner = models.ForeignKey('Player', on_delete=models.SET_NULL, null=True,
+		related_name='won_instances')
+	solution = models.TextField(null=True)
+	started_at = models.DateTimeField(null=True)
+	time_to_solution = models.IntegerField(null=True)
 	size = models.IntegerField()
+	pooled = models.BooleanField(default=False)
+	claimed_at = models.DateTimeField(null=True)
+	preferences = models.BinaryField()
+	solution_count = models.IntegerField(null=True, db_index=True)
+	search_effort = models.IntegerField(null=True, db_index=True)
+	tightness = models.FloatField(null=True, db_index=True)
+	actor_options = models.BinaryField(null=True)
+
+	class Meta:
+		# Claims of pooled instances in a difficulty band.
+		indexes = [models.Index(fields=['size', 'pooled', 'tightness'])]
+
+	# Objects are stored on a single byte, which bounds the size of instances.
+	MAX_SIZE = 256
 
 	@staticmethod
-	def random(N):
-		"""Generate a random solvable LEF instance. To ensure the instance
-		is solvable, an allocation is chosen randomly and the preference orders
-		for each actor is populated in accordance with the allocation.
+	def random(N, solutions=None):
+		"""Generate a random solvable LEF instance and store it in the database.
 
 		Args:
 			N (int): Number of actors.
+			solutions (int): Exact number of solutions requested, if any.
 
 		Returns: 
 			(LEFInstance): Database object representing the instance created.
 		"""
+		values, _ = default_generator.generate(N, solutions)
+		return LEFInstance.create_from_values(values)
+
+	@staticmethod
+	def random_values(N):
+		"""Generate the preference orders of a random solvable LEF instance 
+		(see generator.InstanceGenerator.planted).
+
+		Args:
+			N (int): Number of actors.
+
+		Returns: 
+			(list, dict): Preference orders of the actors and the allocation 
+				used to build them (actor -> index in its preference order).
+		"""
+		values, allocation = default_generator.planted(N)
+		return values, dict(enumerate(allocation))
+
+	@staticmethod
+	def create_from_values(values, pooled=False, difficulty=None):
+		"""Stores an instance, the preference orders of its actors and its
+		difficulty features.
+
+		Args:
+			values (list): Preference order of each actor.
+			pooled (bool): Whether the instance is kept in the instance pool.
+			difficulty (dict): Difficulty fields, if already computed (see
+				`difficulty_fields`).
+
+		Returns: 
+			(LEFInstance): Database object representing the instance created.
+		"""
+		if difficulty is None:
+			difficulty = LEFInstance.difficulty_fields(values)
+		return LEFInstance.objects.create(size=len(values), pooled=pooled,
+			claimed_at=None if pooled else timezone.now(),
+			preferences=LEFInstance.pack_values(values), **difficulty)
+
+	@staticmethod
+	def difficulty_fields(values):
+		"""Computes the difficulty features of an instance, as field values.
+
+		Args:
+			values (list): Preference order of each actor.
+
+		Returns: (dict) Values of the difficulty fields, empty if the 
+			instance is larger than LEF_DIFFICULTY_MAX_SIZE.
+		"""
+		if len(values) > get_setting('LEF_DIFFICULTY_MAX_SIZE'):
+			return {}
+		features = solver.difficulty(values)
+		return {
+			'solution_count': features['solutions'],
+			'search_effort': features['effort'],
+			'tightness': features['tightness'],
+			'actor_options': array('H', features['options']).tobytes()
+		}
+
+	@staticmethod
+	def pack_values(values):
+		"""Packs preference orders into the row-major byte matrix stored in 
+		`preferences`.
+
+		Args:
+			values (list): Preference order of each actor.
+
+		Returns: (bytes) Packed preference matrix.
+		"""
+		if len(values) > LEFInstance.MAX_SIZE:
+			raise ValueError('Instances are limited to {} actors.'.format(
+				LEFInstance.MAX_SIZE))
+		return array('B', [o for prefs in values for o in prefs]).tobytes()
 
-		# `objects` contains the mapping object_idx -> object_value
-		objects = list(range(N))
-		shuffle(objects)
-		# 1. First we declare the allocation chosen to ensure solvability:
-		# For each actor, the index of the allocated object in the preference
-		# order is chosen randomly.
-		alloc_indices = {a: None for a in range(N)}
-		for a in range(N):
-			if a == 0 or a == N-1: pool = range(N-1)
-			else: pool = range(N-2)
-			alloc_indices[a] = choice(pool)
-
-		# 2. Next we populate the preference orders for each actor:
-		# The objects prefered to the chosen allocation are chosen among the set
-		# of all possible objects restricted to the neighbors allocation.
-		def get_neighbors(a):
-			"""Returns the neighbors indices of actor `a`."""
-			if a == 0: neighbors = [a+1]
-			elif a == N-1: neighbors = [a-1]
-			else: neighbors = [a-1, a+1]
-			return neighbors
-
-		instance = LEFInstance.objects.create(size=N)
-		for a in range(N):
-			neighbors = get_neighbors(a)
-			object_pool_top = [o for o in range(N) 
-				if o not in neighbors and o != a]
-			shuffle(object_pool_top)
-
-			prefs = list()
-			# Populate objects prefered to the allocation.
-			for pref_idx in range(alloc_indices[a]):
-				prefs.append(objects[object_pool_top.pop()])
-
-			# Set allocation in preference order.
-			prefs.append(objects[a])
-
-			# Populate rest of preference order.
-			object_pool_bot = object_pool_top + neighbors
-			shuffle(object_pool_bot)
-			for pref_idx in range(alloc_indices[a]+1, N):
-				prefs.append(objects[object_pool_bot.pop()])
-
-			# Create LEFOrder
-			LEFOrder.objects.create(instance=instance, 
-				index=a, values=','.join(map(str, prefs)))
-
-		return instance
+	def get_matrix(self):
+		"""Returns the preference matrix as a (size x size) memoryview over the
+		stored bytes, without copying them. `matrix[a, i]` is the object at 
+		index `i` in the preference order of actor `a`.
+
+		Returns: (memoryview) Preference matrix.
+		"""
+		return memoryview(self.preferences).cast('B', (self.size, self.size))
+
+	def get_values(self):
+		"""Returns the preference orders of the actors as lists.
+
+		Returns: (list) Preference order of each actor.
+		"""
+		return self.get_matrix().tolist()
+
+	@staticmethod
+	def check_allocation(values, solution):
+		"""Checks that no actor feels envy in an allocation.
+
+		Args:
+			values (list): Preference order of each actor.
+			solution (dict): Allocation to be checked (actor -> index in its
+				preference order). Keys may be ints or strings.
+
+		Returns: (boolean) Validity of the allocation.
+		"""
+		return Preferences(values).is_envy_free(solution)
 
 	def check_solution(self, solution):
 		"""Checks if a specific allocation is valid for the instance, that is
@@ -93,57 +191,35 @@ class LEFInstance(models.Model):
 		"""
 		if self.solved_by != None: return 
 
-		values = [p.get_values() for p in 
-				self.prefs.all().order_by('index')]
-
-		for a in range(self.size):
-
-			if a == 0: neighbors = [a+1]
-			elif a == self.size-1: neighbors = [a-1]
-			else: neighbors = [a-1, a+1]
-
-			for n in neighbors:
-				neighbor_object_value = values[n][solution[str(n)]]
-				neighbor_object_index = values[a].index(neighbor_object_value)
-
-				if neighbor_object_index < solution[str(a)]:
-					return False
+		return preference_cache.get(self).is_envy_free(solution)
 
-		return True
+	@property
+	def version(self):
+		"""Version of the instance held by the clients. Preferences never 
+		change once an instance is created, so the id identifies them.
+		"""
+		return self.pk
 
-	def serialize(self):
+	def serialize(self, known_version=None):
 		"""Returns a serializable python object that can be sent over a 
-		websocket connection.
+		websocket connection. If the client already holds this version of the
+		instance, the preference matrix is left out of the reply.
+
+		Args:
+			known_version (int): Version of the instance held by the client.
 
 		Returns: (dict) containing all relevant data.
 		"""
-		return {
+		data = {
+			'version': self.version,
 			'size': self.size,
-			'values': [p.get_values() for p in 
-				self.prefs.all().order_by('index')],
 			'solved_by': self.solved_by,
 			'solution': list(map(int, self.solution.split(','))) 
 				if self.solution else None
 		}
-
-
-class LEFOrder(models.Model):
-	"""Defines a preference order for a single actor in an instance. The order 
-	is stored as comma separated values in a string.
-
-	Attributes:
-		values (CharField): Order of objects.
-		instance (ForeignKey): Refering instance.
-		index (IntegerField): Index of corresponding actor in instance.
-	"""
-	values = models.CharField(max_length=13)
-	instance = models.ForeignKey(LEFInstance, 
-		on_delete=models.CASCADE, 
-		related_name='prefs')
-	index = models.IntegerField()
-
-	def get_values(self):
-		return list(map(int, self.values.split(',')))
+		if known_version is None or known_version != self.version:
+			data['values'] = preference_cache.get(self).values
+		return data
 
 
 class Room(models.Model):
@@ -151,14 +227,18 @@ class Room(models.Model):
 	It also holds a reference to the instance the players are trying to solve.
 
 	Attributes:
-		token (CharField): Used to identify rooms in the webapp.
+		token (CharField): Used to identify rooms in the webapp (unique).
 		current_instance (ForeignKey): Reference to the instance the players are
 			currently trying to solve.
+		active_at (DateTimeField): Time of the last action of the players of
+			the room, recorded at most every LEF_ROOM_ACTIVITY_INTERVAL
+			seconds. Rooms idle for too long are closed (see sweeper.Sweeper).
 	"""
-	token = models.CharField(max_length=8)
+	token = models.CharField(max_length=8, unique=True)
 	current_instance = models.ForeignKey(LEFInstance, 
 		on_delete=models.SET_NULL,
 		null=True)
+	active_at = models.DateTimeField(default=timezone.now, db_index=True)
 	
 	def serialize(self):
 		"""Returns a serializable python object that can be sent over a 
@@ -166,9 +246,14 @@ class Room(models.Model):
 
 		Returns: (dict) containing all relevant data.
 		"""
+		# The count is annotated when rooms are listed (see 
+		# MenuConsumer.load_rooms).
+		connected_count = getattr(self, 'connected_count', None)
+		if connected_count is None:
+			connected_count = self.connected_players.count()
 		return {
 			'token': self.token,
-			'connected_count': self.connected_players.count()
+			'connected_count': connected_count
 		}
 
 
@@ -177,17 +262,21 @@ class Player(models.Model):
 
 	Attributes:
 		username (CharField): Username of player.
-		token (CharField): Used to identify players in the webapp.
+		token (CharField): Used to identify players in the webapp (unique).
 		connected_to (ForeignKey): Reference to the room the player is currently
 			connected to.
 		is_ready (BooleanField): Status of player. True if the player is in a 
 			room and playing. False otherwise.
+		disconnected_at (DateTimeField): Time at which the connection of the
+			player to its room was lost, if it was. The player stays in the 
+			room for a grace period, during which it may resume its session.
 	"""
 	username = models.CharField(max_length=40)
-	token = models.CharField(max_length=8)
+	token = models.CharField(max_length=8, unique=True)
 	connected_to = models.ForeignKey(Room, on_delete=models.SET_NULL, 
 		null=True, related_name="connected_players")
 	is_ready = models.BooleanField(default=False)
+	disconnected_at = models.DateTimeField(null=True, db_index=True)
 
 	def serialize(self):
 		"""Returns a serializable python object that can be sent over a 
@@ -200,4 +289,84 @@ class Player(models.Model):
 			'token': self.token,
 			'connected_to': self.connected_to.token,
 			'is_ready': self.is_ready
-		}
\ No newline at end of file
+		}
+
+
+# Ranking of the leaderboard: by wins, then by best time to solution, the 
+# winners without a recorded time last. NULLS LAST cannot be used in an index
+# on every backend, so unknown times are sorted by an explicit expression.
+LEADERBOARD_ORDER = (F('wins').desc(), ExpressionWrapper(
+	Q(best_time__isnull=True), output_field=BooleanField()).asc(),
+	F('best_time').asc())
+
+
+class PlayerStats(models.Model):
+	"""Aggregated results of a player, updated in the transaction that solves
+	an instance (see `record`), so that statistics and leaderboards never 
+	scan the games.
+
+	Attributes:
+		player (OneToOneField): Player.
+		games (IntegerField): Number of instances solved in rooms the player
+			was connected to.
+		wins (IntegerField): Number of instances solved by the player.
+		timed_wins (IntegerField): Number of wins whose time is known.
+		best_time (IntegerField): Shortest time to solution (in 
+			milliseconds).
+		total_time (BigIntegerField): Sum of the times to solution of the 
+			timed wins (in milliseconds).
+	"""
+	player = models.OneToOneField(Player, on_delete=models.CASCADE, 
+		primary_key=True, related_name='stats')
+	games = models.IntegerField(default=0)
+	wins = models.IntegerField(default=0)
+	timed_wins = models.IntegerField(default=0)
+	best_time = models.IntegerField(null=True)
+	total_time = models.BigIntegerField(default=0)
+
+	class Meta:
+		# Leaderboard order.
+		indexes = [models.Index(*LEADERBOARD_ORDER,
+			name='game_playerstats_top_idx')]
+
+	@property
+	def mean_time(self):
+		"""Mean time to solution (in milliseconds) of the timed wins."""
+		return self.total_time / self.timed_wins if self.timed_wins else None
+
+	@staticmethod
+	def record(winner_pk, player_pks, time):
+		"""Records a solved instance in the statistics of the players of the
+		room. Must be called in the transaction of the solve.
+
+		Args:
+			winner_pk (int): Id of the winner.
+			player_pks (list): Ids of the players connected to the room.
+			time (int): Time to solution (in milliseconds), if known.
+		"""
+		# Rows of the first games of the players.
+		PlayerStats.objects.bulk_create([PlayerStats(player_id=pk) for pk in
+			set(player_pks) | {winner_pk}], ignore_conflicts=True)
+		PlayerStats.objects.filter(player_id__in=player_pks).exclude(
+			player_id=winner_pk).update(games=F('games') + 1)
+		fields = {'games': F('games') + 1, 'wins': F('wins') + 1}
+		if time is not None:
+			fields.update(timed_wins=F('timed_wins') + 1,
+				total_time=F('total_time') + time,
+				best_time=Least(Coalesce('best_time', Value(time)), 
+					Value(time)))
+		PlayerStats.objects.filter(player_id=winner_pk).update(**fields)
+
+	def serialize(self):
+		"""Returns a serializable python object that can be sent over a 
+		websocket connection.
+
+		Returns: (dict) containing all relevant data.
+		"""
+		return {
+			'username': self.player.username,
+			'games': self.games,
+			'wins': self.wins,
+			'best_time': self.best_time,
+			'mean_time': self.mean_time
+		}
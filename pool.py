@@ -0,0 +1,265 @@
+from collections import deque
+from django.db import close_old_connections
+from django.utils import timezone
+from .conf import get_setting
+from .models import LEFInstance
+
+import logging
+import threading
+
+
+logger = logging.getLogger(__name__)
+
+
+class InstancePool:
+	"""InstancePool keeps pre-generated instances ready to be handed out to
+	rooms, so that starting a game does not generate an instance inline.
+
+	A background producer thread fills the pool of each configured size and
+	refills it whenever it drops below the low-water mark. Pooled instances are
+	flagged in the database (`LEFInstance.pooled`) and claimed with a
+	conditional update, which keeps the claim atomic across worker processes.
+
+	Attributes:
+		sizes (dict): Number of instances to keep ready for each size.
+		low_water_mark (int): Level below which a size is refilled.
+		hits (int): Number of claims served from the pool.
+		misses (int): Number of claims that had to generate an instance.
+	"""
+
+	# Number of pooled instances of a difficulty band read by a claim, and 
+	# number of instances generated by the producer to top up an empty band.
+	BAND_CANDIDATES = 10
+	BAND_TRIES = 50
+
+	def __init__(self, sizes=None, low_water_mark=None, background=True):
+		self.sizes = sizes if sizes is not None \
+			else get_setting('LEF_INSTANCE_POOL_SIZES')
+		self.low_water_mark = low_water_mark if low_water_mark is not None \
+			else get_setting('LEF_INSTANCE_POOL_LOW_WATER_MARK')
+		self.background = background
+		self.hits = 0
+		self.misses = 0
+		self._queues = {size: deque() for size in self.sizes}
+		# Difficulty bands found empty, to be topped up by the producer.
+		self._bands = set()
+		self._lock = threading.Lock()
+		self._wakeup = threading.Event()
+		self._producer = None
+
+	def start(self):
+		"""Starts the producer thread if it is not already running."""
+		with self._lock:
+			if self._producer is not None:
+				return
+			self._producer = threading.Thread(target=self._produce,
+				name='lef-instance-pool', daemon=True)
+			self._producer.start()
+
+	def claim(self, size, band=None):
+		"""Claims a pre-generated instance of the given size. If the queue of
+		the size is empty, an instance pooled in the database (e.g. by another
+		process) is claimed instead; if there is none, an instance is generated
+		inline and the claim counts as a miss.
+
+		Args:
+			size (int): Number of actors.
+			band (str): Difficulty band of the instance (see 
+				LEF_DIFFICULTY_BANDS), if any.
+
+		Returns:
+			(LEFInstance): Instance no longer marked as pooled.
+		"""
+		if self.background:
+			self.start()
+		if band is not None:
+			return self.claim_band(size, band)
+
+		queue = self._queues.setdefault(size, deque())
+		while True:
+			try:
+				instance = queue.popleft()
+			except IndexError:
+				break
+			# Another process may have claimed the same (adopted) instance.
+			if self._claim(instance):
+				if len(queue) < self.low_water_mark:
+					self._wakeup.set()
+				return instance
+
+		self._wakeup.set()
+		for instance in LEFInstance.objects.filter(size=size, 
+				pooled=True)[:self.BAND_CANDIDATES]:
+			# The same candidates may be read by concurrent claims.
+			if self._claim(instance):
+				return instance
+
+		with self._lock:
+			self.misses += 1
+		return LEFInstance.random(size)
+
+	def claim_band(self, size, band):
+		"""Claims a pooled instance whose tightness is in a difficulty band.
+		The candidates are read with a single query on the (size, pooled, 
+		tightness) index. If the band is empty, the pooled instance nearest
+		to the band is claimed instead, counting as a miss (or any instance,
+		see `claim`), and the producer is woken up to top up the band
+		(see `fill_band`), so that the claim never generates instances until
+		one falls in the band.
+
+		Args:
+			size (int): Number of actors.
+			band (str): Difficulty band (see LEF_DIFFICULTY_BANDS).
+
+		Returns:
+			(LEFInstance): Instance no longer marked as pooled.
+		"""
+		low, high = get_setting('LEF_DIFFICULTY_BANDS')[band]
+		pooled = LEFInstance.objects.filter(size=size, pooled=True)
+		for instance in pooled.filter(tightness__gte=low,
+				tightness__lt=high)[:self.BAND_CANDIDATES]:
+			# The same candidates may be read by concurrent claims.
+			if self._claim(instance):
+				return instance
+
+		with self._lock:
+			self._bands.add((size, band))
+		self._wakeup.set()
+		# The nearest instances below and above the band, on the same index.
+		candidates = list(pooled.filter(tightness__lt=low)\
+			.order_by('-tightness')[:self.BAND_CANDIDATES]) + \
+			list(pooled.filter(tightness__gte=high)\
+			.order_by('tightness')[:self.BAND_CANDIDATES])
+		candidates.sort(key=lambda i: low - i.tightness if i.tightness < low
+			else i.tightness - high)
+		for instance in candidates:
+			if self._claim(instance, hit=False):
+				with self._lock:
+					self.misses += 1
+				return instance
+		return self.claim(size)
+
+	def _claim(self, instance, hit=True):
+		"""Claims a pooled instance with a conditional update.
+
+		Args:
+			instance (LEFInstance): Pooled instance.
+			hit (boolean): Whether the claim counts as a hit.
+
+		Returns: (boolean) True if the instance was claimed.
+		"""
+		claimed_at = timezone.now()
+		claimed = LEFInstance.objects.filter(pk=instance.pk, pooled=True)\
+			.update(pooled=False, claimed_at=claimed_at)
+		if claimed:
+			instance.pooled = False
+			instance.claimed_at = claimed_at
+			if hit:
+				with self._lock:
+					self.hits += 1
+		return bool(claimed)
+
+	def fill(self, size):
+		"""Generates, validates and stores instances until the pool of `size`
+		reaches its target level.
+
+		Args:
+			size (int): Number of actors.
+		"""
+		queue = self._queues.setdefault(size, deque())
+		while len(queue) < self.sizes.get(size, 0):
+			values, allocation = LEFInstance.random_values(size)
+			if not LEFInstance.check_allocation(values, allocation):
+				logger.warning('Discarding invalid generated instance.')
+				continue
+			queue.append(LEFInstance.create_from_values(values, pooled=True))
+
+	def fill_band(self, size, band):
+		"""Generates instances until BAND_CANDIDATES pooled instances of
+		`size` are in a difficulty band, or BAND_TRIES instances have been
+		generated. The instances outside the band are kept while the queue of
+		`size` is below its target level, and discarded otherwise so that no
+		pooled instance is left out of the queues.
+
+		Args:
+			size (int): Number of actors.
+			band (str): Difficulty band (see LEF_DIFFICULTY_BANDS).
+		"""
+		if size > get_setting('LEF_DIFFICULTY_MAX_SIZE'):
+			# No tightness is computed for these sizes.
+			return
+		low, high = get_setting('LEF_DIFFICULTY_BANDS')[band]
+		missing = self.BAND_CANDIDATES - LEFInstance.objects.filter(size=size,
+			pooled=True, tightness__gte=low, tightness__lt=high).count()
+		queue = self._queues.setdefault(size, deque())
+		for _ in range(self.BAND_TRIES):
+			if missing <= 0:
+				break
+			values, _ = LEFInstance.random_values(size)
+			fields = LEFInstance.difficulty_fields(values)
+			if low <= fields.get('tightness', -1) < high:
+				LEFInstance.create_from_values(values, pooled=True,
+					difficulty=fields)
+				missing -= 1
+			elif len(queue) < self.sizes.get(size, 0):
+				queue.append(LEFInstance.create_from_values(values,
+					pooled=True, difficulty=fields))
+
+	def release(self, instance):
+		"""Returns a claimed instance that was not used to the pool.
+
+		Args:
+			instance (LEFInstance): Unsolved instance.
+		"""
+		LEFInstance.objects.filter(pk=instance.pk).update(pooled=True)
+		instance.pooled = True
+		self._queues.setdefault(instance.size, deque()).append(instance)
+
+	def adopt(self):
+		"""Loads the pooled instances left in the database (e.g. by a previous
+		process) back into the pool.
+		"""
+		for size, queue in self._queues.items():
+			missing = self.sizes.get(size, 0) - len(queue)
+			if missing > 0:
+				queue.extend(LEFInstance.objects.filter(size=size,
+					pooled=True)[:missing])
+
+	def stats(self):
+		"""Returns the pool counters and the current level of each size.
+
+		Returns: (dict) containing the counters.
+		"""
+		return {
+			'hits': self.hits,
+			'misses': self.misses,
+			'levels': {size: len(q) for size, q in self._queues.items()}
+		}
+
+	def _produce(self):
+		"""Producer loop, refilling every size whenever it is woken up."""
+		try:
+			self.adopt()
+		except Exception:
+			logger.exception('Unable to adopt pooled instances.')
+		while True:
+			close_old_connections()
+			for size in list(self._queues):
+				try:
+					self.fill(size)
+				except Exception:
+					logger.exception('Unable to fill the instance pool.')
+			with self._lock:
+				bands, self._bands = self._bands, set()
+			for size, band in bands:
+				try:
+					self.fill_band(size, band)
+				except Exception:
+					logger.exception('Unable to fill a difficulty band.')
+			close_old_connections()
+			self._wakeup.wait()
+			self._wakeup.clear()
+
+
+# Pool shared by the consumers of the process.
+instance_pool = InstancePool()
@@ -0,0 +1,164 @@
+from collections import OrderedDict
+from .conf import get_setting
+
+import threading
+
+
+class Preferences:
+	"""Decoded preference matrix of an instance along with its rank table, the
+	inverse permutation of each preference order. Envy checks only need
+	constant-time lookups in the rank table.
+
+	Attributes:
+		size (int): Number of actors.
+		values (tuple): Preference order of each actor: `values[a][i]` is the
+			object at index `i` for actor `a`.
+		ranks (tuple): Rank table: `ranks[a][o]` is the index of object `o` in
+			the preference order of actor `a`.
+	"""
+	__slots__ = ('size', 'values', 'ranks')
+
+	def __init__(self, values):
+		self.size = len(values)
+		self.values = tuple(tuple(prefs) for prefs in values)
+		ranks = []
+		for prefs in self.values:
+			rank = [0] * self.size
+			for i, o in enumerate(prefs):
+				rank[o] = i
+			ranks.append(tuple(rank))
+		self.ranks = tuple(ranks)
+
+	def reordered(self, a, order):
+		"""Returns the preferences where actor `a` has another preference
+		order, sharing the rows of the other actors.
+
+		Args:
+			a (int): Index of actor.
+			order (list): New preference order of `a`.
+
+		Returns: (Preferences) Preferences of the modified instance.
+		"""
+		prefs = Preferences.__new__(Preferences)
+		prefs.size = self.size
+		rank = [0] * self.size
+		for i, o in enumerate(order):
+			rank[o] = i
+		prefs.values = self.values[:a] + (tuple(order),) + self.values[a+1:]
+		prefs.ranks = self.ranks[:a] + (tuple(rank),) + self.ranks[a+1:]
+		return prefs
+
+	@staticmethod
+	def allocation(solution):
+		"""Converts an allocation received from a client (a dict whose keys may
+		be strings) into a list.
+
+		Args:
+			solution (dict|list): Allocation (actor -> index in its preference
+				order).
+
+		Returns: (list) Index allocated to each actor.
+		"""
+		if isinstance(solution, dict):
+			solution = {int(a): int(i) for a, i in solution.items()}
+			return [solution[a] for a in range(len(solution))]
+		return list(solution)
+
+	def neighbors(self, a):
+		"""Returns the neighbors indices of actor `a`."""
+		if a == 0: return (1,) if self.size > 1 else ()
+		if a == self.size-1: return (a-1,)
+		return (a-1, a+1)
+
+	def is_envious(self, a, alloc):
+		"""Checks if actor `a` envies one of its neighbors. In a partial 
+		allocation, only actors allocated an object feel envy, towards the 
+		neighbors allocated one.
+
+		Args:
+			a (int): Index of actor.
+			alloc (list): Index allocated to each actor, None if there is none.
+
+		Returns: (boolean) True if the actor is envious.
+		"""
+		if alloc[a] is None:
+			return False
+		rank = self.ranks[a]
+		for n in self.neighbors(a):
+			if alloc[n] is not None and \
+					rank[self.values[n][alloc[n]]] < alloc[a]:
+				return True
+		return False
+
+	def is_envy_free(self, solution):
+		"""Checks that no actor feels envy in an allocation.
+
+		Args:
+			solution (dict|list): Allocation to be checked.
+
+		Returns: (boolean) Validity of the allocation.
+		"""
+		alloc = Preferences.allocation(solution)
+		return not any(self.is_envious(a, alloc) for a in range(self.size))
+
+
+class PreferenceCache:
+	"""Process-wide LRU cache of decoded preferences, keyed by instance id.
+	Only unsolved instances are cached and entries must be invalidated once 
+	their instance is solved.
+
+	Attributes:
+		maxsize (int): Maximum number of instances kept in the cache.
+	"""
+
+	def __init__(self, maxsize=None):
+		self.maxsize = maxsize if maxsize is not None \
+			else get_setting('LEF_PREFERENCE_CACHE_SIZE')
+		self._entries = OrderedDict()
+		self._lock = threading.Lock()
+
+	def get(self, instance):
+		"""Returns the preferences of an instance, decoding them on a miss.
+
+		Args:
+			instance (LEFInstance): Instance whose preferences are requested.
+
+		Returns: (Preferences) Decoded preferences.
+		"""
+		with self._lock:
+			prefs = self._entries.get(instance.pk)
+			if prefs is not None:
+				self._entries.move_to_end(instance.pk)
+				return prefs
+
+		prefs = Preferences(instance.get_values())
+		if instance.pk is None or instance.solved_by is not None:
+			return prefs
+		with self._lock:
+			self._entries[instance.pk] = prefs
+			if len(self._entries) > self.maxsize:
+				self._entries.popitem(last=False)
+		return prefs
+
+	def invalidate(self, instance_id):
+		"""Removes an instance from the cache.
+
+		Args:
+			instance_id (int): Id of the instance.
+		"""
+		with self._lock:
+			self._entries.pop(instance_id, None)
+
+	def clear(self):
+		with self._lock:
+			self._entries.clear()
+
+	def __contains__(self, instance_id):
+		return instance_id in self._entries
+
+	def __len__(self):
+		return len(self._entries)
+
+
+# Cache shared by the consumers of the process.
+preference_cache = PreferenceCache()
@@ -1,10 +1,26 @@
 # from channels.routing import route
 # from game.consumers import ws_connect, ws_disconnect
 from . import consumers
-from django.conf.urls import url
+from .conf import get_setting
+from django.urls import re_path
 
-websocket_urlpatterns = [
-	url(r"^menu/", consumers.MenuConsumer),
-	url(r"^room/(?P<room_token>[^/]+)/(?P<player_token>[^/]+)/$", 
-		consumers.RoomConsumer)
-]
+
+def get_websocket_urlpatterns(use_async=None):
+	"""Returns the websocket routes, served by the synchronous or asynchronous
+	consumers according to the LEF_ASYNC_CONSUMERS setting.
+	"""
+	if use_async is None:
+		use_async = get_setting('LEF_ASYNC_CONSUMERS')
+	if use_async:
+		menu, room = consumers.AsyncMenuConsumer, consumers.AsyncRoomConsumer
+	else:
+		menu, room = consumers.MenuConsumer, consumers.RoomConsumer
+
+	return [
+		re_path(r"^menu/", menu.as_asgi()),
+		re_path(r"^room/(?P<room_token>[^/]+)/(?P<player_token>[^/]+)/$", 
+			room.as_asgi())
+	]
+
+
+websocket_urlpatterns = get_websocket_urlpatterns()
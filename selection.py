@@ -0,0 +1,276 @@
+from asgiref.sync import async_to_sync
+from channels.layers import get_channel_layer
+from collections import OrderedDict
+from .conf import get_setting
+
+import logging
+import threading
+import time
+
+
+logger = logging.getLogger(__name__)
+
+
+class Selection:
+	"""Partial allocation of a player, along with the envy status of each
+	actor and the number of actors allocated each object. A move only
+	re-evaluates the envy of the moved actor and of its neighbors on the path,
+	the other counters being updated in constant time.
+
+	Attributes:
+		instance_id (int): Id of the instance.
+		prefs (Preferences): Preferences of the instance.
+		alloc (list): Index allocated to each actor, None if there is none.
+		envy (list): Envy status of each actor.
+		n_envious (int): Number of envious actors.
+		assigned (int): Number of actors allocated an object.
+		distinct (int): Number of objects allocated to at least one actor.
+	"""
+	__slots__ = ('instance_id', 'prefs', 'alloc', 'envy', 'n_envious',
+		'assigned', 'distinct', '_counts')
+
+	def __init__(self, instance_id, prefs):
+		self.instance_id = instance_id
+		self.prefs = prefs
+		self.alloc = [None] * prefs.size
+		self.envy = [False] * prefs.size
+		self.n_envious = 0
+		self.assigned = 0
+		self.distinct = 0
+		self._counts = [0] * prefs.size
+
+	@property
+	def is_complete(self):
+		"""True if every object is allocated and no actor is envious, i.e. the
+		selection is an envy-free allocation.
+		"""
+		return self.distinct == self.prefs.size and self.n_envious == 0
+
+	def select(self, a, i):
+		"""Allocates the object at index `i` of its preference order to actor
+		`a`, or none if `i` is None.
+
+		Returns: (boolean) True if the selection changed, False if it did not
+			or if the move is invalid.
+		"""
+		size = self.prefs.size
+		if not 0 <= a < size or (i is not None and not 0 <= i < size):
+			return False
+		old = self.alloc[a]
+		if old == i:
+			return False
+		if old is not None:
+			self._move(self.prefs.values[a][old], -1)
+		if i is not None:
+			self._move(self.prefs.values[a][i], 1)
+		self.alloc[a] = i
+		self.assigned += (i is not None) - (old is not None)
+
+		for b in (a,) + self.prefs.neighbors(a):
+			envious = self.prefs.is_envious(b, self.alloc)
+			if envious != self.envy[b]:
+				self.envy[b] = envious
+				self.n_envious += 1 if envious else -1
+		return True
+
+	def _move(self, obj, delta):
+		counts = self._counts
+		counts[obj] += delta
+		if counts[obj] == (1 if delta > 0 else 0):
+			self.distinct += delta
+
+	def progress(self):
+		"""Returns the progress of the player, as sent to the room."""
+		return {
+			'n_envious': self.n_envious,
+			'assigned': self.assigned,
+			'complete': self.is_complete
+		}
+
+
+class SelectionTracker:
+	"""Process-wide LRU store of the selections of the players, keyed by room
+	and player tokens. A selection is started over when the instance of the
+	room changes. Selections are held by the process serving the connection
+	of their player; an evicted selection is started over at the next move.
+
+	Attributes:
+		maxsize (int): Maximum number of selections kept.
+	"""
+
+	def __init__(self, maxsize=None):
+		self.maxsize = maxsize if maxsize is not None \
+			else get_setting('LEF_SELECTION_CACHE_SIZE')
+		self._entries = OrderedDict()
+		self._lock = threading.Lock()
+
+	def select(self, room_token, player_token, instance_id, prefs, a, i):
+		"""Applies a move to the selection of a player.
+
+		Args:
+			room_token (str): Token of the room.
+			player_token (str): Token of the player.
+			instance_id (int): Id of the instance of the room.
+			prefs (Preferences): Preferences of the instance.
+			a (int): Actor moved.
+			i (int): Index of the object allocated in the preference order of
+				the actor, None to deselect it.
+
+		Returns: (dict) Progress of the player (see Selection.progress), None
+			if the move did not change it.
+		"""
+		key = (room_token, player_token)
+		with self._lock:
+			selection = self._entries.get(key)
+			if selection is None or selection.instance_id != instance_id:
+				selection = self._entries[key] = Selection(instance_id, prefs)
+			self._entries.move_to_end(key)
+			if len(self._entries) > self.maxsize:
+				self._entries.popitem(last=False)
+			before = selection.progress()
+			if not selection.select(a, i):
+				return None
+			progress = selection.progress()
+			return progress if progress != before else None
+
+	def get(self, room_token, player_token):
+		with self._lock:
+			return self._entries.get((room_token, player_token))
+
+	def clear(self):
+		with self._lock:
+			self._entries.clear()
+
+	def __len__(self):
+		return len(self._entries)
+
+
+class ProgressThrottle:
+	"""Throttles the progress updates broadcasted to the rooms: the progress of
+	a player is sent at most once per interval. The updates made in between
+	are coalesced, only the latest one being kept, and the pending updates of
+	a room are sent together in a single group message by a background thread
+	once their interval has elapsed.
+
+	Attributes:
+		interval (float): Minimum time (in seconds) between two updates of the
+			progress of a player.
+		clock (callable): Monotonic clock.
+	"""
+
+	def __init__(self, interval=None, clock=time.monotonic):
+		self.interval = interval if interval is not None \
+			else get_setting('LEF_PROGRESS_INTERVAL')
+		self.clock = clock
+		# Time of the last update sent by player, and the pending updates by
+		# room, with the time at which they are due.
+		self._sent = {}
+		self._pending = {}
+		self._lock = threading.Lock()
+		self._wakeup = threading.Event()
+		self._thread = None
+
+	def offer(self, room_token, player_token, progress):
+		"""Offers an update of the progress of a player.
+
+		Returns: (boolean) True if it may be sent at once, False if it was
+			queued.
+		"""
+		now = self.clock()
+		key = (room_token, player_token)
+		with self._lock:
+			pending = self._pending.get(room_token)
+			if pending is not None and player_token in pending[1]:
+				pending[1][player_token] = progress
+				return False
+			last = self._sent.get(key)
+			if last is None or now - last >= self.interval:
+				self._sent[key] = now
+				return True
+			due = last + self.interval
+			updates = pending[1] if pending is not None else {}
+			updates[player_token] = progress
+			self._pending[room_token] = (due if pending is None 
+				else min(due, pending[0]), updates)
+		self.start()
+		self._wakeup.set()
+		return False
+
+	def pop_due(self):
+		"""Removes the pending updates that are due.
+
+		Returns: (tuple) The updates by room, and the time at which the next
+			pending update is due (None if there is none).
+		"""
+		now = self.clock()
+		due, next_due = {}, None
+		with self._lock:
+			for room_token, (at, updates) in list(self._pending.items()):
+				if at > now:
+					next_due = at if next_due is None else min(at, next_due)
+					continue
+				del self._pending[room_token]
+				due[room_token] = updates
+				for player_token in updates:
+					self._sent[(room_token, player_token)] = now
+		return due, next_due
+
+	def forget(self, room_token, player_token):
+		"""Drops the state of a player who left its room."""
+		with self._lock:
+			self._sent.pop((room_token, player_token), None)
+			pending = self._pending.get(room_token)
+			if pending is not None:
+				pending[1].pop(player_token, None)
+				if not pending[1]:
+					del self._pending[room_token]
+
+	def start(self):
+		"""Starts the thread sending the pending updates if it is not already
+		running.
+		"""
+		with self._lock:
+			if self._thread is not None:
+				return
+			self._thread = threading.Thread(target=self._run,
+				name='lef-progress', daemon=True)
+			self._thread.start()
+
+	def _run(self):
+		"""Sending loop, waiting until the next pending update is due."""
+		# Imported here, as the consumers use the throttle.
+		from .consumers import group_name
+		channel_layer = get_channel_layer()
+		while True:
+			self._wakeup.clear()
+			due, next_due = self.pop_due()
+			for room_token, updates in due.items():
+				try:
+					async_to_sync(channel_layer.group_send)(
+						group_name(room_token), {
+							'type': 'broadcast',
+							'data': opponent_progress(updates)
+						})
+				except Exception:
+					logger.exception('Unable to send the progress of room %s.',
+						room_token)
+			timeout = None if next_due is None \
+				else max(next_due - self.clock(), 0)
+			self._wakeup.wait(timeout)
+
+
+def opponent_progress(updates):
+	"""Builds the message broadcasting the progress of players to their room.
+
+	Args:
+		updates (dict): Progress (see Selection.progress) by player token.
+	"""
+	return {
+		'action': 'opponent_progress',
+		'client_data': {'progress': updates}
+	}
+
+
+# Selections and progress throttle of the room consumers of the process.
+selection_tracker = SelectionTracker()
+progress_throttle = ProgressThrottle()
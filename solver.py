@@ -0,0 +1,235 @@
+from .preferences import Preferences
+
+
+class Solver:
+	"""Exact solver for LEF instances. Actors are laid out on a path, so the
+	envy-freeness of an allocation only depends on consecutive pairs of actors.
+	The solver walks the actors from left to right with a state made of the
+	set of objects already allocated (a bitmask) and the object of the previous
+	actor, memoizing the number of ways each state can be completed.
+
+	Attributes:
+		prefs (Preferences): Preferences of the instance.
+		size (int): Number of actors.
+		allowed (list): Bitmask of the objects each actor may receive.
+		compat (list): `compat[a][x]` is the bitmask of the objects actor `a+1`
+			can hold when actor `a` holds `x` without envy between them.
+		effort (int): Number of states expanded so far, a measure of the search
+			effort the instance requires.
+	"""
+
+	def __init__(self, prefs, fixed=None):
+		"""
+		Args:
+			prefs (Preferences|list): Preferences or preference matrix.
+			fixed (dict): Optional partial allocation (actor -> index in its
+				preference order) every solution must extend.
+		"""
+		if not isinstance(prefs, Preferences):
+			prefs = Preferences(prefs)
+		self.prefs = prefs
+		self.size = size = prefs.size
+		self.allowed = [(1 << size) - 1] * size
+		for a, i in (fixed or {}).items():
+			self.allowed[int(a)] = 1 << prefs.values[int(a)][int(i)]
+
+		# `worse[a][x]` is the set of objects actor `a` ranks after `x`.
+		self._worse = [_worse(prefs_a) for prefs_a in prefs.values]
+		self.compat = [self._compat(a) for a in range(size - 1)]
+
+		self.effort = 0
+		# Memoized counts of the states of each actor.
+		self._memo = [{} for _ in range(size)]
+		self._limit = None
+
+	def _compat(self, a):
+		"""Computes `compat[a]`. Actor a holding x and actor a+1 holding y do
+		not envy each other if a ranks y after x and a+1 ranks x after y.
+		"""
+		worse, full = self._worse, (1 << self.size) - 1
+		return [worse[a][x] & (full & ~worse[a+1][x] & ~(1 << x))
+			for x in range(self.size)]
+
+	def reorder(self, a, order):
+		"""Replaces the preference order of actor `a`. Only the pairs of `a`
+		with its neighbors change, so the memoized counts of the states of the
+		actors after `a` are kept; editing an instance this way is cheaper 
+		than building a new solver.
+
+		Args:
+			a (int): Index of actor.
+			order (list): New preference order of `a`.
+		"""
+		self.prefs = self.prefs.reordered(a, order)
+		self._worse[a] = _worse(order)
+		for b in (a - 1, a):
+			if 0 <= b < self.size - 1:
+				self.compat[b] = self._compat(b)
+		for b in range(a + 1):
+			self._memo[b] = {}
+
+	def count(self, limit=None):
+		"""Returns the number of envy-free allocations of the instance.
+
+		Args:
+			limit (int): Stop counting once `limit` solutions are found, which
+				is enough to tell whether an instance has more than `limit-1`
+				solutions.
+
+		Returns: (int) Number of solutions, at most `limit`.
+		"""
+		if limit != self._limit:
+			self._reset(limit)
+		total = 0
+		for x in _bits(self.allowed[0]):
+			total += self._count(0, 1 << x, x)
+			if limit is not None and total >= limit:
+				return limit
+		return total
+
+	def solutions(self, limit=None):
+		"""Enumerates the envy-free allocations of the instance. Dead ends are
+		pruned with the memoized counts, so each solution costs O(N) once the
+		counts are known.
+
+		Args:
+			limit (int): Maximum number of solutions to yield.
+
+		Yields: (list) Index allocated to each actor in its preference order.
+		"""
+		ranks = self.prefs.ranks
+		objects = [None] * self.size
+		found = 0
+
+		def extend(a, mask, x):
+			nonlocal found
+			objects[a] = x
+			if a == self.size - 1:
+				found += 1
+				yield [ranks[b][o] for b, o in enumerate(objects)]
+				return
+			for y in _bits(self.compat[a][x] & self.allowed[a+1] & ~mask):
+				if limit is not None and found >= limit: return
+				if self._count(a + 1, mask | 1 << y, y):
+					yield from extend(a + 1, mask | 1 << y, y)
+
+		if not self.size: return
+		for x in _bits(self.allowed[0]):
+			if limit is not None and found >= limit: return
+			if self._count(0, 1 << x, x):
+				yield from extend(0, 1 << x, x)
+
+	def solve(self):
+		"""Returns an envy-free allocation of the instance, or None if there is
+		none. The counts are capped at 1: knowing that a state has a completion
+		is enough to prune the dead ends, and the search stops at the first
+		completion of each state.
+		"""
+		if self._limit != 1:
+			self._reset(1)
+		return next(self.solutions(limit=1), None)
+
+	def options(self):
+		"""Returns, for each actor, the bitmask of the objects it holds in at
+		least one envy-free allocation. Must be called after a `count` without
+		limit: every state visited by the count has a valid prefix, so a state
+		with completions places its last object in some solution.
+
+		Returns: (list) Bitmask of the objects of each actor.
+		"""
+		options = [0] * self.size
+		for a, memo in enumerate(self._memo):
+			for (mask, x), total in memo.items():
+				if total:
+					options[a] |= 1 << x
+		return options
+
+	def _reset(self, limit):
+		"""Forgets the memoized counts, which depend on the limit."""
+		self._memo = [{} for _ in range(self.size)]
+		self._limit = limit
+
+	def _count(self, a, mask, x):
+		"""Number of ways to complete the allocation where actor `a` holds `x`
+		and the objects in `mask` are allocated to actors 0 to `a`, capped by
+		the current limit.
+		"""
+		key = (mask, x)
+		memo = self._memo[a]
+		total = memo.get(key)
+		if total is not None:
+			return total
+
+		self.effort += 1
+		if a == self.size - 1:
+			total = 1
+		else:
+			total, limit = 0, self._limit
+			candidates = self.compat[a][x] & self.allowed[a+1] & ~mask
+			while candidates:
+				low = candidates & -candidates
+				candidates ^= low
+				y = low.bit_length() - 1
+				total += self._count(a + 1, mask | low, y)
+				if limit is not None and total >= limit:
+					total = limit
+					break
+		memo[key] = total
+		return total
+
+
+def _worse(order):
+	"""Returns, for each object, the bitmask of the objects ranked after it
+	in a preference order.
+	"""
+	row, mask = [0] * len(order), 0
+	for o in reversed(order):
+		row[o] = mask
+		mask |= 1 << o
+	return row
+
+
+def _bits(mask):
+	"""Yields the indices of the bits set in `mask`."""
+	while mask:
+		low = mask & -mask
+		yield low.bit_length() - 1
+		mask ^= low
+
+
+def count_solutions(prefs, fixed=None):
+	"""Returns the number of envy-free allocations (see Solver)."""
+	return Solver(prefs, fixed).count()
+
+
+def iter_solutions(prefs, fixed=None, limit=None):
+	"""Enumerates the envy-free allocations (see Solver.solutions)."""
+	return Solver(prefs, fixed).solutions(limit)
+
+
+def solve(prefs, fixed=None):
+	"""Returns an envy-free allocation, or None (see Solver.solve)."""
+	return Solver(prefs, fixed).solve()
+
+
+def difficulty(prefs):
+	"""Computes the difficulty features of an instance.
+
+	Args:
+		prefs (Preferences|list): Preferences or preference matrix.
+
+	Returns: (dict) `solutions` (number of envy-free allocations), `effort`
+		(number of states the solver expands to count them), `options` 
+		(number of objects each actor holds in some solution) and `tightness`
+		(share of the actor/object pairs found in no solution, from 0 for an
+		unconstrained instance to 1 - 1/N when every actor is forced).
+	"""
+	solver = Solver(prefs)
+	solutions = solver.count()
+	options = [bin(mask).count('1') for mask in solver.options()]
+	return {
+		'solutions': solutions,
+		'effort': solver.effort,
+		'options': options,
+		'tightness': 1 - sum(options) / solver.size**2 if solver.size else 0.
+	}
@@ -0,0 +1,656 @@
+from django.db import IntegrityError, close_old_connections, transaction
+from django.db.models import Count
+from django.utils import timezone
+from datetime import timedelta
+from .conf import get_setting
+from .models import LEFInstance, Player, PlayerStats, Room
+
+import atexit
+import logging
+import threading
+import zlib
+
+
+logger = logging.getLogger(__name__)
+
+
+class PlayerState:
+	"""State of a player connected to a room.
+
+	Attributes:
+		pk (int): Id of the Player object.
+		token (str): Token of the player.
+		username (str): Username of the player.
+		is_ready (bool): Status of the player.
+		disconnected_at (datetime): Time at which the connection of the 
+			player was lost, None while it is connected.
+	"""
+	__slots__ = ('pk', 'token', 'username', 'is_ready', 'disconnected_at')
+
+	def __init__(self, pk, token, username, is_ready, disconnected_at=None):
+		self.pk = pk
+		self.token = token
+		self.username = username
+		self.is_ready = is_ready
+		self.disconnected_at = disconnected_at
+
+	@staticmethod
+	def from_player(player):
+		return PlayerState(player.pk, player.token, player.username,
+			player.is_ready, player.disconnected_at)
+
+	def serialize(self, room_token):
+		"""See Player.serialize."""
+		return {
+			'username': self.username,
+			'token': self.token,
+			'connected_to': room_token,
+			'is_ready': self.is_ready
+		}
+
+
+class RoomState:
+	"""State of a room: its players and the instance they are solving.
+
+	Attributes:
+		pk (int): Id of the Room object.
+		token (str): Token of the room.
+		players (dict): PlayerState of the connected players, by token.
+		instance (LEFInstance): Current instance of the room, if any.
+		active_at (datetime): Last recorded activity of the room (see 
+			Room.active_at).
+	"""
+	__slots__ = ('pk', 'token', 'players', 'instance', 'active_at')
+
+	def __init__(self, pk, token, players, instance, active_at=None):
+		self.pk = pk
+		self.token = token
+		self.players = players
+		self.instance = instance
+		self.active_at = active_at
+
+	@property
+	def ready_count(self):
+		return sum(p.is_ready for p in self.players.values())
+
+	@property
+	def players_version(self):
+		"""Version of the players held by the clients: a checksum of the 
+		serialized players, sent with the context and compared when a session
+		is resumed (see RoomHandler.resume).
+		"""
+		return zlib.crc32(';'.join('{}:{}:{:d}'.format(token, p.username, 
+			p.is_ready) for token, p in sorted(self.players.items()))\
+			.encode('utf-8'))
+
+
+class DatabaseRoomStore:
+	"""Room store reading and writing the room state directly from the models
+	on every call. This is the default store.
+	"""
+
+	def load(self, room_token):
+		"""Returns the state of a room.
+
+		Args:
+			room_token (str): Token of the room.
+
+		Returns: (RoomState) State of the room.
+		"""
+		room = Room.objects.select_related('current_instance')\
+			.get(token=room_token)
+		return RoomState(room.pk, room.token,
+			{p.token: PlayerState.from_player(p)
+				for p in room.connected_players.all()},
+			room.current_instance, room.active_at)
+
+	def join(self, room_token, player_token):
+		"""Creates the room if needed and sets the player status.
+
+		Args:
+			room_token (str): Token of the room.
+			player_token (str): Token of the player.
+
+		Returns: (dict) Room list event to be sent to the menu (see 
+			room_event).
+		"""
+		room, created = self._join(room_token, player_token)
+		return room_event('room_created' if created else 'room_updated',
+			room_token, room.connected_count)
+
+	def _join(self, room_token, player_token):
+		"""Gets or creates the room and connects the player to it, in two 
+		indexed queries when the room exists.
+
+		Returns: (Room, boolean) Room, annotated with its number of connected
+			players, and whether it was created.
+		"""
+		try:
+			room = Room.objects.annotate(
+				connected_count=Count('connected_players')
+			).get(token=room_token)
+			created = False
+		except Room.DoesNotExist:
+			try:
+				with transaction.atomic():
+					room = Room.objects.create(token=room_token)
+			except IntegrityError:
+				# Created concurrently by another worker.
+				return self._join(room_token, player_token)
+			room.connected_count, created = 0, True
+		if not created and activity_due(room.active_at):
+			Room.objects.filter(pk=room.pk).update(active_at=timezone.now())
+
+		# Set player status. The count only changes if the player was not 
+		# already connected to the room.
+		room.connected_count += Player.objects.filter(token=player_token)\
+			.exclude(connected_to=room).update(connected_to=room,
+				disconnected_at=None)
+		return room, created
+
+	def resume(self, room_token, player_token):
+		"""Resumes the session of a player whose connection was lost, if it is
+		still in the room (see `disconnect`). 
+
+		Args:
+			room_token (str): Token of the room.
+			player_token (str): Token of the player.
+
+		Returns: (boolean) True if the session was resumed. Otherwise the 
+			player has left the room and must join it again.
+		"""
+		return bool(Player.objects.filter(token=player_token,
+			connected_to__token=room_token).update(disconnected_at=None))
+
+	def disconnect(self, room_token, player_token):
+		"""Records that the connection of a player was lost, in a single 
+		update. The player stays in the room, so that the session can be 
+		resumed, until it is expired after the grace period (see `expire`).
+
+		Args:
+			room_token (str): Token of the room.
+			player_token (str): Token of the player.
+		"""
+		Player.objects.filter(token=player_token, 
+			connected_to__token=room_token).update(
+				disconnected_at=timezone.now())
+
+	def leave(self, room_token, player_token, idle=None):
+		"""Updates the player status and deletes the room if the player was the
+		last one connected.
+
+		Args:
+			room_token (str): Token of the room.
+			player_token (str): Token of the player.
+			idle (float): If given, the player only leaves if its connection 
+				was lost at least `idle` seconds ago and not resumed since.
+
+		Returns: (dict) Room list event to be sent to the menu, None if the 
+			player did not leave.
+		"""
+		# Update player status
+		players = Player.objects.filter(token=player_token)
+		if idle is not None:
+			players = players.filter(connected_to__token=room_token,
+				disconnected_at__lte=timezone.now() - timedelta(seconds=idle))
+		left = players.update(connected_to=None, is_ready=False, 
+			disconnected_at=None)
+		if idle is not None and not left:
+			return None
+		# If last player to leave the room, delete room.
+		room = Room.objects.annotate(
+			connected_count=Count('connected_players')
+		).get(token=room_token)
+		if room.connected_count <= 0:
+			room.delete()
+			return room_event('room_closed', room_token, 0)
+		return room_event('room_updated', room_token, room.connected_count)
+
+	def touch(self, room):
+		"""Records the activity of a room, unless it was recorded less than
+		LEF_ROOM_ACTIVITY_INTERVAL seconds ago, so that the sweeper does not
+		close it while its players are playing (see `expire_rooms`).
+
+		Args:
+			room (RoomState): State of the room.
+		"""
+		if activity_due(room.active_at):
+			room.active_at = timezone.now()
+			Room.objects.filter(pk=room.pk).update(active_at=room.active_at)
+
+	def set_ready(self, room, player_token):
+		"""Sets the ready status of a player of the room.
+
+		Args:
+			room (RoomState): State of the room.
+			player_token (str): Token of the player.
+		"""
+		if player_token in room.players:
+			room.players[player_token].is_ready = True
+		Player.objects.filter(token=player_token).update(is_ready=True)
+
+	def set_instance(self, room, instance):
+		"""Sets the current instance of the room, unless the room already has
+		one. The update is conditional, so that concurrent workers loading the
+		instance of the same room agree on a single instance.
+
+		Args:
+			room (RoomState): State of the room.
+			instance (LEFInstance): Instance to be solved.
+
+		Returns: (boolean) True if the instance was set. Otherwise, the 
+			instance set by another worker is loaded in the room state.
+		"""
+		active_at = timezone.now()
+		updated = Room.objects.filter(pk=room.pk, 
+			current_instance__isnull=True).update(current_instance=instance,
+				active_at=active_at)
+		if updated:
+			room.instance = instance
+			room.active_at = active_at
+		else:
+			room.instance = Room.objects.select_related('current_instance')\
+				.get(pk=room.pk).current_instance
+		return bool(updated)
+
+	def solve(self, room, player_token, solution):
+		"""Marks the current instance of the room as solved, if no other 
+		player solved it first. The update is conditional, so the first solver
+		wins across worker processes.
+
+		Args:
+			room (RoomState): State of the room.
+			player_token (str): Token of the winner.
+			solution (str): Allocation submitted by the winner.
+
+		Returns: (boolean) True if the player won the instance. Otherwise, 
+			the solution of the winner is loaded in the instance.
+		"""
+		instance = room.instance
+		winner = room.players.get(player_token)
+		time_to_solution = elapsed(instance.started_at)
+		with transaction.atomic():
+			updated = LEFInstance.objects.filter(pk=instance.pk, 
+				solved_by__isnull=True).update(solved_by=player_token, 
+					solution=solution, time_to_solution=time_to_solution,
+					winner_id=winner and winner.pk)
+			if updated and winner is not None:
+				PlayerStats.record(winner.pk, 
+					[p.pk for p in room.players.values()], time_to_solution)
+		if updated:
+			instance.solved_by = player_token
+			instance.solution = solution
+			instance.time_to_solution = time_to_solution
+		else:
+			instance.refresh_from_db(fields=['solved_by', 'solution',
+				'time_to_solution'])
+		return bool(updated)
+
+	def start_clock(self, room):
+		"""Records the time at which the instance of the room is first sent to
+		the players (see LEFInstance.started_at), unless a concurrent worker
+		did first.
+
+		Args:
+			room (RoomState): State of the room.
+		"""
+		started_at = timezone.now()
+		if LEFInstance.objects.filter(pk=room.instance.pk, 
+				started_at__isnull=True).update(started_at=started_at):
+			room.instance.started_at = started_at
+
+	def expire(self, idle, limit):
+		"""Makes the players whose connection was lost at least `idle` seconds
+		ago leave their room, and deletes the rooms left empty.
+
+		Args:
+			idle (float): Grace period, in seconds.
+			limit (int): Maximum number of players processed.
+
+		Returns: (int, list) Number of players processed and room list 
+			events to be sent to the menu.
+		"""
+		cutoff = timezone.now() - timedelta(seconds=idle)
+		players = list(Player.objects.filter(disconnected_at__lte=cutoff)\
+			.values_list('pk', 'connected_to_id')[:limit])
+		if not players:
+			return 0, []
+		# Sessions may have been resumed since.
+		Player.objects.filter(pk__in=[pk for pk, _ in players],
+			disconnected_at__lte=cutoff).update(connected_to=None,
+				is_ready=False, disconnected_at=None)
+
+		events, empty = [], []
+		for room in Room.objects.filter(pk__in={pk for _, pk in players})\
+				.annotate(connected_count=Count('connected_players')):
+			if room.connected_count:
+				events.append(room_event('room_updated', room.token,
+					room.connected_count))
+			else:
+				empty.append(room.pk)
+				events.append(room_event('room_closed', room.token, 0))
+		if empty:
+			Room.objects.filter(pk__in=empty, 
+				connected_players__isnull=True).delete()
+		return len(players), events
+
+	def expire_rooms(self, idle, limit):
+		"""Closes the rooms without activity (see Room.active_at) for at least
+		`idle` seconds, whose players most likely crashed, and the rooms left
+		empty. The activity of the rooms is recorded by every room action
+		(see `touch`), including in the processes using a MemoryRoomStore, so
+		that `manage.py sweep` can be run in a process of its own.
+
+		Args:
+			idle (float): Idle timeout, in seconds.
+			limit (int): Maximum number of rooms closed.
+
+		Returns: (list) Room list events to be sent to the menu.
+		"""
+		rooms = Room.objects.filter(
+			active_at__lte=timezone.now() - timedelta(seconds=idle))
+		held = self.held_rooms()
+		if held:
+			rooms = rooms.exclude(pk__in=held)
+		rooms = dict(rooms.values_list('pk', 'token')[:limit])
+		if not rooms:
+			return []
+		with transaction.atomic():
+			Player.objects.filter(connected_to__in=list(rooms)).update(
+				connected_to=None, is_ready=False, disconnected_at=None)
+			Room.objects.filter(pk__in=list(rooms)).delete()
+		return [room_event('room_closed', token, 0) 
+			for token in rooms.values()]
+
+	def held_rooms(self):
+		"""Returns the ids of the rooms whose state is held by the store, 
+		which only expires them through their players.
+		"""
+		return []
+
+
+class MemoryRoomStore(DatabaseRoomStore):
+	"""Room store holding the state of the active rooms in memory. Rooms are
+	loaded from the database when a player joins, after which handlers only
+	read and write the memory; writes are persisted to the models in batches
+	by a background thread (write-behind).
+
+	The memory of a process is authoritative for its rooms, so all the
+	connections of a room must be served by the same process. Instances are
+	set and solved under the lock of the store, with the same first-wins 
+	semantics as the conditional updates of DatabaseRoomStore.
+
+	Attributes:
+		flush_interval (float): Maximum time (in seconds) between flushes.
+		batch_size (int): Number of pending writes triggering a flush.
+	"""
+
+	def __init__(self, flush_interval=None, batch_size=None):
+		self.flush_interval = flush_interval if flush_interval is not None \
+			else get_setting('LEF_ROOM_STATE_FLUSH_INTERVAL')
+		self.batch_size = batch_size if batch_size is not None \
+			else get_setting('LEF_ROOM_STATE_BATCH_SIZE')
+		self.rooms = {}
+		self._pending = {}
+		self._deleted = set()
+		self._games = []
+		self._lock = threading.RLock()
+		self._wakeup = threading.Event()
+		self._writer = None
+
+	def load(self, room_token):
+		with self._lock:
+			room = self.rooms.get(room_token)
+		if room is None:
+			room = super().load(room_token)
+			with self._lock:
+				room = self.rooms.setdefault(room_token, room)
+		return room
+
+	def join(self, room_token, player_token):
+		room, created = self._join(room_token, player_token)
+		with self._lock:
+			state = self.rooms.get(room_token)
+		# An unknown player token joins no one, as with the database store.
+		if state is None or state.pk != room.pk:
+			state = super().load(room_token)
+			player = state.players.get(player_token)
+		else:
+			player = Player.objects.filter(token=player_token).first()
+			player = player and PlayerState.from_player(player)
+		with self._lock:
+			if player is not None:
+				# Pending writes would undo the join.
+				self._pending.pop((Player, player.pk), None)
+			self._deleted.discard(room.pk)
+			current = self.rooms.get(room_token)
+			if current is None or current.pk != room.pk:
+				self.rooms[room_token] = state
+			elif player is not None:
+				current.players[player_token] = player
+			count = len(self.rooms[room_token].players)
+		return room_event('room_created' if created else 'room_updated',
+			room_token, count)
+
+	def resume(self, room_token, player_token):
+		with self._lock:
+			room = self.rooms.get(room_token)
+			if room is not None:
+				player = room.players.get(player_token)
+				if player is None:
+					return False
+				if player.disconnected_at is not None:
+					player.disconnected_at = None
+					self._write(Player, player.pk, disconnected_at=None)
+				return True
+		return super().resume(room_token, player_token)
+
+	def disconnect(self, room_token, player_token):
+		with self._lock:
+			room = self.rooms.get(room_token)
+			player = room and room.players.get(player_token)
+			if player is not None:
+				player.disconnected_at = timezone.now()
+				self._write(Player, player.pk, 
+					disconnected_at=player.disconnected_at)
+
+	def leave(self, room_token, player_token, idle=None):
+		if idle is not None:
+			with self._lock:
+				room = self.rooms.get(room_token)
+			if room is None:
+				return super().leave(room_token, player_token, idle)
+		room = self.load(room_token)
+		with self._lock:
+			if idle is not None:
+				player = room.players.get(player_token)
+				if player is None or player.disconnected_at is None or \
+						player.disconnected_at > timezone.now() - \
+						timedelta(seconds=idle):
+					return None
+			player = room.players.pop(player_token, None)
+			if player is not None:
+				self._write(Player, player.pk, connected_to=None,
+					is_ready=False, disconnected_at=None)
+			if not room.players:
+				del self.rooms[room_token]
+				self._deleted.add(room.pk)
+				self._pending.pop((Room, room.pk), None)
+				return room_event('room_closed', room_token, 0)
+			return room_event('room_updated', room_token, len(room.players))
+
+	def set_ready(self, room, player_token):
+		with self._lock:
+			player = room.players.get(player_token)
+			# Players who are not in the room are ignored.
+			if player is None:
+				return
+			player.is_ready = True
+			self._write(Player, player.pk, is_ready=True)
+
+	def touch(self, room):
+		with self._lock:
+			if activity_due(room.active_at):
+				room.active_at = timezone.now()
+				self._write(Room, room.pk, active_at=room.active_at)
+
+	def set_instance(self, room, instance):
+		with self._lock:
+			if room.instance is not None:
+				return False
+			room.instance = instance
+			room.active_at = timezone.now()
+			self._write(Room, room.pk, current_instance_id=instance.pk,
+				active_at=room.active_at)
+			return True
+
+	def solve(self, room, player_token, solution):
+		with self._lock:
+			instance = room.instance
+			if instance.solved_by is not None:
+				return False
+			winner = room.players.get(player_token)
+			instance.solved_by = player_token
+			instance.solution = solution
+			instance.time_to_solution = elapsed(instance.started_at)
+			self._write(LEFInstance, instance.pk, solved_by=player_token,
+				solution=solution, time_to_solution=instance.time_to_solution,
+				winner_id=winner and winner.pk)
+			# Recorded in the transaction persisting the solve.
+			if winner is not None:
+				self._games.append((winner.pk, 
+					[p.pk for p in room.players.values()], 
+					instance.time_to_solution))
+			return True
+
+	def start_clock(self, room):
+		with self._lock:
+			if room.instance.started_at is None:
+				room.instance.started_at = timezone.now()
+				self._write(LEFInstance, room.instance.pk,
+					started_at=room.instance.started_at)
+
+	def expire(self, idle, limit):
+		# Only the rooms held in memory: those of other processes are expired
+		# by their own store.
+		cutoff = timezone.now() - timedelta(seconds=idle)
+		with self._lock:
+			expired = [(room_token, player_token) 
+				for room_token, room in self.rooms.items()
+				for player_token, p in room.players.items()
+				if p.disconnected_at is not None and p.disconnected_at <= cutoff
+			][:limit]
+		events = [self.leave(room_token, player_token, idle) 
+			for room_token, player_token in expired]
+		return len(expired), [event for event in events if event is not None]
+
+	def held_rooms(self):
+		with self._lock:
+			return [room.pk for room in self.rooms.values()]
+
+	def _write(self, model, pk, **fields):
+		"""Records fields to be persisted. Writes to the same row are merged.
+		"""
+		self._pending.setdefault((model, pk), {}).update(fields)
+		if self._writer is None:
+			self.start()
+		if len(self._pending) >= self.batch_size:
+			self._wakeup.set()
+
+	def start(self):
+		"""Starts the write-behind thread."""
+		with self._lock:
+			if self._writer is not None:
+				return
+			self._writer = threading.Thread(target=self._run,
+				name='lef-room-state', daemon=True)
+			self._writer.start()
+			atexit.register(self.flush)
+
+	def flush(self):
+		"""Persists all pending writes in a single transaction."""
+		with self._lock:
+			pending, self._pending = self._pending, {}
+			deleted, self._deleted = self._deleted, set()
+			games, self._games = self._games, []
+		if not pending and not deleted:
+			return
+
+		try:
+			with transaction.atomic():
+				for (model, pk), fields in pending.items():
+					model.objects.filter(pk=pk).update(**fields)
+				for game in games:
+					PlayerStats.record(*game)
+				if deleted:
+					# Rooms may have been joined again by now.
+					Room.objects.filter(pk__in=deleted,
+						connected_players__isnull=True).delete()
+		except Exception:
+			# Keep the writes for the next flush, newer writes taking over.
+			with self._lock:
+				for key, fields in pending.items():
+					fields.update(self._pending.get(key, {}))
+					self._pending[key] = fields
+				self._deleted |= deleted
+				self._games[:0] = games
+			raise
+
+	def _run(self):
+		"""Write-behind loop."""
+		while True:
+			self._wakeup.wait(self.flush_interval)
+			self._wakeup.clear()
+			try:
+				close_old_connections()
+				self.flush()
+			except Exception:
+				logger.exception('Unable to persist the room states.')
+
+
+def activity_due(active_at):
+	"""Returns whether the activity of a room last recorded at `active_at`
+	is to be recorded again (see DatabaseRoomStore.touch).
+	"""
+	return active_at is None or timezone.now() - active_at >= timedelta(
+		seconds=get_setting('LEF_ROOM_ACTIVITY_INTERVAL'))
+
+
+def elapsed(started_at):
+	"""Returns the time elapsed since `started_at` (see 
+	LEFInstance.started_at), in milliseconds. None if the start is unknown or
+	in the future, e.g. recorded by a host whose clock is ahead.
+	"""
+	if started_at is None:
+		return None
+	milliseconds = round((timezone.now() - started_at).total_seconds() * 1000)
+	return milliseconds if milliseconds >= 0 else None
+
+
+def room_event(action, room_token, connected_count):
+	"""Builds an event of the room list displayed in the menu.
+
+	Args:
+		action (str): `room_created`, `room_updated` or `room_closed`.
+		room_token (str): Token of the room.
+		connected_count (int): Number of players connected to the room.
+
+	Returns: (dict) Event data, in the format of the websocket messages.
+	"""
+	return {
+		'action': action,
+		'client_data': {
+			'room': {'token': room_token, 'connected_count': connected_count}
+		}
+	}
+
+
+def get_room_store():
+	"""Returns the room store selected by the LEF_ROOM_STATE setting."""
+	if get_setting('LEF_ROOM_STATE') == 'memory':
+		return MemoryRoomStore()
+	return DatabaseRoomStore()
+
+
+# Store shared by the consumers of the process.
+room_store = get_room_store()
@@ -1,6 +1,7 @@
 angular.module('EquityGame')
 .controller('MenuController', ['$rootScope', '$scope', '$cookies', 
-	'WebsocketService', function($rootScope, $scope, $cookies, ws) {
+	'$location', 'WebsocketService', 
+	function($rootScope, $scope, $cookies, $location, ws) {
 
 	/**
 	 * MenuController is in charge of the main menu's functionalities. It 
@@ -24,7 +25,75 @@ angular.module('EquityGame')
 		$cookies.put('player_token', data.player_token);
 		$rootScope.next_room_token = data.next_room_token;
 		$rootScope.rooms = data.rooms;
+		$rootScope.rooms_page = data.page;
+		$rootScope.rooms_has_next = data.has_next;
 	});
+
+	/**
+	 * The room list only loads its first page with the context. Next pages
+	 * are requested with the `load_rooms` action.
+	 */
+	ws.bindCallback('load_rooms', function(data) {
+		let known = {};
+		$rootScope.rooms.forEach(function(room) { known[room.token] = true; });
+		data.rooms.forEach(function(room) {
+			if (!known[room.token]) $rootScope.rooms.push(room);
+		});
+		$rootScope.rooms_page = data.page;
+		$rootScope.rooms_has_next = data.has_next;
+	});
+
+	$scope.loadMoreRooms = function() {
+		ws.send({action: 'load_rooms', page: $rootScope.rooms_page + 1});
+	};
+
+	/**
+	 * Room list events
+	 * The server pushes an event whenever a room is created, its number of 
+	 * players changes or it is closed, so the list stays up to date.
+	 */
+	let find_room = function(token) {
+		for (let idx = 0; idx < $rootScope.rooms.length; idx++) {
+			if ($rootScope.rooms[idx].token === token) return idx;
+		}
+		return -1;
+	};
+	ws.bindCallback('room_created', function(data) {
+		if (find_room(data.room.token) < 0) $rootScope.rooms.unshift(data.room);
+	});
+	ws.bindCallback('room_updated', function(data) {
+		let idx = find_room(data.room.token);
+		if (idx >= 0) $rootScope.rooms[idx] = data.room;
+		else $rootScope.rooms.unshift(data.room);
+	});
+	ws.bindCallback('room_closed', function(data) {
+		let idx = find_room(data.room.token);
+		if (idx >= 0) $rootScope.rooms.splice(idx, 1);
+	});
+	/**
+	 * Matchmaking
+	 * Instead of picking a room, the player may wait for the server to pair 
+	 * it with an opponent. Both players are then sent the room created for
+	 * them.
+	 */
+	$scope.findOpponent = function() {
+		ws.send({action: 'enqueue', player_token: $rootScope.player_token});
+	};
+	$scope.cancelFindOpponent = function() {
+		ws.send({action: 'cancel_enqueue', 
+			player_token: $rootScope.player_token});
+	};
+	ws.bindCallback('enqueue', function(data) {
+		$scope.searching = true;
+	});
+	ws.bindCallback('cancel_enqueue', function(data) {
+		$scope.searching = false;
+	});
+	ws.bindCallback('match_found', function(data) {
+		$scope.searching = false;
+		$location.path('/play/' + data.room_token);
+	});
+
 	// Connect to the websocket service.
 	ws.connect('/menu/');
 	// When the user leaves the page, the websocket must be disconnected.
@@ -57,13 +126,28 @@ angular.module('EquityGame')
 	}
 
 	// Similar to the MenuController, an `onconnect` callback is registered
-	// to request context data on connection
+	// to request context data on connection. When the websocket reconnects, 
+	// the session is resumed instead: the server is sent the versions of the
+	// players and of the instance held by the controller (the resume token)
+	// and only sends back what changed.
+	let connected = false;
 	ws.onconnect_callback = function() {
-		ws.send({'action': 'load_context', 'csmr_data': {}});
+		if (!connected) {
+			connected = true;
+			ws.send({'action': 'load_context', 'csmr_data': {}});
+			return;
+		}
+		ws.send({'action': 'resume', 'csmr_data': {
+			'players_version': self.players_version,
+			'instance_version': self.instance ? self.instance.version : null,
+			'is_solved': self.status === 'solved'
+		}});
 	}
 	// Connection to websocket. We use the url paramters `room_id` and 
-	// `player_token` to identify the connection.
-	ws.connect('/room/'+$routeParams.room_id+'/'+player_token+'/');
+	// `player_token` to identify the connection. Instances are received in
+	// the compact binary encoding.
+	ws.connect('/room/'+$routeParams.room_id+'/'+player_token+'/', 
+		{binary: true});
 	// When the user leaves the page, the websocket must be disconnected.
 	$scope.$on('$routeChangeStart', function(e, n, p) {
 		console.log('About to leave the page: disconnecting websocket.');
@@ -83,7 +167,8 @@ angular.module('EquityGame')
 	 * Received when the server responds to the initial request for context.
 	 * Loads player information (user and adversary).
 	 */
-	ws.bindCallback('load_context', function(data) {
+	let set_players = function(data) {
+		self.players_version = data.players_version;
 		for (let idx in data.players) {
 			let player = data.players[idx];
 			if (player.token === player_token) {
@@ -92,7 +177,8 @@ angular.module('EquityGame')
 				self.adversary = player;
 			}
 		}
-	});
+	};
+	ws.bindCallback('load_context', set_players);
 
 	/**
 	 * load_instance
@@ -100,14 +186,53 @@ angular.module('EquityGame')
 	 * via the `load_instance` event. The GameController can then change status
 	 * and the game starts.
 	 */
-	ws.bindCallback('load_instance', function(data) {
-		self.instance = data.instance;
+	let set_instance = function(instance) {
+		self.instance = instance;
 		if (self.instance.solved_by) {
 			self.status = 'solved';
 			self.selected = self.instance.solution;
 		} else {
 			self.status = 'playing';
 		}
+	};
+	ws.bindCallback('load_instance', function(data) {
+		set_instance(data.instance);
+	});
+
+	/**
+	 * resume
+	 * Response to the `resume` action. Only the players and the instance that
+	 * changed since the connection was lost are received. If the instance 
+	 * received is the one held, its preferences are left out.
+	 */
+	ws.bindCallback('resume', function(data) {
+		if (data.players !== undefined) {
+			set_players(data);
+		}
+		self.players_version = data.players_version;
+		if (data.instance === null) {
+			// The grace period expired: the room starts over.
+			self.instance = undefined;
+			self.selected = {};
+			self.envy = {};
+			self.opponent_progress = undefined;
+			self.status = 'loading';
+		} else if (data.instance !== undefined) {
+			if (data.instance.values === undefined) {
+				data.instance.values = self.instance.values;
+			}
+			set_instance(data.instance);
+		}
+	});
+
+	/**
+	 * notify_reconnect
+	 * Received when a player resumes its session: the game goes on.
+	 */
+	ws.bindCallback('notify_reconnect', function() {
+		if (self.status === 'loading' && self.instance) {
+			self.status = self.instance.solved_by ? 'solved' : 'playing';
+		}
 	});
 
 	/**
@@ -130,12 +255,41 @@ angular.module('EquityGame')
 	ws.bindCallback('check_solution', function(data) {
 		if (data.is_solved) {
 			self.status = 'solved';
+			// The reply only carries the instance status when the instance
+			// version sent with the solution is the current one.
+			if (data.instance.values === undefined && self.instance &&
+				self.instance.version === data.instance.version) {
+				data.instance.values = self.instance.values;
+			}
 			self.instance = data.instance;
 			self.selected = data.instance.solution;
 
 		}
 	});
 	
+	/**
+	 * opponent_progress
+	 * Progress of the players of the room (number of envious actors, number
+	 * of actors allocated an object and whether the selection is complete),
+	 * broadcasted by the server as they select objects.
+	 */
+	ws.bindCallback('opponent_progress', function(data) {
+		for (let token in data.progress) {
+			if (token !== player_token) {
+				self.opponent_progress = data.progress[token];
+			}
+		}
+	});
+	
+	/**
+	 * hint
+	 * Response to the `hint` action: the next object to select, or a dead end
+	 * if no envy-free allocation extends the current selection.
+	 */
+	ws.bindCallback('hint', function(data) {
+		self.hint = data.hint;
+	});
+	
 	/***************************************************************************
 	 * Actions
 	 * 
@@ -170,6 +324,11 @@ angular.module('EquityGame')
 		self.number_of_select = {};
 		self.n_envious = 0;
 		self.selected[i] = j;
+		self.hint = undefined;
+		// The server tracks the selection to show the progress of the player
+		// to its opponent.
+		ws.send({'action': 'select', 'csmr_data': 
+			{'player_token': player_token, 'actor': i, 'index': j}});
 
 		for (var a = 0; a < self.instance.size; a++) {
 			// Check if an object has been selected more than once. 
@@ -194,12 +353,24 @@ angular.module('EquityGame')
 				'action': 'check_solution',
 				'csmr_data': {
 					'solution': self.selected,
-					'player_token': player_token
+					'player_token': player_token,
+					'instance_version': self.instance.version
 				}
 			})
 		}
 	}
 
+	/**
+	 * askHint()
+	 * Asks the server for the next object to select given the current
+	 * selection (see the `hint` callback).
+	 */
+	$scope.askHint = function() {
+		if (self.instance.solved_by) return;
+		ws.send({'action': 'hint', 'csmr_data': 
+			{'player_token': player_token, 'selection': self.selected}});
+	}
+
 	/**
 	 * check_actor_envy()
 	 * Checks if an actor is experiencing envy with the current selection.
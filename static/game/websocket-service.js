@@ -11,6 +11,12 @@ angular.module('EquityGame')
 	 * All messages received must contain an `action` field  and a `client_data` 
 	 * field. The `action` field is used to specify the service callback to be 
 	 * called and `client_data` will be passed to the callback as argument.
+	 * The server may batch several messages in a single frame, as an array of
+	 * messages handled in order.
+	 *
+	 * Connections opened with the `binary` option negotiate the binary
+	 * encoding: the server then sends binary frames in which the preference
+	 * matrices are packed as bytes (see `decodeFrame`).
 	 */
 
 	$rootScope.DEBUG = true;
@@ -25,32 +31,30 @@ angular.module('EquityGame')
 	 * lost, it will try to reconnect regularly.
 	 * 
 	 * @param {String} url - Url to which the websocket will connect.
+	 * @param {object} options - Set `binary` to negotiate the binary encoding.
 	 */
-	self.connect = function(url) {
+	self.connect = function(url, options) {
 		var ws_scheme = window.location.protocol === 'https:' ? 'wss' : 'ws';
         var ws_path = ws_scheme + '://' + window.location.host + url;
+        if (options && options.binary) ws_path += '?encoding=binary';
 
         if ($rootScope.DEBUG) 
         	console.log('[WSService] Connect to ws_path: %s', ws_path);
 
-        self.socket = new ReconnectingWebSocket(ws_path);
+        // Binary frames are received as array buffers, decoded as they arrive.
+        self.socket = new ReconnectingWebSocket(ws_path, null,
+        	{binaryType: 'arraybuffer'});
 
 		self.socket.onmessage = function(e) {
 
 			if ($rootScope.DEBUG)
 				console.log('[WSService] Raw data received: %s', e.data);
 
-			var data = JSON.parse(e.data);
-			try {
-				$rootScope.$apply(function() {
-					handlers[data.action](data.client_data);
-				});
-			} catch (exc) {
-				console.error('[WSService] Error handling: socket.onmessage');
-				console.error('[WSService] Data received', data);
-				console.error('[WSService] Exception:', exc);
+			if (e.data instanceof ArrayBuffer) {
+				dispatch(decodeFrame(e.data));
+			} else {
+				dispatch(JSON.parse(e.data));
 			}
-
 		};
 
 		self.socket.onopen = function() {
@@ -63,6 +67,64 @@ angular.module('EquityGame')
 		};
 	};
 
+	/**
+	 * dispatch()
+	 * Calls the callbacks of the messages of a frame.
+	 *
+	 * @param {object} data - Message, or array of messages.
+	 */
+	var dispatch = function(data) {
+		var messages = Array.isArray(data) ? data : [data];
+		try {
+			$rootScope.$apply(function() {
+				messages.forEach(function(message) {
+					handlers[message.action](message.client_data);
+				});
+			});
+		} catch (exc) {
+			console.error('[WSService] Error handling: socket.onmessage');
+			console.error('[WSService] Data received', data);
+			console.error('[WSService] Exception:', exc);
+		}
+	};
+
+	/**
+	 * decodeFrame()
+	 * Decodes a binary frame: a "LEF1" marker, the length of the JSON header 
+	 * (uint32, big endian), the header, then each preference matrix as its 
+	 * size (uint16, big endian) followed by size*size bytes. The header refers
+	 * to the matrices with `{"$matrix": index}`.
+	 *
+	 * @param {ArrayBuffer} buffer - Frame received.
+	 */
+	var decodeFrame = function(buffer) {
+		var view = new DataView(buffer);
+		var length = view.getUint32(4);
+		var header = new TextDecoder('utf-8').decode(
+			new Uint8Array(buffer, 8, length));
+
+		var matrices = [];
+		for (var offset = 8 + length; offset < buffer.byteLength; ) {
+			var size = view.getUint16(offset);
+			offset += 2;
+			var matrix = [];
+			for (var a = 0; a < size; a++) {
+				matrix.push(Array.from(
+					new Uint8Array(buffer, offset + a*size, size)));
+			}
+			matrices.push(matrix);
+			offset += size * size;
+		}
+
+		return JSON.parse(header, function(key, value) {
+			if (value !== null && typeof value === 'object' && 
+				'$matrix' in value) {
+				return matrices[value.$matrix];
+			}
+			return value;
+		});
+	};
+
 	/**
 	 * bindCallback()
 	 * This method associates an `action` field to a callback function that will
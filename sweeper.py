@@ -0,0 +1,155 @@
+from asgiref.sync import async_to_sync
+from channels.layers import get_channel_layer
+from datetime import timedelta
+from django.db import close_old_connections
+from django.utils import timezone
+from .conf import get_setting
+from .models import LEFInstance
+from .preferences import preference_cache
+from .state import room_store
+
+import logging
+import threading
+import time
+
+
+logger = logging.getLogger(__name__)
+
+
+class Sweeper:
+	"""Sweeper collects the garbage left by the games, so that disconnecting
+	only records the time at which the connection was lost:
+
+	- players disconnected for longer than the grace period leave their room,
+	  and the rooms left empty are deleted;
+	- rooms idle for longer than the idle timeout are closed;
+	- unsolved instances no longer referenced by a room are deleted.
+
+	Each step is run in batches of bounded size. The sweeper is run with
+	`manage.py sweep`, or periodically by a background thread (see
+	LEF_SWEEP_INTERVAL). Rooms held in memory by a MemoryRoomStore are only
+	expired by the sweeper of their own process.
+
+	Attributes:
+		store (DatabaseRoomStore): Room store of the process.
+		grace_period (float): See LEF_RESUME_GRACE_PERIOD.
+		idle_timeout (float): See LEF_ROOM_IDLE_TIMEOUT.
+		batch_size (int): Maximum number of rows handled by a batch.
+	"""
+
+	def __init__(self, store=None, grace_period=None, idle_timeout=None,
+			batch_size=None):
+		self.store = store if store is not None else room_store
+		self.grace_period = grace_period if grace_period is not None \
+			else get_setting('LEF_RESUME_GRACE_PERIOD')
+		self.idle_timeout = idle_timeout if idle_timeout is not None \
+			else get_setting('LEF_ROOM_IDLE_TIMEOUT')
+		self.batch_size = batch_size if batch_size is not None \
+			else get_setting('LEF_SWEEP_BATCH_SIZE')
+		self._lock = threading.Lock()
+		self._thread = None
+
+	def sweep(self, max_batches=None):
+		"""Runs every step until it has nothing left to do.
+
+		Args:
+			max_batches (int): Maximum number of batches run by each step.
+
+		Returns: (dict) Number of players, rooms and instances collected.
+		"""
+		return {
+			'players': self._repeat(self.expire_players, max_batches),
+			'rooms': self._repeat(self.expire_rooms, max_batches),
+			'instances': self._repeat(self.prune_instances, max_batches)
+		}
+
+	def expire_players(self):
+		"""Makes a batch of players disconnected for longer than the grace
+		period leave their room (see DatabaseRoomStore.expire).
+
+		Returns: (int) Number of players processed.
+		"""
+		count, events = self.store.expire(self.grace_period, self.batch_size)
+		self.notify(events)
+		return count
+
+	def expire_rooms(self):
+		"""Closes a batch of idle rooms (see DatabaseRoomStore.expire_rooms).
+
+		Returns: (int) Number of rooms closed.
+		"""
+		events = self.store.expire_rooms(self.idle_timeout, self.batch_size)
+		self.notify(events)
+		return len(events)
+
+	def prune_instances(self):
+		"""Deletes a batch of unsolved instances that were claimed for a room
+		and that no room references any more. The instances claimed less than
+		the idle timeout ago are kept, as their room may not be set yet. The
+		instances never claimed (e.g. generated without `--pooled`) are kept.
+
+		Returns: (int) Number of instances deleted.
+		"""
+		cutoff = timezone.now() - timedelta(seconds=self.idle_timeout)
+		pks = list(LEFInstance.objects.filter(claimed_at__lte=cutoff,
+			pooled=False, solved_by__isnull=True, room__isnull=True
+		).values_list('pk', flat=True)[:self.batch_size])
+		if pks:
+			LEFInstance.objects.filter(pk__in=pks, pooled=False,
+				room__isnull=True).delete()
+			for pk in pks:
+				preference_cache.invalidate(pk)
+		return len(pks)
+
+	def notify(self, events):
+		"""Sends the room list events of a batch to the menu, in a single
+		message.
+		"""
+		if not events:
+			return
+		# Imported here, as the consumers start the sweeper.
+		from .consumers import ROOMS_GROUP
+		channel_layer = get_channel_layer()
+		if channel_layer is not None:
+			async_to_sync(channel_layer.group_send)(ROOMS_GROUP,
+				{'type': 'rooms_event', 'data': events})
+
+	def _repeat(self, step, max_batches):
+		"""Runs batches of a step until one is not full."""
+		total, batches = 0, 0
+		while max_batches is None or batches < max_batches:
+			count = step()
+			total += count
+			batches += 1
+			if count < self.batch_size:
+				break
+		return total
+
+	def start(self, interval=None):
+		"""Starts the sweeper thread if it is not already running.
+
+		Args:
+			interval (float): Time (in seconds) between two sweeps,
+				LEF_SWEEP_INTERVAL by default.
+		"""
+		with self._lock:
+			if self._thread is not None:
+				return
+			self._thread = threading.Thread(target=self._run,
+				args=(interval or get_setting('LEF_SWEEP_INTERVAL'),),
+				name='lef-sweeper', daemon=True)
+			self._thread.start()
+
+	def _run(self, interval):
+		"""Sweeper loop."""
+		while True:
+			time.sleep(interval)
+			try:
+				close_old_connections()
+				self.sweep()
+			except Exception:
+				logger.exception('Unable to sweep the rooms and instances.')
+
+
+# Sweeper of the process, started by the consumers.
+sweeper = Sweeper()
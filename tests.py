@@ -1,147 +1,1106 @@
-from django.test import TestCase
-from .models import LEFInstance
+from asgiref.sync import async_to_sync
+from channels.routing import URLRouter
+from channels.testing import WebsocketCommunicator
+from datetime import timedelta
+from django.core.management import CommandError, call_command
+from django.db import IntegrityError
+from django.test import TestCase, TransactionTestCase, override_settings
+from django.utils import timezone
+from itertools import permutations, product
+from unittest import mock, skipIf
+from . import batch, eventlog, instrumentation, wire
+from .batching import Outbox
+from .conf import get_setting
+from .consumers import MenuConsumer, RoomConsumer, RoomHandler
+from .eventlog import EventLog, LogReader, count_events, log_files, replay
+from .generator import InstanceGenerator
+from .hints import HintCache, compute
+from .layers import Broker, UnixSocketChannelLayer
+from .leaderboard import Leaderboard, solve_rating
+from .matchmaking import Matchmaker
+from .models import LEFInstance, Player, PlayerStats, Room
+from .pool import InstancePool
+from .preferences import Preferences, PreferenceCache, preference_cache
+from .routing import get_websocket_urlpatterns
+from .selection import ProgressThrottle, Selection, SelectionTracker
+from .solver import Solver, difficulty
+from .state import DatabaseRoomStore, MemoryRoomStore, elapsed
+from .sweeper import Sweeper
+
+import asyncio
+import io
+import os
+import random
+import shutil
+import tempfile
 
 
 class LEFInstanceTestCase(TestCase):
 
 	def test_instance_solvable(self):
-
 		number_of_tries = 100
-		print("Generating {} instances".format(number_of_tries))
-
 		fails = 0
-		f_instances = list()
 		for _ in range(number_of_tries):
 			instance = LEFInstance.random(5)
-			solutions, metadata = compute_optimal_solutions(instance)
-			if len(solutions) > 0:
-				print(".", end="", flush=True)
-			else:
-				print("x", end="", flush=True)
+			if Solver(instance.get_values()).solve() is None:
 				fails += 1
-				f_instances.append(instance)
-
-		print()
-		print("Number of fails: {}".format(fails))
-
-
-def _assertNoEnvyC1(instance, alloc, first_index, second_index, r):
-	r_first = instance[first_index].index(r)
-	idx_in_prev = instance[first_index].index(alloc[second_index])
-	r_scnd = instance[second_index].index(r)
-	idx_in_prev2 = instance[second_index].index(alloc[second_index])
-
-	return idx_in_prev > r_first and r_scnd > idx_in_prev2
-
-def _assertNoEnvyC2(instance, alloc, first_index, second_index, r):
-	r_first = instance[first_index].index(r)
-	idx_in_prev = instance[first_index].index(alloc[first_index])
-	r_scnd = instance[second_index].index(r)
-	idx_in_prev2 = instance[second_index].index(alloc[first_index])
-
-	return idx_in_prev < r_first and r_scnd < idx_in_prev2
-
-
-def backtrack_from_agent(instance, agent_idx):
-	ca_idx = agent_idx
-	alloc = {a: None for a in range(len(instance))}
-	impossible_alloc = {a: list() for a in range(len(instance))}
-	allocated_resources = list()
-	niter = 0
-	last_agent_idx = agent_idx-1 if agent_idx != 0 else len(instance)-1
-	hotspots = [[0 for _ in range(len(instance))] for _ in range(len(instance))]
-
-	while not alloc[last_agent_idx] != None:
-
-		agent_prefs = instance[ca_idx]
-		imp_alloc = impossible_alloc[ca_idx]
-		available = [r for r in agent_prefs \
-			if r not in allocated_resources and r not in imp_alloc]
-
-		allocation_happened = False
-		for r in available:
-			niter += 1
-
-			if ca_idx == agent_idx:
-				alloc[ca_idx] = r
-				allocated_resources.append(r)
-				ca_idx = (ca_idx + 1) % len(instance)
-				allocation_happened = True
-				break
-
-			next_index = (ca_idx + 1) % len(instance)
-			if ca_idx == 0:
-				if next_index == agent_idx:
-					if _assertNoEnvyC2(instance, alloc, next_index, next_index-1, r):
-						alloc[ca_idx] = r
-						allocated_resources.append(r)
-						allocation_happened = True
-				else:
-					alloc[ca_idx] = r
-					allocated_resources.append(r)
-					ca_idx = (ca_idx + 1) % len(instance)
-					allocation_happened = True
-				break
-
-			first_index = ca_idx 
-			second_index = ca_idx-1 
-
-			c1 = _assertNoEnvyC1(instance, alloc, first_index, second_index, r)
-			c2 = _assertNoEnvyC2(instance, alloc, next_index, next_index-1, r) \
-				if next_index == agent_idx and next_index != 0 else True
-
-			if c1 and c2:
-				alloc[ca_idx] = r
-				allocated_resources.append(r)
-				ca_idx = (ca_idx + 1) % len(instance)
-				allocation_happened = True
-				break
-
-		if not allocation_happened:
-			impossible_alloc[ca_idx] = list()
-			ca_idx = ca_idx - 1 if ca_idx != 0 else len(instance) - 1
-			impossible_alloc[ca_idx].append(alloc[ca_idx])
-			allocated_resources.remove(alloc[ca_idx])
-			hotspots[instance[ca_idx].index(alloc[ca_idx])][ca_idx] += 1
-			alloc[ca_idx] = None
-
-		if ca_idx == agent_idx and len(impossible_alloc[ca_idx]) == len(instance):
-			return False, niter, hotspots
-
-	return alloc, niter, hotspots
-
-
-def compute_optimal_solutions(instance):
-	solutions = list()
-	metadata = list()
-	revrsd_instance = instance[::-1]
-	instance_length = len(instance)
-	
-	for actor_idx in range(instance_length):
-		sol, niter, hotspots = backtrack_from_agent(instance, actor_idx)
-		if sol and sol not in solutions: 
-			# print("solutions: {}".format(solutions))
-			# print("Sol: {}".format(sol))
-			solutions.append(sol)
-			metadata.append({
-				'niter': niter,
-				'hotspots': hotspots
-			})
-			
-		# compute solution in the reversed order
-		sol, niter, hotspots = backtrack_from_agent(revrsd_instance, actor_idx)
-		if not sol: continue
-		# reverse solution
-		reversed_solution = dict()
-		l = instance_length - 1
-		for a in range(instance_length):
-			reversed_solution[a] = sol.get(l - a)
-
-		if reversed_solution not in solutions: 
-			solutions.append(reversed_solution)
-			metadata.append({
-				'niter': niter,
-				'hotspots': hotspots
-			})
-
-	return solutions, metadata
\ No newline at end of file
+		self.assertEqual(fails, 0)
+
+
+class SolverTestCase(TestCase):
+
+	def brute_force(self, prefs):
+		solutions = list()
+		for objects in permutations(range(prefs.size)):
+			alloc = [prefs.ranks[a][o] for a, o in enumerate(objects)]
+			if prefs.is_envy_free(alloc):
+				solutions.append(alloc)
+		return solutions
+
+	def test_matches_brute_force(self):
+		for N in range(3, 7):
+			for _ in range(20):
+				prefs = Preferences(LEFInstance.random_values(N)[0])
+				solver = Solver(prefs)
+				expected = self.brute_force(prefs)
+				self.assertEqual(solver.count(), len(expected))
+				self.assertEqual(sorted(solver.solutions()), sorted(expected))
+
+	def test_fixed_actors(self):
+		values, allocation = LEFInstance.random_values(6)
+		solver = Solver(values, fixed={0: allocation[0], 3: allocation[3]})
+		for alloc in solver.solutions():
+			self.assertEqual(alloc[0], allocation[0])
+			self.assertEqual(alloc[3], allocation[3])
+		self.assertIsNotNone(solver.solve())
+
+	def test_reorder(self):
+		rng = random.Random(0)
+		for _ in range(20):
+			values = [list(prefs) for prefs in LEFInstance.random_values(6)[0]]
+			solver = Solver(values)
+			solver.count()
+			a = rng.randrange(6)
+			rng.shuffle(values[a])
+			solver.reorder(a, values[a])
+			prefs = Preferences(values)
+			self.assertEqual(solver.prefs.ranks, prefs.ranks)
+			self.assertEqual(solver.count(), len(self.brute_force(prefs)))
+
+
+class LEFInstanceStorageTestCase(TestCase):
+
+	def test_preferences_round_trip(self):
+		values, allocation = LEFInstance.random_values(9)
+		instance = LEFInstance.create_from_values(values)
+		instance = LEFInstance.objects.get(pk=instance.pk)
+
+		self.assertEqual(instance.get_values(), values)
+		self.assertEqual(instance.get_matrix()[3, 4], values[3][4])
+		self.assertTrue(instance.check_solution(
+			{str(a): i for a, i in allocation.items()}))
+
+
+class PreferencesTestCase(TestCase):
+
+	def test_rank_table(self):
+		prefs = Preferences([[2, 0, 1], [1, 2, 0], [0, 1, 2]])
+		self.assertEqual(prefs.ranks[0], (1, 2, 0))
+		self.assertTrue(prefs.is_envy_free({'0': 0, '1': 1, '2': 0}))
+		self.assertFalse(prefs.is_envy_free([2, 1, 0]))
+		self.assertTrue(prefs.is_envious(0, [2, 1, 0]))
+
+	def test_cache_eviction_and_invalidation(self):
+		cache = PreferenceCache(maxsize=2)
+		instances = [LEFInstance.random(5) for _ in range(3)]
+		for instance in instances:
+			cache.get(instance)
+		self.assertNotIn(instances[0].pk, cache)
+		self.assertIs(cache.get(instances[2]), cache.get(instances[2]))
+
+		cache.invalidate(instances[2].pk)
+		self.assertNotIn(instances[2].pk, cache)
+
+
+class InstanceGeneratorTestCase(TestCase):
+
+	def test_requested_solutions(self):
+		generator = InstanceGenerator(seed=0)
+		for size, solutions in [(5, 1), (6, 1), (6, 2), (8, 1)]:
+			values, _ = generator.generate(size, solutions)
+			self.assertEqual(Solver(values).count(), solutions)
+
+	def test_seeded(self):
+		values, _ = InstanceGenerator(seed=4).generate(7, 1)
+		self.assertEqual(values, InstanceGenerator(seed=4).generate(7, 1)[0])
+
+	def test_invalid_requests(self):
+		generator = InstanceGenerator(seed=0)
+		with self.assertRaises(ValueError):
+			generator.generate(5, 0)
+		with self.assertRaises(CommandError):
+			call_command('generate_instances', 1, solutions=0, 
+				stdout=io.StringIO())
+
+	def test_resume_written_chunk(self):
+		tmpdir = tempfile.mkdtemp()
+		self.addCleanup(shutil.rmtree, tmpdir, True)
+		path = os.path.join(tmpdir, 'checkpoint')
+		options = {'seed': 0, 'workers': 1, 'chunk_size': 2, 
+			'checkpoint': path, 'stdout': io.StringIO()}
+		call_command('generate_instances', 4, **options)
+		# Interrupted after writing the last chunk, before recording it.
+		with open(path) as f:
+			lines = f.readlines()
+		with open(path, 'w') as f:
+			f.writelines(lines[:-1])
+		call_command('generate_instances', 4, **options)
+		self.assertEqual(LEFInstance.objects.count(), 4)
+		with open(path) as f:
+			self.assertEqual(len(f.readlines()), 3)
+
+
+class DifficultyTestCase(TestCase):
+
+	def test_features(self):
+		values, _ = LEFInstance.random_values(6)
+		solutions = list(Solver(values).solutions())
+		features = difficulty(values)
+		self.assertEqual(features['solutions'], len(solutions))
+		self.assertEqual(features['options'], 
+			[len({s[a] for s in solutions}) for a in range(6)])
+
+		instance = LEFInstance.create_from_values(values)
+		self.assertEqual(instance.solution_count, len(solutions))
+		self.assertAlmostEqual(instance.tightness, features['tightness'])
+
+	def test_claim_band(self):
+		pool = InstancePool(sizes={5: 30}, low_water_mark=0, background=False)
+		pool.fill(5)
+		low, high = get_setting('LEF_DIFFICULTY_BANDS')['hard']
+		with self.assertNumQueries(2):
+			instance = pool.claim(5, 'hard')
+		self.assertTrue(low <= instance.tightness < high)
+		self.assertFalse(LEFInstance.objects.get(pk=instance.pk).pooled)
+
+	def test_claim_empty_band(self):
+		pool = InstancePool(sizes={5: 0}, low_water_mark=0, background=False)
+		instances = [LEFInstance.create_from_values(
+			LEFInstance.random_values(5)[0], pooled=True) for _ in range(3)]
+		for instance, tightness in zip(instances, (.1, .3, .6)):
+			LEFInstance.objects.filter(pk=instance.pk).update(
+				tightness=tightness)
+		# The nearest instance is claimed, without generating any.
+		instance = pool.claim(5, 'hard')
+		self.assertEqual(instance.pk, instances[2].pk)
+		self.assertEqual(LEFInstance.objects.count(), 3)
+		self.assertEqual(pool.stats()['misses'], 1)
+
+		# The producer tops up the band.
+		pool.fill_band(5, 'hard')
+		low, high = get_setting('LEF_DIFFICULTY_BANDS')['hard']
+		self.assertTrue(LEFInstance.objects.filter(pooled=True,
+			tightness__gte=low, tightness__lt=high).exists())
+		# The instances outside the band are not kept, the queue being full.
+		self.assertEqual(LEFInstance.objects.filter(pooled=True).exclude(
+			tightness__gte=low, tightness__lt=high).count(), 2)
+
+	def test_backfill(self):
+		for _ in range(5):
+			LEFInstance.random(5)
+		LEFInstance.objects.update(solution_count=None, search_effort=None,
+			tightness=None)
+		call_command('backfill_difficulty', workers=1, chunk_size=2,
+			stdout=io.StringIO())
+		self.assertFalse(LEFInstance.objects.filter(
+			tightness__isnull=True).exists())
+
+
+@skipIf(batch.np is None, 'numpy is not installed')
+class BatchEnvyTestCase(TestCase):
+
+	def test_matches_loop(self):
+		values, _ = LEFInstance.random_values(4)
+		prefs = Preferences(values)
+		allocations = list(product(range(4), repeat=4))
+		envy_free, envious = batch.check_allocations(values, allocations)
+
+		for m, alloc in enumerate(allocations):
+			self.assertEqual(envy_free[m], prefs.is_envy_free(alloc))
+			self.assertEqual(envious[m].tolist(),
+				[prefs.is_envious(a, alloc) for a in range(4)])
+
+
+class InstancePoolTestCase(TestCase):
+
+	def test_claim_from_pool(self):
+		pool = InstancePool(sizes={5: 3}, low_water_mark=1, background=False)
+		pool.fill(5)
+		self.assertEqual(LEFInstance.objects.filter(pooled=True).count(), 3)
+
+		instance = pool.claim(5)
+		self.assertFalse(instance.pooled)
+		self.assertEqual(LEFInstance.objects.filter(pooled=True).count(), 2)
+		self.assertEqual(pool.stats()['hits'], 1)
+
+	def test_claim_miss(self):
+		pool = InstancePool(sizes={5: 0}, low_water_mark=0, background=False)
+		instance = pool.claim(5)
+		self.assertEqual(instance.size, 5)
+		self.assertEqual(pool.stats()['misses'], 1)
+
+	def test_claim_from_database(self):
+		# Instances pooled by another process.
+		InstancePool(sizes={5: 2}, low_water_mark=0, background=False).fill(5)
+		pool = InstancePool(sizes={5: 0}, low_water_mark=0, background=False)
+		instance = pool.claim(5)
+		self.assertFalse(LEFInstance.objects.get(pk=instance.pk).pooled)
+		self.assertEqual(LEFInstance.objects.count(), 2)
+		self.assertEqual(pool.stats()['hits'], 1)
+
+	def test_claim_already_claimed(self):
+		pool = InstancePool(sizes={5: 1}, low_water_mark=0, background=False)
+		pool.fill(5)
+		# Simulates a claim made by another process.
+		LEFInstance.objects.update(pooled=False)
+		pool.claim(5)
+		self.assertEqual(pool.stats()['misses'], 1)
+
+
+class RoomStoreTestCase(TestCase):
+
+	def play(self, store, queries):
+		"""Plays a game in room `r1`, checking the number of queries made by
+		`set_ready` and `check_solution`.
+		"""
+		for token in ('p1', 'p2'):
+			Player.objects.create(token=token)
+			store.join('r1', token)
+		pool = InstancePool(sizes={5: 0}, low_water_mark=0, background=False)
+		with mock.patch('game.consumers.room_store', store), \
+				mock.patch('game.consumers.instance_pool', pool):
+			with self.assertNumQueries(queries['set_ready']):
+				RoomHandler.set_ready({'room_token': 'r1', 
+					'player_token': 'p1'})
+			data = RoomHandler.set_ready({'room_token': 'r1', 
+				'player_token': 'p2'})
+			instance = data['callback']({'room_token': 'r1'})\
+				['client_data']['instance']
+			solution = {str(a): i for a, i in 
+				enumerate(Solver(instance['values']).solve())}
+
+			with self.assertNumQueries(queries['check_solution']):
+				data = RoomHandler.check_solution({'room_token': 'r1',
+					'player_token': 'p2', 'solution': solution})
+		self.assertTrue(data['client_data']['is_solved'])
+
+	def test_database_store(self):
+		# The solve and the statistics of both players, in a transaction.
+		self.play(DatabaseRoomStore(), {'set_ready': 5, 'check_solution': 8})
+		instance = Room.objects.get(token='r1').current_instance
+		self.assertEqual(instance.solved_by, 'p2')
+		self.assertEqual(instance.winner.token, 'p2')
+		self.assertIsNotNone(instance.time_to_solution)
+
+	def test_elapsed(self):
+		now = timezone.now()
+		self.assertIsNone(elapsed(None))
+		self.assertIsNone(elapsed(now + timedelta(seconds=10)))
+		self.assertGreaterEqual(elapsed(now - timedelta(seconds=2)), 2000)
+
+	def test_concurrent_workers(self):
+		# Two workers holding the state of the same room.
+		store = DatabaseRoomStore()
+		Player.objects.create(token='p1')
+		store.join('r1', 'p1')
+		rooms = [store.load('r1'), store.load('r1')]
+		instances = [LEFInstance.random(5) for _ in rooms]
+
+		self.assertTrue(store.set_instance(rooms[0], instances[0]))
+		self.assertFalse(store.set_instance(rooms[1], instances[1]))
+		self.assertEqual(rooms[1].instance, instances[0])
+
+		self.assertTrue(store.solve(rooms[0], 'p1', '0,0,0,0,0'))
+		self.assertFalse(store.solve(rooms[1], 'p2', '1,1,1,1,1'))
+		self.assertEqual(rooms[1].instance.solved_by, 'p1')
+
+	def test_memory_store(self):
+		store = MemoryRoomStore(flush_interval=3600)
+		self.play(store, {'set_ready': 0, 'check_solution': 0})
+		self.assertIsNone(Room.objects.get(token='r1').current_instance)
+
+		store.flush()
+		room = Room.objects.get(token='r1')
+		self.assertEqual(room.current_instance.solved_by, 'p2')
+		self.assertTrue(Player.objects.get(token='p1').is_ready)
+		self.assertEqual(PlayerStats.objects.get(player__token='p2').wins, 1)
+
+		store.set_ready(store.load('r1'), 'unknown')
+		store.leave('r1', 'p1')
+		store.leave('r1', 'p2')
+		store.flush()
+		self.assertFalse(Room.objects.filter(token='r1').exists())
+
+	def test_join_unknown_player(self):
+		Player.objects.create(token='p1')
+		stores = {'r1': DatabaseRoomStore(), 
+			'r2': MemoryRoomStore(flush_interval=3600)}
+		for room_token, store in stores.items():
+			# Creates the room, then joins the room held by the store.
+			for _ in range(2):
+				event = store.join(room_token, 'unknown')
+				self.assertEqual(
+					event['client_data']['room']['connected_count'], 0)
+			event = store.join(room_token, 'p1')
+			self.assertEqual(
+				event['client_data']['room']['connected_count'], 1)
+
+
+class LeaderboardTestCase(TestCase):
+
+	def setUp(self):
+		self.players = [Player.objects.create(token='p{}'.format(i), 
+			username='player {}'.format(i)) for i in range(3)]
+
+	def test_record(self):
+		pks = [p.pk for p in self.players]
+		PlayerStats.record(pks[0], pks, 3000)
+		PlayerStats.record(pks[0], pks, 1000)
+		PlayerStats.record(pks[1], pks[:2], None)
+
+		stats = PlayerStats.objects.get(pk=pks[0])
+		self.assertEqual((stats.games, stats.wins, stats.best_time, 
+			stats.mean_time), (3, 2, 1000, 2000))
+		stats = PlayerStats.objects.get(pk=pks[1])
+		self.assertEqual((stats.games, stats.wins, stats.best_time, 
+			stats.mean_time), (3, 1, None, None))
+		self.assertEqual(PlayerStats.objects.get(pk=pks[2]).games, 2)
+		self.assertEqual(solve_rating('p0'), 200 / 3)
+		self.assertIsNone(solve_rating('unknown'))
+
+	def test_top(self):
+		pks = [p.pk for p in self.players]
+		PlayerStats.record(pks[1], pks, 2000)
+		PlayerStats.record(pks[2], pks, 1000)
+		now = [0]
+		board = Leaderboard(size=2, timeout=5, clock=lambda: now[0])
+
+		with self.assertNumQueries(1):
+			top = board.top()
+			self.assertEqual(board.top(1), top[:1])
+		self.assertEqual([p['username'] for p in top], 
+			['player 2', 'player 1'])
+
+		PlayerStats.record(pks[1], pks, 3000)
+		self.assertEqual(board.top(), top)
+		now[0] = 5
+		self.assertEqual(board.top()[0]['username'], 'player 1')
+
+	def test_top_untimed_wins_last(self):
+		pks = [p.pk for p in self.players]
+		PlayerStats.record(pks[0], pks, None)
+		PlayerStats.record(pks[1], pks, 2000)
+		top = Leaderboard(size=3, timeout=0).top()
+		self.assertEqual([p['username'] for p in top],
+			['player 1', 'player 0', 'player 2'])
+
+	def test_menu_leaderboard_size(self):
+		for k in ('abc', [1], None):
+			data = MenuConsumer.handle({'action': 'load_leaderboard', 'k': k})
+			self.assertEqual(data['action'], 'load_leaderboard')
+
+
+class SelectionTestCase(TestCase):
+
+	def tearDown(self):
+		# The ids of the instances are reused once the test is rolled back.
+		preference_cache.clear()
+
+	def test_incremental_envy(self):
+		values, _ = LEFInstance.random_values(6)
+		prefs = Preferences(values)
+		selection = Selection(1, prefs)
+		rng = random.Random(0)
+		for _ in range(200):
+			a, i = rng.randrange(6), rng.choice([None] + list(range(6)))
+			selection.select(a, i)
+			alloc = selection.alloc
+			envy = [prefs.is_envious(b, alloc) for b in range(6)]
+			self.assertEqual(selection.envy, envy)
+			self.assertEqual(selection.n_envious, sum(envy))
+			objects = {values[b][i] for b, i in enumerate(alloc) 
+				if i is not None}
+			self.assertEqual(selection.is_complete, len(objects) == 6 and 
+				prefs.is_envy_free(alloc))
+
+	def test_throttle(self):
+		now = [0]
+		throttle = ProgressThrottle(interval=1, clock=lambda: now[0])
+		with mock.patch.object(throttle, 'start'):
+			self.assertTrue(throttle.offer('r1', 'p1', {'assigned': 1}))
+			self.assertTrue(throttle.offer('r1', 'p2', {'assigned': 1}))
+			self.assertFalse(throttle.offer('r1', 'p1', {'assigned': 2}))
+			self.assertFalse(throttle.offer('r1', 'p1', {'assigned': 3}))
+			self.assertFalse(throttle.offer('r1', 'p2', {'assigned': 2}))
+		self.assertEqual(throttle.pop_due(), ({}, 1))
+		now[0] = 1
+		self.assertEqual(throttle.pop_due(), ({'r1': {'p1': {'assigned': 3},
+			'p2': {'assigned': 2}}}, None))
+		self.assertFalse(throttle.offer('r1', 'p1', {'assigned': 4}))
+
+	def test_select_action(self):
+		store = MemoryRoomStore(flush_interval=3600)
+		for token in ('p1', 'p2'):
+			Player.objects.create(token=token)
+			store.join('r1', token)
+		store.set_instance(store.load('r1'), LEFInstance.random(5))
+		throttle = ProgressThrottle(interval=3600)
+		with mock.patch('game.consumers.room_store', store), \
+				mock.patch('game.consumers.progress_throttle', throttle), \
+				mock.patch('game.consumers.selection_tracker', 
+					SelectionTracker()), \
+				mock.patch.object(throttle, 'start'), \
+				self.assertNumQueries(0):
+			data = RoomHandler.select({'room_token': 'r1', 
+				'player_token': 'p1', 'actor': 0, 'index': 0})
+			self.assertEqual(data['type'], 'broadcast')
+			self.assertEqual(data['client_data']['progress']['p1'],
+				{'n_envious': 0, 'assigned': 1, 'complete': False})
+			# Throttled, then unchanged.
+			self.assertIsNone(RoomHandler.select({'room_token': 'r1', 
+				'player_token': 'p1', 'actor': 1, 'index': 0}))
+			self.assertIsNone(RoomHandler.select({'room_token': 'r1', 
+				'player_token': 'p1', 'actor': 1, 'index': 0}))
+		store.flush()
+
+
+class EventLogTestCase(TestCase):
+
+	def setUp(self):
+		self.directory = tempfile.mkdtemp()
+		self.addCleanup(shutil.rmtree, self.directory, True)
+
+	def test_replay(self):
+		log = EventLog(self.directory, flush_interval=3600)
+		# 2021-03-01 23:59:59 and 2021-03-02 00:00:01 UTC.
+		with mock.patch('game.eventlog.time.time', 
+				side_effect=[1614643199., 1614643201., 1614643202.]):
+			log.record(eventlog.JOIN, 'r1', 'p1')
+			log.record(eventlog.INSTANCE, 'r1', instance_id=3, size=5)
+			log.record(eventlog.SUBMISSION, 'r1', 'p1', 3, valid=True,
+				solution='0,1,2,3,4')
+		log.close()
+
+		paths = log_files(self.directory)
+		self.assertEqual([os.path.basename(p) for p in paths], 
+			['events-2021-03-01.log', 'events-2021-03-02.log'])
+		events = list(replay(paths))
+		self.assertEqual([e.name for e in events], 
+			['join', 'instance', 'submission'])
+		self.assertEqual((events[0].player_token, events[0].instance_id), 
+			('p1', None))
+		self.assertEqual((events[1].player_token, events[1].data), 
+			(None, {'size': 5}))
+		self.assertEqual(events[2].data['solution'], '0,1,2,3,4')
+		self.assertEqual(count_events(paths), 
+			{'join': 1, 'instance': 1, 'submission': 1})
+		self.assertEqual(len(list(replay(paths, {eventlog.SUBMISSION}, 
+			'r2'))), 0)
+
+	def test_unencodable_event(self):
+		log = EventLog(self.directory, flush_interval=3600)
+		log.record(eventlog.JOIN, 'r1', 'p\u00e9')
+		log.record(eventlog.JOIN, 'r1', 'p' * 300)
+		# Dropped on its own, the batch is still written.
+		with self.assertLogs('game.eventlog', 'WARNING'):
+			log.record(eventlog.JOIN, 'r1', 'p' * 70000)
+		log.record(eventlog.READY, 'r1', 'p1')
+		log.close()
+		events = list(replay(log_files(self.directory)))
+		self.assertEqual([e.player_token for e in events],
+			['p\u00e9', 'p' * 300, 'p1'])
+
+	def test_partial_record(self):
+		path = os.path.join(self.directory, 'events-2021-03-01.log')
+		record = eventlog.encode(eventlog.READY, 1614643199., 'r1', 'p1')
+		with open(path, 'wb') as f:
+			f.write(record + record[:-3])
+		with LogReader(path) as reader:
+			self.assertEqual(len(list(reader.scan())), 1)
+		open(path, 'wb').close()
+		self.assertEqual(count_events([path]), {})
+
+	def test_short_writes(self):
+		log = EventLog(self.directory, flush_interval=3600)
+		log.record(eventlog.JOIN, 'r1', 'p1')
+		log.flush()
+		# The file accepts a few bytes per write.
+		write = log._file.write
+		with mock.patch.object(log, '_file') as f:
+			f.write.side_effect = lambda data: write(data[:5])
+			log.record(eventlog.READY, 'r1', 'p1')
+			log.record(eventlog.READY, 'r1', 'p2')
+			log.flush()
+		log.close()
+		events = list(replay(log_files(self.directory)))
+		self.assertEqual([e.player_token for e in events], ['p1', 'p1', 'p2'])
+
+
+class HintTestCase(TestCase):
+
+	def tearDown(self):
+		# The ids of the instances are reused once the test is rolled back.
+		preference_cache.clear()
+
+	def test_follow_hints(self):
+		values, _ = LEFInstance.random_values(8)
+		prefs = Preferences(values)
+		partial = {}
+		for _ in range(8):
+			hint = compute(prefs, partial)
+			self.assertFalse(hint['dead_end'])
+			partial[hint['actor']] = hint['index']
+		self.assertTrue(prefs.is_envy_free(partial))
+		self.assertEqual(compute(prefs, partial), 
+			{'dead_end': False, 'actor': None, 'index': None})
+
+	def test_dead_end(self):
+		values, _ = LEFInstance.random_values(6)
+		prefs = Preferences(values)
+		# Actors 0 and 1 both holding their favorite object.
+		partial = {0: 0, 1: prefs.ranks[1][values[0][0]]}
+		self.assertTrue(compute(prefs, partial)['dead_end'])
+		for objects in permutations(range(6)):
+			alloc = [prefs.ranks[a][o] for a, o in enumerate(objects)]
+			if not prefs.is_envy_free(alloc):
+				continue
+			partial = {0: alloc[0], 3: alloc[3]}
+			self.assertFalse(compute(prefs, partial)['dead_end'])
+
+	def test_warm(self):
+		values, _ = LEFInstance.random_values(8)
+		prefs = Preferences(values)
+		cache = HintCache()
+		cache.warm(1, prefs)
+		self.assertEqual(len(cache), 8)
+		partial = {}
+		with mock.patch('game.hints.compute') as compute_hint:
+			for _ in range(8):
+				hint = cache.get(1, prefs, partial)
+				partial[hint['actor']] = hint['index']
+			compute_hint.assert_not_called()
+		self.assertTrue(prefs.is_envy_free(partial))
+
+	def test_hint_action(self):
+		store = MemoryRoomStore(flush_interval=3600)
+		Player.objects.create(token='p1')
+		store.join('r1', 'p1')
+		store.set_instance(store.load('r1'), LEFInstance.random(5))
+		cache = HintCache()
+		with mock.patch('game.consumers.room_store', store), \
+				mock.patch('game.consumers.hint_cache', cache), \
+				self.assertNumQueries(0):
+			data = {'room_token': 'r1', 'player_token': 'p1',
+				'selection': {'2': 1}}
+			hint = RoomHandler.hint(dict(data))['client_data']['hint']
+			with mock.patch('game.hints.compute') as compute_hint:
+				self.assertEqual(
+					RoomHandler.hint(dict(data))['client_data']['hint'], hint)
+				compute_hint.assert_not_called()
+		self.assertEqual(len(cache), 1)
+		store.flush()
+
+
+class SessionResumeTestCase(TestCase):
+
+	def check_resume(self, store):
+		for token in ('p1', 'p2'):
+			Player.objects.create(token=token)
+			store.join('r1', token)
+		room = store.load('r1')
+		store.set_instance(room, LEFInstance.random(5))
+
+		store.disconnect('r1', 'p1')
+		# The grace period is not over.
+		self.assertIsNone(store.leave('r1', 'p1', idle=3600))
+		self.assertTrue(store.resume('r1', 'p1'))
+
+		with mock.patch('game.consumers.room_store', store):
+			data = RoomHandler.resume({'room_token': 'r1', 
+				'players_version': room.players_version,
+				'instance_version': room.instance.version})
+			self.assertEqual(set(data['client_data']), {'players_version'})
+			self.assertEqual(data['callback']({})['action'], 
+				'notify_reconnect')
+
+			store.set_ready(room, 'p2')
+			data = RoomHandler.resume({'room_token': 'r1', 
+				'players_version': None, 'instance_version': None})
+			self.assertEqual(len(data['client_data']['players']), 2)
+			self.assertIn('values', data['client_data']['instance'])
+
+		store.disconnect('r1', 'p1')
+		event = store.leave('r1', 'p1', idle=0)
+		self.assertEqual(event['client_data']['room']['connected_count'], 1)
+		self.assertFalse(store.resume('r1', 'p1'))
+
+	def test_database_store(self):
+		self.check_resume(DatabaseRoomStore())
+
+	def test_memory_store(self):
+		store = MemoryRoomStore(flush_interval=3600)
+		self.check_resume(store)
+		store.flush()
+		self.assertIsNone(Player.objects.get(token='p1').connected_to)
+
+
+class SweeperTestCase(TestCase):
+
+	def test_sweep(self):
+		store = DatabaseRoomStore()
+		for token in ('p1', 'p2', 'p3'):
+			Player.objects.create(token=token)
+		store.join('r1', 'p1')
+		store.join('r1', 'p2')
+		store.join('r2', 'p3')
+		store.set_instance(store.load('r1'), LEFInstance.random(5))
+		# An instance whose room was deleted, and a solved one.
+		claimed_at = timezone.now() - timedelta(hours=2)
+		LEFInstance.objects.filter(pk=LEFInstance.random(5).pk)\
+			.update(claimed_at=claimed_at)
+		LEFInstance.objects.filter(pk=LEFInstance.random(5).pk)\
+			.update(claimed_at=claimed_at, solved_by='p3')
+		store.disconnect('r1', 'p1')
+		store.disconnect('r2', 'p3')
+
+		sweeper = Sweeper(store, grace_period=0, idle_timeout=3600, 
+			batch_size=1)
+		with mock.patch.object(sweeper, 'notify') as notify:
+			counts = sweeper.sweep()
+		self.assertEqual(counts, {'players': 2, 'rooms': 0, 'instances': 1})
+		events = [e['action'] for c in notify.call_args_list for e in c[0][0]]
+		self.assertEqual(sorted(events), ['room_closed', 'room_updated'])
+		self.assertFalse(Room.objects.filter(token='r2').exists())
+		self.assertIsNone(Player.objects.get(token='p1').connected_to)
+		self.assertEqual(LEFInstance.objects.count(), 2)
+
+		Room.objects.update(active_at=timezone.now() - timedelta(hours=2))
+		with mock.patch.object(sweeper, 'notify'):
+			counts = sweeper.sweep()
+		self.assertEqual(counts['rooms'], 1)
+		self.assertIsNone(Player.objects.get(token='p2').connected_to)
+
+	def test_active_rooms_kept(self):
+		for token in ('p1', 'p2'):
+			Player.objects.create(token=token)
+		memory = MemoryRoomStore(flush_interval=3600)
+		memory.join('r1', 'p1')
+		DatabaseRoomStore().join('r2', 'p2')
+		Room.objects.update(active_at=timezone.now() - timedelta(hours=2))
+		memory.load('r1').active_at = Room.objects.get(token='r1').active_at
+		# The players of both rooms act. The room held in memory is swept by
+		# another process (see `manage.py sweep`).
+		for store, room_token, player_token in ((memory, 'r1', 'p1'), 
+				(DatabaseRoomStore(), 'r2', 'p2')):
+			with mock.patch('game.consumers.room_store', store):
+				RoomHandler.set_ready({'room_token': room_token,
+					'player_token': player_token})
+		memory.flush()
+		sweeper = Sweeper(DatabaseRoomStore(), grace_period=0,
+			idle_timeout=3600)
+		with mock.patch.object(sweeper, 'notify'):
+			counts = sweeper.sweep()
+		self.assertEqual(counts['rooms'], 0)
+		self.assertEqual(Room.objects.count(), 2)
+
+	def test_generated_instances_kept(self):
+		call_command('generate_instances', 3, workers=1, seed=0,
+			stdout=io.StringIO())
+		sweeper = Sweeper(DatabaseRoomStore(), grace_period=0, idle_timeout=0)
+		with mock.patch.object(sweeper, 'notify'):
+			counts = sweeper.sweep()
+		self.assertEqual(counts['instances'], 0)
+		self.assertEqual(LEFInstance.objects.count(), 3)
+
+
+@override_settings(CHANNEL_LAYERS={
+	'default': {'BACKEND': 'channels.layers.InMemoryChannelLayer'}},
+	LEF_SWEEP_INTERVAL=None)
+class AsyncConsumerTestCase(TransactionTestCase):
+	"""Plays through the asynchronous consumers. The database is accessed 
+	from the threads of the consumers, hence the TransactionTestCase.
+	"""
+
+	def setUp(self):
+		self.application = URLRouter(get_websocket_urlpatterns(True))
+		# No background thread writing concurrently to the SQLite database.
+		pool = InstancePool(sizes={5: 0}, low_water_mark=0, background=False)
+		patcher = mock.patch('game.consumers.instance_pool', pool)
+		patcher.start()
+		self.addCleanup(patcher.stop)
+
+	async def receive_action(self, client, action):
+		while True:
+			frame = await client.receive_json_from(5)
+			for message in frame if isinstance(frame, list) else [frame]:
+				if message.get('action') == action:
+					return message
+
+	def test_menu(self):
+		async def play():
+			client = WebsocketCommunicator(self.application, '/menu/')
+			connected, _ = await client.connect()
+			self.assertTrue(connected)
+			await client.send_json_to({'action': 'load_context'})
+			context = await self.receive_action(client, 'load_context')
+			await client.send_json_to({'action': 'load_rooms', 'page': 0})
+			rooms = await self.receive_action(client, 'load_rooms')
+			await client.disconnect()
+			return context, rooms
+
+		context, rooms = async_to_sync(play)()
+		self.assertTrue(Player.objects.filter(
+			token=context['client_data']['player_token']).exists())
+		self.assertEqual(rooms['client_data']['rooms'], [])
+
+	def test_room(self):
+		for token in ('p1', 'p2'):
+			Player.objects.create(token=token)
+
+		async def play():
+			clients = [WebsocketCommunicator(self.application, 
+				'/room/r1/{}/'.format(token)) for token in ('p1', 'p2')]
+			for client in clients:
+				self.assertTrue((await client.connect())[0])
+			for client, token in zip(clients, ('p1', 'p2')):
+				await client.send_json_to({'action': 'set_ready',
+					'csmr_data': {'player_token': token}})
+			instances = [(await self.receive_action(c, 'load_instance'))
+				['client_data']['instance'] for c in clients]
+			solution = {str(a): i for a, i in 
+				enumerate(Solver(instances[0]['values']).solve())}
+			await clients[0].send_json_to({'action': 'check_solution',
+				'csmr_data': {'player_token': 'p1', 'solution': solution}})
+			results = [await self.receive_action(c, 'check_solution') 
+				for c in clients]
+			for client in clients:
+				await client.disconnect()
+			return instances, results
+
+		instances, results = async_to_sync(play)()
+		self.assertEqual(instances[0]['version'], instances[1]['version'])
+		self.assertTrue(all(r['client_data']['is_solved'] for r in results))
+		self.assertEqual(Room.objects.get(token='r1').current_instance\
+			.solved_by, 'p1')
+
+	def test_malformed_frame(self):
+		Player.objects.create(token='p1')
+
+		async def play():
+			client = WebsocketCommunicator(self.application, 
+				'/room/r1/p1/?encoding=binary')
+			self.assertTrue((await client.connect())[0])
+			await client.send_to(bytes_data=wire.MAGIC + b'\x00')
+			while True:
+				output = await client.receive_output(5)
+				if output['type'] == 'websocket.close':
+					return output['code']
+
+		self.assertEqual(async_to_sync(play)(), wire.CLOSE_MALFORMED)
+
+
+class MenuTestCase(TestCase):
+
+	def test_load_rooms(self):
+		players = [Player.objects.create(token=str(i)) for i in range(5)]
+		store = DatabaseRoomStore()
+		for i in range(25):
+			event = store.join('r{}'.format(i), players[i % 5].token)
+		self.assertEqual(event['action'], 'room_created')
+
+		with self.settings(LEF_MENU_PAGE_SIZE=10), self.assertNumQueries(1):
+			data = MenuConsumer.load_rooms(2)
+		self.assertEqual(len(data['rooms']), 5)
+		self.assertFalse(data['has_next'])
+		self.assertEqual(data['rooms'][0], 
+			{'token': 'r4', 'connected_count': 0})
+		self.assertEqual(data['rooms'][-1], 
+			{'token': 'r0', 'connected_count': 0})
+
+		event = store.join('r24', players[0].token)
+		self.assertEqual(event['client_data']['room'], 
+			{'token': 'r24', 'connected_count': 2})
+
+
+	def test_join_queries(self):
+		store = DatabaseRoomStore()
+		for token in ('p1', 'p2'):
+			Player.objects.create(token=token)
+		store.join('r1', 'p1')
+		with self.assertNumQueries(2):
+			event = store.join('r1', 'p2')
+		self.assertEqual(event['client_data']['room']['connected_count'], 2)
+		# Joining again does not count the player twice.
+		event = store.join('r1', 'p2')
+		self.assertEqual(event['client_data']['room']['connected_count'], 2)
+
+		# The player and the first page of rooms.
+		with self.assertNumQueries(2):
+			data = MenuConsumer.load_context({'player_token': 'p1'})
+		self.assertEqual(data['client_data']['player_token'], 'p1')
+
+	def test_new_player_token_taken(self):
+		Player.objects.create(token='p1')
+		with mock.patch('game.consumers.get_new_token',
+				side_effect=['p1', 'p2', 'r1']):
+			data = MenuConsumer.load_context({})
+		self.assertEqual(data['client_data']['player_token'], 'p2')
+		self.assertTrue(Player.objects.filter(token='p2').exists())
+
+
+class MatchmakingTestCase(TestCase):
+
+	def test_pairing(self):
+		now = [0.]
+		matchmaker = Matchmaker(tolerance=50, widening=10, 
+			clock=lambda: now[0])
+		self.assertIsNone(matchmaker.enqueue('p1', 'c1', 1000))
+		self.assertIsNone(matchmaker.enqueue('p2', 'c2', 1500))
+		self.assertIsNone(matchmaker.enqueue('p3', 'c3', 1200))
+		waiting, ticket = matchmaker.enqueue('p4', 'c4', 1530)
+		self.assertEqual((waiting.player_token, ticket.player_token),
+			('p2', 'p4'))
+
+		self.assertTrue(matchmaker.cancel(channel_name='c3'))
+		self.assertIsNone(matchmaker.enqueue('p5', 'c5', 1300))
+		self.assertEqual(matchmaker.match_waiting(), [])
+		# The tolerance widened enough.
+		now[0] = 30
+		pairs = matchmaker.match_waiting()
+		self.assertEqual([[t.player_token for t in pair] for pair in pairs],
+			[['p1', 'p5']])
+		self.assertEqual(len(matchmaker), 0)
+
+	def test_enqueue_action(self):
+		matchmaker = Matchmaker()
+		pool = InstancePool(sizes={5: 0}, low_water_mark=0, background=False)
+		with mock.patch('game.consumers.matchmaker', matchmaker), \
+				mock.patch('game.matchmaking.instance_pool', pool), \
+				self.settings(LEF_MATCHMAKING_INTERVAL=None):
+			reply = MenuConsumer.handle({'action': 'enqueue',
+				'player_token': 'p1'}, 'c1')
+			self.assertEqual(reply['client_data'], {'waiting': 1})
+			reply = MenuConsumer.handle({'action': 'enqueue',
+				'player_token': 'p2'}, 'c2')
+		self.assertEqual(reply['action'], 'match_found')
+		self.assertEqual(reply['notify'], ['c1'])
+		room = Room.objects.get(token=reply['client_data']['room_token'])
+		self.assertIsNotNone(room.current_instance)
+
+	def test_failed_game_requeued(self):
+		now = [0.]
+		matchmaker = Matchmaker(tolerance=0, widening=10, 
+			clock=lambda: now[0])
+		matchmaker.enqueue('p1', 'c1', 1000)
+		matchmaker.enqueue('p2', 'c2', 1100)
+		now[0] = 30
+		channel_layer = mock.Mock()
+		with mock.patch('game.matchmaking.create_room', 
+				side_effect=IntegrityError), \
+				self.assertLogs('game.matchmaking', 'ERROR'):
+			matchmaker.start_games(matchmaker.match_waiting(), channel_layer)
+		channel_layer.send.assert_not_called()
+		# The players keep their waiting time and are paired again.
+		pairs = matchmaker.match_waiting()
+		self.assertEqual([[t.player_token for t in pair] for pair in pairs],
+			[['p1', 'p2']])
+
+
+class OutboxTestCase(TestCase):
+
+	def test_single_frame_per_recipient(self):
+		outbox = Outbox('me')
+		outbox.add({'type': 'broadcast', 'action': 'load_context'})
+		outbox.add({'type': None, 'action': 'check_solution'})
+		outbox.add({'type': 'broadcast', 'action': 'load_instance'})
+		self.assertTrue(outbox.has_broadcast)
+
+		event = outbox.event()
+		self.assertEqual([m['action'] for m in Outbox.unpack(event, 'me')],
+			['load_context', 'check_solution', 'load_instance'])
+		self.assertEqual([m['action'] for m in Outbox.unpack(event, 'other')],
+			['load_context', 'load_instance'])
+
+	def test_direct_only(self):
+		outbox = Outbox('me')
+		outbox.add({'type': None, 'action': 'check_solution'})
+		self.assertFalse(outbox.has_broadcast)
+		self.assertEqual(outbox.payload(), {'action': 'check_solution'})
+		self.assertIsNone(Outbox.unpack(outbox.event(), 'other'))
+
+
+class WireTestCase(TestCase):
+
+	def setUp(self):
+		preference_cache.clear()
+
+	def test_round_trip(self):
+		instance = LEFInstance.random(6)
+		message = [{'action': 'load_context', 'client_data': {'players': []}},
+			{'action': 'load_instance', 
+				'client_data': {'instance': instance.serialize()}}]
+		frame = wire.encode(message)
+
+		decoded = wire.decode(frame)
+		self.assertEqual(decoded[1]['client_data']['instance']['values'],
+			instance.get_values())
+		self.assertEqual(decoded[0], message[0])
+
+	def test_truncated_frame(self):
+		frame = wire.encode({'action': 'load_instance', 'client_data': {
+			'instance': LEFInstance.random(5).serialize()}})
+		for end in (2, wire.HEADER.size + 3, len(frame) - 4):
+			with self.assertRaises(wire.ProtocolError):
+				wire.decode(frame[:end])
+		with self.assertRaises(wire.ProtocolError):
+			wire.decode(wire.HEADER.pack(wire.MAGIC, 2) + b'\xff\xfe')
+
+	def test_known_version(self):
+		instance = LEFInstance.random(5)
+		self.assertIn('values', instance.serialize())
+		self.assertNotIn('values', instance.serialize(instance.version))
+
+	def test_wants_binary(self):
+		self.assertTrue(wire.wants_binary({'query_string': b'encoding=binary'}))
+		self.assertFalse(wire.wants_binary({'query_string': b''}))
+
+
+class InstrumentationTestCase(TestCase):
+
+	def test_measure(self):
+		Player.objects.create(token='p1')
+		sample = instrumentation.Sample('menu', 'load_context', 20)
+		reply = instrumentation.measure(sample, MenuConsumer.handle,
+			{'player_token': 'p1'})
+		self.assertEqual(reply['action'], 'load_context')
+		self.assertEqual(sample.queries, 2)
+
+		registry = instrumentation.Registry()
+		hook = instrumentation.RegistryHook(registry)
+		instrumentation.finish(sample)
+		hook.record_action(sample)
+		hook.record_send('menu', 'load_context', 300)
+		text = registry.exposition()
+		self.assertIn('# TYPE lef_action_seconds histogram', text)
+		self.assertIn('lef_action_queries_bucket{action="load_context",'
+			'consumer="menu",le="3"} 1', text)
+		self.assertIn('lef_send_total{action="load_context",consumer="menu"} '
+			'1', text)
+
+	def test_action_label(self):
+		self.assertEqual(MenuConsumer.action_label({'action': 'enqueue'}),
+			'enqueue')
+		self.assertEqual(MenuConsumer.action_label({}), 'load_context')
+		self.assertEqual(MenuConsumer.action_label({'action': 'x' * 100}),
+			'load_context')
+		self.assertEqual(RoomConsumer.action_label({'action': 'select'}),
+			'select')
+		self.assertEqual(RoomConsumer.action_label({'action': 'load_room'}),
+			'unknown')
+		# Unknown room actions are ignored.
+		self.assertEqual(RoomConsumer.handle({'action': 'load_room', 
+			'csmr_data': {}}, 'r1'), [])
+
+
+class UnixSocketChannelLayerTestCase(TestCase):
+
+	def test_group_send_across_processes(self):
+		tmpdir = tempfile.mkdtemp()
+		self.addCleanup(shutil.rmtree, tmpdir, True)
+		path = os.path.join(tmpdir, 'broker')
+
+		async def run():
+			brokers = [asyncio.ensure_future(Broker().serve(
+				'{}.{}'.format(path, i))) for i in range(2)]
+			while not all(os.path.exists('{}.{}'.format(path, i)) 
+					for i in range(2)):
+				await asyncio.sleep(.01)
+			# Two worker processes.
+			layers = [UnixSocketChannelLayer(path, shards=2) for _ in range(2)]
+			channels = [await layer.new_channel() for layer in layers]
+			for layer, channel in zip(layers, channels):
+				await layer.group_add('group-r1', channel)
+			await layers[0].group_send('group-r1', {'type': 'broadcast'})
+			received = [await asyncio.wait_for(layer.receive(channel), 1)
+				for layer, channel in zip(layers, channels)]
+
+			await layers[1].group_discard('group-r1', channels[1])
+			await layers[1].group_send('group-r1', {'type': 'batch'})
+			received.append(await asyncio.wait_for(
+				layers[0].receive(channels[0]), 1))
+			for layer in layers:
+				await layer.close()
+			for broker in brokers:
+				broker.cancel()
+			return received
+
+		self.assertEqual([m['type'] for m in asyncio.run(run())],
+			['broadcast', 'broadcast', 'batch'])
+
+	def test_reconnect(self):
+		tmpdir = tempfile.mkdtemp()
+		self.addCleanup(shutil.rmtree, tmpdir, True)
+		path = os.path.join(tmpdir, 'broker')
+
+		async def run():
+			broker = asyncio.ensure_future(Broker().serve(path + '.0'))
+			while not os.path.exists(path + '.0'):
+				await asyncio.sleep(.01)
+			self.assertEqual(os.stat(path + '.0').st_mode & 0o777, 0o600)
+			layer = UnixSocketChannelLayer(path)
+			channel = await layer.new_channel()
+			await layer.group_add('group-r1', channel)
+			await layer.group_send('group-r1', {'type': 'broadcast'})
+			received = [await asyncio.wait_for(layer.receive(channel), 1)]
+
+			# The next request reconnects and subscribes again.
+			connection = layer._state()['connections'][0]
+			connection.writer.close()
+			while connection.writer is not None:
+				await asyncio.sleep(.01)
+			await layer.group_send('group-r1', {'type': 'batch'})
+			received.append(await asyncio.wait_for(layer.receive(channel), 1))
+			# Drained queues are removed.
+			self.assertEqual(layer._state()['queues'], {})
+			await layer.close()
+			broker.cancel()
+			return received
+
+		self.assertEqual([m['type'] for m in asyncio.run(run())],
+			['broadcast', 'batch'])
+
+	def test_cancelled_receive(self):
+		tmpdir = tempfile.mkdtemp()
+		self.addCleanup(shutil.rmtree, tmpdir, True)
+		path = os.path.join(tmpdir, 'broker')
+
+		async def run():
+			broker = asyncio.ensure_future(Broker().serve(path + '.0'))
+			while not os.path.exists(path + '.0'):
+				await asyncio.sleep(.01)
+			layer = UnixSocketChannelLayer(path)
+			# The cancelled receive does not take the next message.
+			with self.assertRaises(asyncio.TimeoutError):
+				await asyncio.wait_for(layer.receive('lobby'), .1)
+			await layer.send('lobby', {'type': 'match'})
+			received = [await asyncio.wait_for(layer.receive('lobby'), 1)]
+
+			# Unknown commands close the connection.
+			connection = layer._state()['connections'][0]
+			with self.assertRaises(ConnectionError):
+				await connection.request('serve', path)
+			await layer.close()
+			broker.cancel()
+			return received
+
+		self.assertEqual([m['type'] for m in asyncio.run(run())], ['match'])
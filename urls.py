@@ -3,5 +3,7 @@ from django.urls import path
 from . import views
 
 urlpatterns = [
-	path('', views.index, name='index')
+	path('', views.index, name='index'),
+	path('metrics/', views.metrics, name='metrics'),
+	path('leaderboard/', views.leaderboard, name='leaderboard'),
 ]
\ No newline at end of file
@@ -1,6 +1,25 @@
-from django.http import HttpResponse
+from django.http import HttpResponse, JsonResponse
 from django.shortcuts import render
+from .instrumentation import registry
+from .leaderboard import leaderboard as top_players
 
 
 def index(request):
-	return render(request, 'game/index.html')
\ No newline at end of file
+	return render(request, 'game/index.html')
+
+
+def metrics(request):
+	"""Exposes the instrumentation registry in the Prometheus text format."""
+	return HttpResponse(registry.exposition(),
+		content_type='text/plain; version=0.0.4; charset=utf-8')
+
+
+def leaderboard(request):
+	"""Returns the K best players, K being given by the `k` parameter (see
+	LEF_LEADERBOARD_SIZE).
+	"""
+	try:
+		k = int(request.GET['k'])
+	except (KeyError, ValueError):
+		k = None
+	return JsonResponse({'leaderboard': top_players.top(k)})
@@ -0,0 +1,118 @@
+from itertools import chain
+
+import json
+import struct
+
+
+# Binary frames start with this marker, followed by the length of the JSON
+# header (unsigned int, big endian), the header and the packed matrices.
+MAGIC = b'LEF1'
+HEADER = struct.Struct('!4sI')
+MATRIX_SIZE = struct.Struct('!H')
+# Websocket close code for a malformed frame (invalid payload data).
+CLOSE_MALFORMED = 1007
+
+
+class ProtocolError(ValueError):
+	"""Raised when a binary frame is malformed."""
+
+
+def wants_binary(scope):
+	"""Returns True if the websocket client negotiated the binary encoding,
+	by connecting with `?encoding=binary`.
+
+	Args:
+		scope (dict): Scope of the connection.
+	"""
+	query = scope.get('query_string', b'').decode('latin-1')
+	return 'encoding=binary' in query.split('&')
+
+
+def encode(content):
+	"""Encodes a message (or a batch of messages) into a binary frame. The
+	preference matrices of the instances are packed as bytes after the JSON
+	header, which refers to them by position: `{"$matrix": index}`.
+
+	Args:
+		content (dict|list): Message to be sent.
+
+	Returns: (bytes) Binary frame.
+	"""
+	matrices = []
+	messages = content if isinstance(content, list) else [content]
+	packed = []
+	for message in messages:
+		data = message.get('client_data')
+		if isinstance(data, dict):
+			# Instances are only sent at the first level of `client_data`.
+			data = dict(data)
+			for key, value in data.items():
+				if isinstance(value, dict) and 'size' in value and \
+						isinstance(value.get('values'), (list, tuple)):
+					matrices.append(value['values'])
+					data[key] = dict(value, values={'$matrix': len(matrices)-1})
+			message = dict(message, client_data=data)
+		packed.append(message)
+	if not isinstance(content, list):
+		packed = packed[0]
+
+	header = json.dumps(packed, separators=(',', ':'))\
+		.encode('utf-8')
+	parts = [HEADER.pack(MAGIC, len(header)), header]
+	for values in matrices:
+		parts.append(MATRIX_SIZE.pack(len(values)))
+		parts.append(bytes(o for prefs in values for o in prefs))
+	return b''.join(parts)
+
+
+def decode(frame):
+	"""Decodes a binary frame produced by `encode`.
+
+	Args:
+		frame (bytes): Binary frame.
+
+	Returns: (dict|list) Message.
+
+	Raises:
+		ProtocolError: If the frame is not a well-formed binary frame.
+	"""
+	try:
+		return _decode(frame)
+	except ProtocolError:
+		raise
+	except (struct.error, UnicodeDecodeError, ValueError, TypeError, 
+			IndexError, KeyError) as e:
+		raise ProtocolError('Malformed frame: {}'.format(e)) from e
+
+
+def _decode(frame):
+	view = memoryview(frame)
+	magic, length = HEADER.unpack_from(view)
+	if magic != MAGIC:
+		raise ProtocolError('Unknown frame format.')
+	if HEADER.size + length > len(view):
+		raise ProtocolError('Truncated header.')
+	offset = HEADER.size
+	content = json.loads(bytes(view[offset:offset+length]).decode('utf-8'))
+	offset += length
+
+	matrices = []
+	while offset < len(view):
+		size, = MATRIX_SIZE.unpack_from(view, offset)
+		offset += MATRIX_SIZE.size
+		if offset + size*size > len(view):
+			raise ProtocolError('Truncated matrix.')
+		matrix = view[offset:offset+size*size].cast('B', (size, size))
+		matrices.append(matrix.tolist())
+		offset += size * size
+
+	def restore(obj):
+		if isinstance(obj, dict):
+			if set(obj) == {'$matrix'}:
+				return matrices[obj['$matrix']]
+			return {k: restore(v) for k, v in obj.items()}
+		if isinstance(obj, list):
+			return [restore(v) for v in obj]
+		return obj
+
+	return restore(content)